@@ -0,0 +1,62 @@
+"""
+Benchmark the vectorized backtester on synthetic minute prices.
+
+Generates random walk prices sampled every minute for several tickers, then times
+backtesting all of them at each observation cadence at once, and one ticker's raw
+history resampled onto the minute grid. Reports the median times as JSON.
+
+    python -m benchmarks.bench_backtest --tickers 10 --years 2 --output out.json
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+import numpy as np
+from bot.backtest import BACKTEST_CADENCES, backtest, backtest_history
+from bot.money import MICROS
+
+
+def main(argv: list[str] | None = None) -> dict:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--tickers", type=int, default=10)
+    parser.add_argument("--years", type=float, default=2)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report here")
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    samples = int(args.years * 365 * 24 * 60)
+    walk = np.cumsum(rng.normal(0, 0.01, (args.tickers, samples)), axis=1)
+    prices = np.round((100 + walk) * MICROS).astype(np.int64)
+    timestamps = np.arange(samples, dtype=np.float64) * 60
+    cadences = [seconds // 60 for seconds in BACKTEST_CADENCES.values()]
+
+    timings = {"backtest_seconds": [], "backtest_history_seconds": []}
+    for _ in range(args.runs):
+        t0 = time.perf_counter()
+        backtest(prices, cadences)
+        timings["backtest_seconds"].append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        backtest_history(timestamps, prices[0] / MICROS)
+        timings["backtest_history_seconds"].append(time.perf_counter() - t0)
+
+    report = {
+        "benchmark": "backtest",
+        "config": vars(args),
+        "samples": samples,
+        "median": {key: statistics.median(runs) for key, runs in timings.items()},
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
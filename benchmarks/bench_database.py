@@ -0,0 +1,202 @@
+"""
+Benchmark the Database layer under a synthetic trading load.
+
+Loads N members holding M tickers each, then replays a weighted mix of operations
+with deterministic synthetic prices. Reports ops/sec and p50/p95/p99 latency per
+operation as JSON, so results can be compared between commits. Runs fully offline.
+
+    python -m benchmarks.bench_database --members 1000 --holdings 10 --output out.json
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Callable
+
+from bot.database import Database, InvalidSharesException, NotEnoughCashException
+from bot.money import to_micros
+
+OPERATIONS = [
+    "buy_quonks",
+    "sell_quonks",
+    "observe_price",
+    "get_holdings",
+    "leaderboard",
+]
+DEFAULT_MIX = "buy_quonks=3,sell_quonks=2,observe_price=3,get_holdings=3,leaderboard=1"
+
+
+class SyntheticPrices:
+    """
+    Deterministic price paths: each ticker oscillates around its own base price.
+    """
+
+    def __init__(self, tickers: list[str], seed: int, fixed_point: bool = False):
+        rng = random.Random(seed)
+        self.fixed_point = fixed_point
+        self.bases = {ticker: rng.uniform(5, 50) for ticker in tickers}
+        self.phases = {ticker: rng.uniform(0, 2 * math.pi) for ticker in tickers}
+
+    def price(self, ticker: str, step: int) -> float:
+        wave = math.sin(step / 50 + self.phases[ticker])
+        price = round(self.bases[ticker] * (1 + 0.2 * wave), 2)
+        return to_micros(price) if self.fixed_point else price
+
+
+def percentile(samples: list[float], p: float) -> float:
+    """
+    Nearest-rank percentile of sorted samples.
+    """
+    if not samples:
+        return 0.0
+    rank = math.ceil(p / 100 * len(samples))
+    return samples[max(rank, 1) - 1]
+
+
+def summarize(latencies: dict[str, list[float]], rejected: dict[str, int]) -> dict:
+    results = {}
+    for operation, samples in latencies.items():
+        samples = sorted(samples)
+        total = sum(samples)
+        results[operation] = {
+            "count": len(samples),
+            "rejected": rejected[operation],
+            "ops_per_sec": len(samples) / total if total > 0 else 0.0,
+            "p50_ms": percentile(samples, 50) * 1000,
+            "p95_ms": percentile(samples, 95) * 1000,
+            "p99_ms": percentile(samples, 99) * 1000,
+        }
+    return results
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        operation, weight = part.split("=")
+        if operation not in OPERATIONS:
+            raise ValueError(f"Unknown operation: {operation}")
+        weights[operation] = float(weight)
+    return weights
+
+
+def load(
+    db: Database, prices: SyntheticPrices, members: int, holdings: int, seed: int
+) -> list[list[str]]:
+    """
+    Register the members and buy their holdings, returning each member's tickers.
+    """
+    rng = random.Random(seed)
+    tickers = list(prices.bases)
+    portfolios = []
+    for member_id in range(members):
+        db.register_user(member_id)
+        portfolio = rng.sample(tickers, holdings)
+        for ticker in portfolio:
+            shares = rng.randint(5, 10)
+            db.buy_quonks(member_id, ticker, shares, prices.price(ticker, 0))
+        portfolios.append(portfolio)
+    return portfolios
+
+
+def replay(
+    db: Database,
+    prices: SyntheticPrices,
+    portfolios: list[list[str]],
+    operations: int,
+    mix: dict[str, float],
+    seed: int,
+) -> tuple[dict[str, list[float]], dict[str, int], float]:
+    rng = random.Random(seed)
+    names = list(mix)
+    weights = list(mix.values())
+    latencies = {name: [] for name in names}
+    rejected = {name: 0 for name in names}
+    calls: dict[str, Callable[[int, str, float], object]] = {
+        "buy_quonks": lambda member_id, ticker, price: db.buy_quonks(
+            member_id, ticker, rng.randint(1, 5), price
+        ),
+        "sell_quonks": lambda member_id, ticker, price: db.sell_quonks(
+            member_id, ticker, rng.randint(1, 5), price
+        ),
+        "observe_price": db.observe_price,
+        "get_holdings": lambda member_id, ticker, price: list(
+            db.get_holdings(member_id)
+        ),
+        "leaderboard": lambda member_id, ticker, price: list(db.leaderboard()),
+    }
+    started = time.perf_counter()
+    for step in range(1, operations + 1):
+        name = rng.choices(names, weights)[0]
+        member_id = rng.randrange(len(portfolios))
+        ticker = rng.choice(portfolios[member_id])
+        price = prices.price(ticker, step)
+        t0 = time.perf_counter()
+        try:
+            calls[name](member_id, ticker, price)
+        except (NotEnoughCashException, InvalidSharesException):
+            rejected[name] += 1
+        latencies[name].append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    return latencies, rejected, elapsed
+
+
+def main(argv: list[str] | None = None) -> dict:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--members", type=int, default=200)
+    parser.add_argument("--holdings", type=int, default=5)
+    parser.add_argument("--tickers", type=int, default=50)
+    parser.add_argument("--operations", type=int, default=5000)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fixed-point", action="store_true", help="Integer money")
+    parser.add_argument(
+        "--path", help="New database file, defaults to a temporary file"
+    )
+    parser.add_argument("--output", help="Write the JSON report here")
+    args = parser.parse_args(argv)
+
+    if args.holdings > args.tickers:
+        parser.error("--holdings cannot exceed --tickers")
+    # The run loads synthetic members and clears every table at the end
+    if args.path and os.path.exists(args.path):
+        parser.error(f"--path {args.path} already exists")
+    tickers = [f"T{i:04d}" for i in range(args.tickers)]
+    prices = SyntheticPrices(tickers, args.seed, args.fixed_point)
+    mix = parse_mix(args.mix)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.path or os.path.join(directory, "bench.db")
+        db = Database(path, fixed_point=args.fixed_point)
+        t0 = time.perf_counter()
+        portfolios = load(db, prices, args.members, args.holdings, args.seed)
+        load_seconds = time.perf_counter() - t0
+        latencies, rejected, elapsed = replay(
+            db, prices, portfolios, args.operations, mix, args.seed
+        )
+        db.clear()
+        db.close()
+
+    report = {
+        "benchmark": "database",
+        "config": vars(args),
+        "load_seconds": load_seconds,
+        "elapsed_seconds": elapsed,
+        "ops_per_sec": args.operations / elapsed,
+        "operations": summarize(latencies, rejected),
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
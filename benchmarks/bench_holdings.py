@@ -0,0 +1,118 @@
+"""
+Benchmark holding lookups and updates before and after HOLDINGS was keyed.
+
+For each table size, builds a database with the unkeyed HOLDINGS of older
+databases, times per-holding lookups and updates, then runs the migrations to key
+it in place and times them again. Reports the median latencies and the migration
+time per size as JSON. Runs fully offline.
+
+    python -m benchmarks.bench_holdings --rows 1000 10000 100000 --output out.json
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable
+from bot.database import Database
+from bot.money import to_micros
+
+TICKERS = 10
+
+
+def unkey(db: Database):
+    # Put HOLDINGS back the way it was before the first migration
+    db.db.execute("CREATE TABLE HOLDINGS_UNKEYED AS SELECT * FROM HOLDINGS")
+    db.db.execute("DROP TABLE HOLDINGS")
+    db.db.execute("ALTER TABLE HOLDINGS_UNKEYED RENAME TO HOLDINGS")
+    db.db.execute("DELETE FROM MIGRATIONS")
+
+
+def load(db: Database, rows: int):
+    members = rows // TICKERS
+    db.db.execute("INSERT INTO MEMBERS SELECT range FROM range(?)", [members])
+    query = "INSERT INTO CASH SELECT range, ? FROM range(?)"
+    db.db.execute(query, [to_micros(Database.STARTING_CASH), members])
+    query = """
+        INSERT INTO HOLDINGS
+        SELECT m.range, 'T' || t.range, 10, ?, ?
+        FROM range(?) m, range(?) t
+    """
+    db.db.execute(query, [to_micros(10), to_micros(100), members, TICKERS])
+
+
+def median_ms(operation: Callable[[int, str], object], members: int, ops: int):
+    rng = random.Random(0)
+    samples = []
+    for _ in range(ops):
+        member_id = rng.randrange(members)
+        ticker = f"T{rng.randrange(TICKERS)}"
+        t0 = time.perf_counter()
+        operation(member_id, ticker)
+        samples.append(time.perf_counter() - t0)
+    return statistics.median(samples) * 1000
+
+
+def measure(db: Database, members: int, ops: int) -> dict:
+    # Warm up the buffers on the keys that are timed
+    median_ms(db.get_holding, members, ops)
+    rng = random.Random(1)
+    return {
+        "get_holding_ms": median_ms(db.get_holding, members, ops),
+        "get_shares_ms": median_ms(db.get_shares, members, ops),
+        "observe_price_ms": median_ms(
+            lambda member_id, ticker: db.observe_price(
+                member_id, ticker, to_micros(rng.uniform(5, 15))
+            ),
+            members,
+            ops,
+        ),
+    }
+
+
+def main(argv: list[str] | None = None) -> dict:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--ops", type=int, default=200)
+    parser.add_argument("--output", help="Write the JSON report here")
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in args.rows:
+            path = os.path.join(directory, f"{rows}.db")
+            db = Database(path, fixed_point=True)
+            unkey(db)
+            load(db, rows)
+            db.checkpoint()
+            unkeyed = measure(db, rows // TICKERS, args.ops)
+            db.migrate()
+            query = "SELECT seconds FROM MIGRATIONS WHERE name = 'key_holdings'"
+            migration = db.db.execute(query).fetchone()[0]
+            keyed = measure(db, rows // TICKERS, args.ops)
+            db.close()
+            results.append(
+                {
+                    "rows": rows,
+                    "unkeyed": unkeyed,
+                    "keyed": keyed,
+                    "migration_seconds": migration,
+                }
+            )
+
+    report = {"benchmark": "holdings", "config": vars(args), "results": results}
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Benchmark how quickly the bot is ready to serve commands after a restart.
+
+Builds guild databases with synthetic members and holdings, then starts fresh
+interpreters that import the bot, open the recently used guilds and serve a first
+/holdings command against fake quotes. Reports per-phase and total times to ready
+as JSON, without connecting to Discord or Yahoo.
+
+    python -m benchmarks.bench_startup --guilds 20 --members 200 --output out.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def build(directory: str, guilds: int, members: int, holdings: int, tickers: int):
+    # Imported here so that the timed child imports start cold
+    from benchmarks.bench_database import SyntheticPrices, load
+    from bot.database import Database
+
+    prices = SyntheticPrices(
+        [f"T{i:04d}" for i in range(tickers)], seed=0, fixed_point=True
+    )
+    for guild_id in range(guilds):
+        db = Database(os.path.join(directory, f"{guild_id}.db"), fixed_point=True)
+        load(db, prices, members, holdings, seed=guild_id)
+        db.close()
+
+
+def child(started: float) -> dict:
+    """
+    Start the bot the way a restarted process would, timing each phase.
+    """
+    t0 = time.perf_counter()
+    from bot import app, stocks
+    from benchmarks.load_commands import FakeContext, FakeQuotes
+
+    imported = time.perf_counter()
+    quotes = FakeQuotes([], None, 0, 0, 0, 0, stocks.QuoteException)
+    quotes.provider = stocks.RandomProvider()
+    stocks.fetch_stock_price = quotes.fetch
+    stocks.fetch_stock_prices = quotes.fetch_many
+
+    async def ready() -> tuple[float, float]:
+        t0 = time.perf_counter()
+        await app.pool.open_recent()
+        opened = time.perf_counter()
+        await app.holdings.callback(FakeContext(member_id=0, guild_id=0))
+        return opened - t0, time.perf_counter() - opened
+
+    open_recent, first_command = asyncio.run(ready())
+    ready_seconds = time.time() - started
+    report = {
+        "import_seconds": imported - t0,
+        "open_recent_seconds": open_recent,
+        "first_command_seconds": first_command,
+        "ready_seconds": ready_seconds,
+        "yfinance_imported": "yfinance" in sys.modules,
+    }
+    # The import that is deferred until the first live quote
+    t0 = time.perf_counter()
+    import yfinance  # noqa: F401
+
+    report["deferred_yfinance_import_seconds"] = time.perf_counter() - t0
+    app.pool.close()
+    return report
+
+
+def main(argv: list[str] | None = None) -> dict:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--guilds", type=int, default=10)
+    parser.add_argument("--members", type=int, default=100)
+    parser.add_argument("--holdings", type=int, default=5)
+    parser.add_argument("--tickers", type=int, default=50)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="Write the JSON report here")
+    parser.add_argument("--child", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child is not None:
+        report = child(args.child)
+        sys.stdout.write(json.dumps(report) + "\n")
+        return report
+
+    if args.holdings > args.tickers:
+        parser.error("--holdings cannot exceed --tickers")
+    runs = []
+    with tempfile.TemporaryDirectory() as directory:
+        build(directory, args.guilds, args.members, args.holdings, args.tickers)
+        env = dict(os.environ, TOKEN="startup-test", DATABASE_DIR=directory)
+        for _ in range(args.runs):
+            command = [sys.executable, "-m", "benchmarks.bench_startup"]
+            command += ["--child", str(time.time())]
+            result = subprocess.run(
+                command, env=env, capture_output=True, text=True, check=True
+            )
+            runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+
+    report = {
+        "benchmark": "startup",
+        "config": vars(args),
+        "runs": runs,
+        "median": {
+            key: statistics.median(run[key] for run in runs)
+            for key in runs[0]
+            if key.endswith("_seconds")
+        },
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
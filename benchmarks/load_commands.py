@@ -0,0 +1,301 @@
+"""
+Load test the bot's command handlers without Discord or Yahoo.
+
+Drives the real handlers in bot/app.py, including their handle_exceptions wrappers,
+with stand-in lightbulb contexts and component interactions. Quotes come from a fake
+source with configurable latency and error rate. Many simulated users run
+concurrently, and the report gives per-command latency distributions and event loop
+stall times as JSON.
+
+    python -m benchmarks.load_commands --users 2000 --commands 10 --output out.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import hikari
+
+from benchmarks.bench_database import SyntheticPrices, percentile
+
+COMMANDS = ["buy", "sell", "holdings", "observe", "leaderboard"]
+DEFAULT_MIX = "buy=3,sell=2,holdings=2,observe=3,leaderboard=1"
+
+
+class FakeContext:
+    """
+    Stand-in for lightbulb.Context that records responses.
+    """
+
+    def __init__(self, member_id: int, guild_id: int, **options):
+        self.author = SimpleNamespace(id=member_id)
+        self.guild_id = guild_id
+        self.options = SimpleNamespace(**options)
+        self.responses = []
+
+    async def respond(self, *args, **kwargs):
+        self.responses.append(args[0] if args else None)
+
+
+class FakeComponentInteraction(hikari.ComponentInteraction):
+    """
+    Stand-in for a button press, recording the initial response.
+    """
+
+    def __init__(self, member_id: int, guild_id: int, custom_id: str):
+        self.member = SimpleNamespace(id=member_id)
+        self.guild_id = guild_id
+        self.custom_id = custom_id
+        self.responses = []
+
+    async def create_initial_response(self, response_type, *args, **kwargs):
+        self.responses.append(args[0] if args else None)
+
+
+class FakeQuotes:
+    """
+    Fake upstream quote source with configurable latency and error rate. Prices come
+    from deterministic synthetic paths, or from a quote provider such as a replayed
+    tape.
+    """
+
+    def __init__(
+        self,
+        tickers: list[str],
+        provider,
+        latency: float,
+        jitter: float,
+        error_rate: float,
+        seed: int,
+        exception: type[Exception],
+    ):
+        self.prices = SyntheticPrices(tickers, seed)
+        self.provider = provider
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.exception = exception
+        self.started = time.perf_counter()
+        self.calls = 0
+
+    async def fetch(
+        self, ticker: str, timeout: float | None = None, priority: str = "interactive"
+    ) -> float:
+        price = (await self.fetch_many([ticker]))[ticker]
+        if price is None:
+            raise self.exception(f"Unable to quote: ${ticker}")
+        return price
+
+    async def fetch_many(
+        self,
+        tickers: list[str],
+        timeout: float | None = None,
+        priority: str = "interactive",
+    ) -> dict[str, float | None]:
+        # A batch is one upstream request, as for batched providers
+        self.calls += 1
+        await asyncio.sleep(self.latency + self.rng.uniform(0, self.jitter))
+        if self.rng.random() < self.error_rate:
+            names = ", ".join(f"${ticker}" for ticker in tickers)
+            raise self.exception(f"Unable to quote: {names}")
+        if self.provider is not None:
+            return self.provider.get_prices(tickers)
+        step = int((time.perf_counter() - self.started) * 10)
+        return {ticker: self.prices.price(ticker.upper(), step) for ticker in tickers}
+
+
+async def monitor_stalls(interval: float, stalls: list[float], stop: asyncio.Event):
+    """
+    Measure how late the event loop wakes up a task sleeping for `interval`.
+    """
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        stalls.append(max(loop.time() - t0 - interval, 0))
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        command, weight = part.split("=")
+        if command not in COMMANDS:
+            raise ValueError(f"Unknown command: {command}")
+        weights[command] = float(weight)
+    return weights
+
+
+class Harness:
+    def __init__(self, app, tickers: list[str], mix: dict[str, float], seed: int):
+        self.app = app
+        self.tickers = tickers
+        self.names = list(mix)
+        self.weights = list(mix.values())
+        self.rng = random.Random(seed)
+        self.latencies = {name: [] for name in COMMANDS}
+        self.rejected = {name: 0 for name in COMMANDS}
+        self.errors = {name: 0 for name in COMMANDS}
+        self.portfolios: dict[int, list[str]] = {}
+
+    async def run_command(self, name: str, member_id: int, guild_id: int):
+        # Sell what the user bought, when they bought anything
+        portfolio = self.portfolios.setdefault(member_id, [])
+        if name == "sell" and portfolio:
+            ticker = portfolio.pop(self.rng.randrange(len(portfolio)))
+        else:
+            ticker = self.rng.choice(self.tickers)
+        shares = self.rng.randint(1, 5)
+        if name == "buy":
+            portfolio.extend([ticker] * shares)
+        elif name == "sell":
+            shares = 1
+        if name == "observe":
+            target = FakeComponentInteraction(member_id, guild_id, "observe")
+            call = self.app.on_component_interaction(
+                SimpleNamespace(interaction=target)
+            )
+        else:
+            target = FakeContext(member_id, guild_id, ticker=ticker, shares=shares)
+            call = getattr(self.app, name).callback(target)
+        t0 = time.perf_counter()
+        try:
+            await call
+        except Exception:
+            self.errors[name] += 1
+        self.latencies[name].append(time.perf_counter() - t0)
+        # Handled exceptions are sent back to the user as the response
+        if any(isinstance(response, Exception) for response in target.responses):
+            self.rejected[name] += 1
+
+    async def run_user(self, member_id: int, guild_id: int, commands: int):
+        await self.app.register.callback(FakeContext(member_id, guild_id))
+        for _ in range(commands):
+            name = self.rng.choices(self.names, self.weights)[0]
+            await self.run_command(name, member_id, guild_id)
+
+    def summarize(self) -> dict:
+        results = {}
+        for name, samples in self.latencies.items():
+            if not samples:
+                continue
+            samples = sorted(samples)
+            results[name] = {
+                "count": len(samples),
+                "rejected": self.rejected[name],
+                "errors": self.errors[name],
+                "p50_ms": percentile(samples, 50) * 1000,
+                "p95_ms": percentile(samples, 95) * 1000,
+                "p99_ms": percentile(samples, 99) * 1000,
+                "max_ms": samples[-1] * 1000,
+            }
+        return results
+
+
+async def run(args, app, stocks) -> dict:
+    if args.tape:
+        provider = stocks.TapeProvider(args.tape, speed=args.tape_speed, loop=True)
+        tickers = list(provider.tickers)[: args.tickers]
+    else:
+        provider = None
+        tickers = [f"T{i:04d}" for i in range(args.tickers)]
+    quotes = FakeQuotes(
+        tickers,
+        provider,
+        args.latency / 1000,
+        args.jitter / 1000,
+        args.error_rate,
+        args.seed,
+        stocks.QuoteException,
+    )
+    stocks.fetch_stock_price = quotes.fetch
+    stocks.fetch_stock_prices = quotes.fetch_many
+    stocks.quote_cache = stocks.QuoteCache(ttl=args.cache_ttl)
+    harness = Harness(app, tickers, parse_mix(args.mix), args.seed)
+
+    stalls = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(
+        monitor_stalls(args.stall_interval / 1000, stalls, stop)
+    )
+    t0 = time.perf_counter()
+    await asyncio.gather(
+        *[
+            harness.run_user(member_id, member_id % args.guilds, args.commands)
+            for member_id in range(args.users)
+        ]
+    )
+    elapsed = time.perf_counter() - t0
+    stop.set()
+    await monitor
+    stalls.sort()
+
+    commands = sum(len(samples) for samples in harness.latencies.values())
+    return {
+        "benchmark": "commands",
+        "config": vars(args),
+        "elapsed_seconds": elapsed,
+        "commands_per_sec": commands / elapsed,
+        "upstream_quotes": quotes.calls,
+        "quote_cache": stocks.quote_cache.stats(),
+        "views": app.views.stats(),
+        "databases": app.pool.stats(),
+        "commands": harness.summarize(),
+        "event_loop_stalls": {
+            "samples": len(stalls),
+            "p50_ms": percentile(stalls, 50) * 1000,
+            "p99_ms": percentile(stalls, 99) * 1000,
+            "max_ms": (stalls[-1] if stalls else 0) * 1000,
+        },
+    }
+
+
+def main(argv: list[str] | None = None) -> dict:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--commands", type=int, default=10)
+    parser.add_argument("--guilds", type=int, default=1)
+    parser.add_argument("--tickers", type=int, default=50)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--latency", type=float, default=100, help="Quote ms")
+    parser.add_argument("--jitter", type=float, default=50, help="Quote jitter ms")
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument("--cache-ttl", type=float, default=30)
+    parser.add_argument("--tape", help="Replay quotes from a CSV or Parquet tape")
+    parser.add_argument("--tape-speed", type=float, default=60)
+    parser.add_argument("--stall-interval", type=float, default=10, help="ms")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report here")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ.setdefault("TOKEN", "load-test")
+        os.environ["DATABASE_DIR"] = directory
+        # Keep stdout for the report, away from the banner and anything else the
+        # app prints
+        with contextlib.redirect_stdout(sys.stderr):
+            from bot import app, stocks
+
+            try:
+                report = asyncio.run(run(args, app, stocks))
+            finally:
+                app.pool.close()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
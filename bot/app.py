@@ -1,19 +1,49 @@
+import asyncio
 import lightbulb
 import hikari
 import os
-from database import (
-    Database,
+from datetime import date, timedelta
+from functools import partial
+from typing import Any
+from bot.database import (
+    AsyncDatabase,
+    DatabasePool,
     InvalidSharesException,
     NotEnoughCashException,
     UserDoesNotExistException,
     UserExistsException,
 )
 from textwrap import dedent
-from stocks import QuoteException, get_stock_price
-from errors import handle_exceptions
+from bot.stocks import (
+    QuoteBatchException,
+    QuoteException,
+    get_stock_history_async,
+    get_stock_price_async,
+    get_stock_prices_async,
+)
+from bot.backtest import backtest_history
+from bot.backup import BACKUP_DIR, Checkpointer
+from bot.cluster import RemotePool
+from bot.errors import handle_exceptions
+from bot.history import HistoryRecorder, sparkline
+from bot.ingestor import MarketDataIngestor
+from bot.metrics import metrics
+from bot.money import format_money, to_micros
+from bot.symbols import symbols
+from bot.views import ViewCache
 
 
 COLOR = hikari.Color.of((59, 165, 93))
+PRICE_MAX_AGE = float(os.getenv("PRICE_MAX_AGE", 60))
+HISTORY_POINTS = int(os.getenv("HISTORY_POINTS", 30))
+HISTORY_PERIODS = {
+    "day": timedelta(days=1),
+    "week": timedelta(weeks=1),
+    "month": timedelta(days=30),
+    "year": timedelta(days=365),
+}
+# Directory that /export-ledger writes each guild's ledger under
+LEDGER_DIR = os.getenv("LEDGER_DIR", "ledger")
 
 
 bot = lightbulb.BotApp(
@@ -21,12 +51,84 @@ bot = lightbulb.BotApp(
 )
 
 
-db = Database()
+async def quote_prices(
+    tickers: list[str], priority: str = "interactive"
+) -> dict[str, int]:
+    # Quote upstream in micro-dollars, including the prices of a partial batch
+    try:
+        prices = await get_stock_prices_async(tickers, priority=priority)
+    except QuoteBatchException as e:
+        prices = {ticker: to_micros(price) for ticker, price in e.prices.items()}
+        raise QuoteBatchException(prices, e.errors)
+    return {ticker: to_micros(price) for ticker, price in prices.items()}
+
+
+if os.getenv("CLUSTER_WORKER") is None:
+    pool = DatabasePool(fixed_point=True)
+    # Refreshing prices in the background yields the upstream rate limit to commands
+    ingestor = MarketDataIngestor(pool, partial(quote_prices, priority="bulk"))
+    history_recorder = HistoryRecorder(pool)
+    checkpointer = Checkpointer(pool)
+else:
+    # Database calls go to the cluster's owner process, which runs the ingestor,
+    # records history and checkpoints
+    pool = RemotePool()
+    ingestor = None
+    history_recorder = None
+    checkpointer = None
+views = ViewCache()
+
+
+@bot.listen(hikari.StartedEvent)
+async def on_started(event: hikari.StartedEvent) -> None:
+    await metrics.serve()
+    if ingestor is not None:
+        history_recorder.start()
+        checkpointer.start()
+        await warm_up()
+
+
+async def warm_up():
+    # Open the recently used guilds, then start ingesting prices for what they
+    # hold, which also fills the quote cache
+    try:
+        with metrics.timer("quonkbot_startup_seconds", phase="open_recent"):
+            await pool.open_recent()
+    finally:
+        ingestor.start()
+
+
+@bot.listen(hikari.StoppingEvent)
+async def on_stopping(event: hikari.StoppingEvent) -> None:
+    if ingestor is not None:
+        await ingestor.stop()
+        await history_recorder.stop()
+        await checkpointer.stop()
+    await metrics.close()
+    pool.close()
+
+
+async def get_price(db: AsyncDatabase, ticker: str) -> int:
+    # Use a recently ingested price before quoting upstream
+    price = await db.get_price(ticker, PRICE_MAX_AGE)
+    if price is None:
+        price = to_micros(await get_stock_price_async(ticker))
+    return price
+
+
+async def get_prices(db: AsyncDatabase, tickers: list[str]) -> dict[str, int]:
+    # Use recently ingested prices, and only quote the rest upstream
+    prices = await db.get_prices(tickers, PRICE_MAX_AGE)
+    missing = [ticker for ticker in tickers if ticker not in prices]
+    if missing:
+        prices.update(await quote_prices(missing))
+    return prices
 
 
 @bot.command
 @lightbulb.command("help", "Learn more about QuonkBot!")
 @lightbulb.implements(lightbulb.SlashCommand)
+@handle_exceptions()
 async def help(ctx: lightbulb.Context) -> None:
     embed = hikari.Embed(title="QuonkBot Help", color=COLOR)
     value = """
@@ -36,6 +138,8 @@ async def help(ctx: lightbulb.Context) -> None:
         3. Use the `/buy` command to buy Quonks.
         4. Use the `/holdings` command to check the value of your owned Quonks.
         5. Use the `/sell` command to sell Quonks.
+        6. Use the `/history` command to see how your total value changed.
+        7. Use the `/backtest` command to see what observing more often would earn.
     """
     embed.add_field(name="Getting Started", value=dedent(value))
     value = """
@@ -56,75 +160,101 @@ async def help(ctx: lightbulb.Context) -> None:
 @handle_exceptions(UserExistsException)
 async def register(ctx: lightbulb.Context) -> None:
     member_id = int(ctx.author.id)
-    db.register_user(member_id)
+    async with pool.acquire(ctx.guild_id) as db:
+        await db.register_user(member_id)
     await ctx.respond(f"Successfully registered user: <@{member_id}>")
 
 
+async def autocomplete_ticker(
+    option: hikari.AutocompleteInteractionOption,
+    interaction: hikari.AutocompleteInteraction,
+) -> list[hikari.CommandChoice]:
+    # Suggest symbols from the local symbol index, without quoting upstream
+    return [
+        hikari.CommandChoice(name=f"{symbol} {name}".strip()[:100], value=symbol)
+        for symbol, name in symbols.search(str(option.value))
+    ]
+
+
 @bot.command
-@lightbulb.option("ticker", "Stock ticker", type=str)
+@lightbulb.option("ticker", "Stock ticker", type=str, autocomplete=True)
 @lightbulb.command("quote", "Responds with a ticker quote")
 @lightbulb.implements(lightbulb.SlashCommand)
 @handle_exceptions(QuoteException)
 async def quote(ctx: lightbulb.Context) -> None:
     # Get ticker information
-    price = get_stock_price(ctx.options.ticker)
+    async with pool.acquire(ctx.guild_id) as db:
+        price = await get_price(db, ctx.options.ticker)
     # Create embed
     embed = hikari.Embed(title=ctx.options.ticker, color=COLOR)
-    embed.add_field(name="Price", value=price)
+    embed.add_field(name="Price", value=format_money(price))
     await ctx.respond(embed, flags=hikari.MessageFlag.EPHEMERAL)
 
 
-def create_holdings_embed(member_id: int) -> hikari.Embed:
+async def create_holdings_embed(db: AsyncDatabase, member_id: int) -> hikari.Embed:
     # Create embed
     embed = hikari.Embed(title="Your Holdings", color=COLOR)
     # Track total
     total = 0
+    # Get current prices for every holding at once
+    holdings = await db.get_holdings(member_id)
+    prices = await get_prices(db, [holding.ticker for holding in holdings])
+    # Observe the prices, reading back the observed holdings
+    holdings = await db.get_observed_holdings(member_id, prices)
     # Create embed field values
     tickers = ""
     quonks = ""
     profits = ""
-    # Get ticker information
-    for holding in db.get_holdings(member_id):
-        # Get current price
-        price = get_stock_price(holding.ticker)
-        # Observe the price
-        db.observe_price(member_id, holding.ticker, price)
-        # Get observed
+    # Get ticker information from the observed holdings. Holdings bought since the
+    # prices were fetched have just been observed at their last price.
+    for holding in holdings:
+        price = prices.get(holding.ticker, holding.price)
         # Add the value to our total value
         total += holding.value
         # Calculate profit
         profit = holding.value - (holding.shares * price)
         # Add the stats to the embed field values
-        tickers += f"{holding.ticker} @ ${price:.2f}\n"
+        tickers += f"{holding.ticker} @ {format_money(price)}\n"
         quonks += f"{holding.shares}\n"
-        profits += f"${profit:.2f}\n"
+        profits += f"{format_money(profit)}\n"
     # Add embed fields
     if tickers != "":
         embed.add_field(name="Ticker", value=tickers, inline=True)
         embed.add_field(name="Quonks", value=quonks, inline=True)
         embed.add_field(name="Profit", value=profits, inline=True)
     # Add cash
-    cash_value = db.get_cash(member_id)
+    cash_value = await db.get_cash(member_id)
     total += cash_value
-    embed.add_field(name="Cash", value=f"${cash_value:.2f}")
+    embed.add_field(name="Cash", value=format_money(cash_value))
     # Add total
-    embed.add_field(name="Total Value", value=f"${total:.2f}")
+    embed.add_field(name="Total Value", value=format_money(total))
     # Add observe button
     row = bot.rest.build_message_action_row()
     row.add_interactive_button(hikari.ButtonStyle.PRIMARY, "observe", label="Observe")
     return embed, row
 
 
+async def get_holdings_view(
+    guild_id: int | None, member_id: int
+) -> tuple[hikari.Embed, Any]:
+    # Reuse a recent view, or share a build that is already running
+    async def build():
+        async with pool.acquire(guild_id) as db:
+            await db.validate_user(member_id)
+            return await create_holdings_embed(db, member_id)
+
+    return await views.fetch((guild_id, member_id), build)
+
+
 @bot.command
 @lightbulb.command("holdings", "Shows your current Quonk holdings and values")
 @lightbulb.implements(lightbulb.SlashCommand)
 @handle_exceptions(QuoteException, UserDoesNotExistException)
 async def holdings(ctx: lightbulb.Context) -> None:
-    # Format and validate user
+    # Format user
     member_id = int(ctx.author.id)
-    db.validate_user(member_id)
     # Create embed
-    embed, row = create_holdings_embed(member_id)
+    embed, row = await get_holdings_view(ctx.guild_id, member_id)
     # Response
     await ctx.respond(embed, flags=hikari.MessageFlag.EPHEMERAL, component=row)
 
@@ -135,72 +265,161 @@ async def on_component_interaction(event: hikari.InteractionCreateEvent) -> None
         return
 
     if event.interaction.custom_id == "observe":
-        # Format and validate user
-        member_id = int(event.interaction.member.id)
-        db.validate_user(member_id)
-        # Create embed
-        embed, row = create_holdings_embed(member_id)
-        # Response
-        await event.interaction.create_initial_response(
-            hikari.ResponseType.MESSAGE_CREATE,
-            embed,
-            component=row,
-            flags=hikari.MessageFlag.EPHEMERAL,
-        )
+        with metrics.timer("quonkbot_command_seconds", command="observe"):
+            # Format user
+            member_id = int(event.interaction.member.id)
+            # Create embed
+            embed, row = await get_holdings_view(event.interaction.guild_id, member_id)
+            # Response
+            await event.interaction.create_initial_response(
+                hikari.ResponseType.MESSAGE_CREATE,
+                embed,
+                component=row,
+                flags=hikari.MessageFlag.EPHEMERAL,
+            )
 
 
 @bot.command
 @lightbulb.option("shares", "Number of Quonks to buy", type=int, min_value=1)
-@lightbulb.option("ticker", "The stock you want to buy", type=str)
+@lightbulb.option("ticker", "The stock you want to buy", type=str, autocomplete=True)
 @lightbulb.command("buy", "Buy Quonks")
 @lightbulb.implements(lightbulb.SlashCommand)
 @handle_exceptions(QuoteException, UserDoesNotExistException, NotEnoughCashException)
 async def buy(ctx: lightbulb.Context):
-    # Format and validate inputs
-    member_id = int(ctx.author.id)
-    db.validate_user(member_id)
-    ticker = str(ctx.options.ticker).upper()
-    shares = int(ctx.options.shares)
-    # Get price
-    yf_price = get_stock_price(ctx.options.ticker)
-    # Buy Quonks
-    db.buy_quonks(member_id, ticker, shares, yf_price)
+    async with pool.acquire(ctx.guild_id) as db:
+        # Format and validate inputs
+        member_id = int(ctx.author.id)
+        await db.validate_user(member_id)
+        ticker = str(ctx.options.ticker).upper()
+        shares = int(ctx.options.shares)
+        # Get price
+        yf_price = await get_price(db, ctx.options.ticker)
+        # Buy Quonks
+        await db.buy_quonks(member_id, ticker, shares, yf_price)
+    views.invalidate((ctx.guild_id, member_id))
     await ctx.respond(
-        f"<@{member_id}> bought {shares} quonks of ${ticker} @ ${yf_price:.2f}."
+        f"<@{member_id}> bought {shares} quonks of ${ticker} @ {format_money(yf_price)}."
     )
 
 
 @bot.command
 @lightbulb.option("shares", "Number of Quonks to sell", type=int, min_value=1)
-@lightbulb.option("ticker", "The stock to sell", type=str)
+@lightbulb.option("ticker", "The stock to sell", type=str, autocomplete=True)
 @lightbulb.command("sell", "Sell Quonks")
 @lightbulb.implements(lightbulb.SlashCommand)
 @handle_exceptions(QuoteException, UserDoesNotExistException, InvalidSharesException)
 async def sell(ctx: lightbulb.Context):
-    # Member id
-    member_id = int(ctx.author.id)
-    db.validate_user(member_id)
-    ticker = str(ctx.options.ticker).upper()
-    shares = int(ctx.options.shares)
-    # Get current price
-    yf_price = get_stock_price(ticker)
-    # Sell Quonks
-    quonk_price = db.sell_quonks(member_id, ticker, shares, yf_price)
+    async with pool.acquire(ctx.guild_id) as db:
+        # Member id
+        member_id = int(ctx.author.id)
+        await db.validate_user(member_id)
+        ticker = str(ctx.options.ticker).upper()
+        shares = int(ctx.options.shares)
+        # Get current price
+        yf_price = await get_price(db, ticker)
+        # Sell Quonks
+        quonk_price = await db.sell_quonks(member_id, ticker, shares, yf_price)
+    views.invalidate((ctx.guild_id, member_id))
     await ctx.respond(
-        f"<@{member_id}> sold {shares} quonks of ${ticker} @ ${quonk_price:2f} per quonk."
+        f"<@{member_id}> sold {shares} quonks of ${ticker} @ {format_money(quonk_price)} per quonk."
+    )
+
+
+@bot.command
+@lightbulb.option(
+    "shares", "Number of Quonks", type=int, min_value=1, required=False, default=1
+)
+@lightbulb.option(
+    "period",
+    "How far back to look",
+    choices=list(HISTORY_PERIODS),
+    required=False,
+    default="week",
+)
+@lightbulb.option("ticker", "Stock ticker", type=str, autocomplete=True)
+@lightbulb.command(
+    "backtest", "Shows what Quonks would have earned at each observation cadence"
+)
+@lightbulb.implements(lightbulb.SlashCommand)
+@handle_exceptions(QuoteException)
+async def backtest(ctx: lightbulb.Context):
+    ticker = ctx.options.ticker
+    period = ctx.options.period
+    shares = ctx.options.shares
+    timestamps, prices = await get_stock_history_async(
+        ticker, HISTORY_PERIODS[period].total_seconds()
+    )
+    # Backtest off the event loop
+    loop = asyncio.get_running_loop()
+    earned = await loop.run_in_executor(
+        None, backtest_history, timestamps, prices, shares
     )
+    # Create embed
+    embed = hikari.Embed(
+        title=f"{shares} ${ticker} Quonks over the last {period}", color=COLOR
+    )
+    if not earned:
+        embed.description = "Not enough price history to backtest."
+    for cadence, value in earned.items():
+        embed.add_field(
+            name=f"Observed every {cadence}", value=format_money(value), inline=True
+        )
+    await ctx.respond(embed, flags=hikari.MessageFlag.EPHEMERAL)
+
+
+for command in (quote, buy, sell, backtest):
+    command.autocomplete("ticker")(autocomplete_ticker)
+
+
+@bot.command
+@lightbulb.option(
+    "period",
+    "How far back to look",
+    choices=list(HISTORY_PERIODS),
+    required=False,
+    default="week",
+)
+@lightbulb.command("history", "Shows how your total value changed over time")
+@lightbulb.implements(lightbulb.SlashCommand)
+@handle_exceptions(UserDoesNotExistException)
+async def history(ctx: lightbulb.Context):
+    # Format and validate user
+    member_id = int(ctx.author.id)
+    period = ctx.options.period
+    async with pool.acquire(ctx.guild_id) as db:
+        await db.validate_user(member_id)
+        # Get the downsampled series
+        points = await db.get_history(
+            member_id, HISTORY_PERIODS[period], HISTORY_POINTS
+        )
+    # Create embed
+    embed = hikari.Embed(title=f"Your History ({period})", color=COLOR)
+    if not points:
+        embed.description = "No history yet, check back in a few minutes."
+    else:
+        embed.description = f"`{sparkline([point.value for point in points])}`"
+        embed.add_field(name="Start", value=format_money(points[0].value), inline=True)
+        embed.add_field(name="Now", value=format_money(points[-1].value), inline=True)
+        low = min(point.low for point in points)
+        high = max(point.high for point in points)
+        embed.add_field(name="Low", value=format_money(low), inline=True)
+        embed.add_field(name="High", value=format_money(high), inline=True)
+    await ctx.respond(embed, flags=hikari.MessageFlag.EPHEMERAL)
 
 
 @bot.command
 @lightbulb.command("leaderboard", "Top quonk traders")
 @lightbulb.implements(lightbulb.SlashCommand)
+@handle_exceptions()
 async def leaderboard(ctx: lightbulb.Context):
     # Create embed
     embed = hikari.Embed(title="Top Quonkers", color=COLOR)
     # Get leaderboard values
     leaders = ""
-    for i, leader in enumerate(db.leaderboard()):
-        leaders += f"#{i+1}. <@{leader.member_id}> ${leader.value:,.2f}\n"
+    async with pool.acquire(ctx.guild_id) as db:
+        top = await db.leaderboard()
+    for i, leader in enumerate(top):
+        leaders += f"#{i+1}. <@{leader.member_id}> {format_money(leader.value)}\n"
     # Add embed fields
     if leaders == "":
         leaders = "No Quonkers here :("
@@ -208,5 +427,61 @@ async def leaderboard(ctx: lightbulb.Context):
     await ctx.respond(embed)
 
 
+@bot.command
+@lightbulb.add_checks(lightbulb.owner_only)
+@lightbulb.command("rebuild-leaderboard", "Recompute leaderboard totals")
+@lightbulb.implements(lightbulb.SlashCommand)
+@handle_exceptions()
+async def rebuild_leaderboard(ctx: lightbulb.Context):
+    async with pool.acquire(ctx.guild_id) as db:
+        drifted = await db.rebuild_totals()
+    await ctx.respond(
+        f"Rebuilt leaderboard totals, {drifted} needed correcting.",
+        flags=hikari.MessageFlag.EPHEMERAL,
+    )
+
+
+@bot.command
+@lightbulb.add_checks(lightbulb.owner_only)
+@lightbulb.option(
+    "days",
+    "Only export this many recent days",
+    type=int,
+    required=False,
+    default=None,
+)
+@lightbulb.command("export-ledger", "Export the trade ledger to Parquet")
+@lightbulb.implements(lightbulb.SlashCommand)
+@handle_exceptions()
+async def export_ledger(ctx: lightbulb.Context):
+    since = None
+    if ctx.options.days is not None:
+        since = date.today() - timedelta(days=max(ctx.options.days, 1) - 1)
+    directory = os.path.join(LEDGER_DIR, str(int(ctx.guild_id or 0)))
+    async with pool.acquire(ctx.guild_id) as db:
+        exported = await db.export_ledger(directory, since)
+    await ctx.respond(
+        f"Exported {exported['TRADES']} trades and "
+        f"{exported['OBSERVATIONS']} observations to {directory}.",
+        flags=hikari.MessageFlag.EPHEMERAL,
+    )
+
+
+@bot.command
+@lightbulb.add_checks(lightbulb.owner_only)
+@lightbulb.command("backup", "Back up members, cash and holdings")
+@lightbulb.implements(lightbulb.SlashCommand)
+@handle_exceptions()
+async def backup(ctx: lightbulb.Context):
+    directory = os.path.join(BACKUP_DIR, str(int(ctx.guild_id or 0)))
+    async with pool.acquire(ctx.guild_id) as db:
+        saved = await db.backup(directory)
+    await ctx.respond(
+        f"Backed up {saved['MEMBERS']} members and {saved['HOLDINGS']} holdings "
+        f"to {directory}.",
+        flags=hikari.MessageFlag.EPHEMERAL,
+    )
+
+
 if __name__ == "__main__":
     bot.run()
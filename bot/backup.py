@@ -0,0 +1,86 @@
+"""
+Back up guild databases to Parquet bundles and restore them, and checkpoint the
+open databases on a schedule.
+
+Back up a database the bot does not have open, or restore a bundle into a new
+database file:
+
+    python -m bot.backup save db/1234.db backups/1234
+    python -m bot.backup restore backups/1234 db/1234.db
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from bot.database import Database
+from bot.metrics import metrics
+from bot.tasks import PeriodicTask
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+CHECKPOINT_INTERVAL = float(os.getenv("CHECKPOINT_INTERVAL", 3600))
+# Also back up every open database to BACKUP_DIR after each checkpoint
+CHECKPOINT_BACKUP = os.getenv("CHECKPOINT_BACKUP")
+
+
+class Checkpointer(PeriodicTask):
+    """
+    Background task that checkpoints every open database once per `interval`
+    seconds, and backs them up to `backup_dir` when one is given.
+    """
+
+    wait_first = True
+    failure_message = "Checkpointing failed"
+
+    def __init__(
+        self,
+        pool,
+        interval: float = CHECKPOINT_INTERVAL,
+        backup_dir: str | None = BACKUP_DIR if CHECKPOINT_BACKUP else None,
+    ):
+        super().__init__(interval)
+        self.pool = pool
+        self.backup_dir = backup_dir
+
+    async def run_cycle(self):
+        with metrics.timer("quonkbot_checkpoint_seconds", task="checkpoint"):
+            await self.pool.checkpoint()
+        if self.backup_dir is not None:
+            with metrics.timer("quonkbot_checkpoint_seconds", task="backup"):
+                await self.pool.backup(self.backup_dir)
+
+
+def main(argv: list[str] | None = None) -> dict:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--float",
+        action="store_true",
+        help="Open the database with DECIMAL rather than micro-dollar money columns",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    save = commands.add_parser("save", help="Back up a database to a bundle")
+    save.add_argument("database")
+    save.add_argument("bundle")
+    restore = commands.add_parser("restore", help="Restore a bundle to a database")
+    restore.add_argument("bundle")
+    restore.add_argument("database")
+    args = parser.parse_args(argv)
+
+    t0 = time.perf_counter()
+    db = Database(args.database, fixed_point=not args.float)
+    try:
+        if args.command == "save":
+            rows = db.backup(args.bundle)
+        else:
+            rows = db.restore(args.bundle)
+            db.checkpoint()
+    finally:
+        db.close()
+    report = {"rows": rows, "seconds": time.perf_counter() - t0}
+    sys.stdout.write(json.dumps(report) + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
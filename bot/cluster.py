@@ -0,0 +1,411 @@
+"""
+Run the bot as several gateway worker processes around one database owner process.
+
+DuckDB allows one writing process per file, so the owner process holds the
+DatabasePool and runs the market data ingestor, and the workers forward database
+calls to it over a local socket. Workers also wait for their upstream quote tokens
+in the owner's quote scheduler, so the cluster shares one rate limit. Each worker
+runs a share of the gateway shards.
+
+    CLUSTER_WORKERS=4 CLUSTER_SHARDS=8 python -m bot.cluster
+"""
+
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import pickle
+import shutil
+import stat
+import struct
+import tempfile
+from contextlib import asynccontextmanager
+from typing import Any
+import bot.metrics
+import bot.stocks
+from bot.database import (
+    DatabasePool,
+    InvalidSharesException,
+    NotEnoughCashException,
+    UserDoesNotExistException,
+    UserExistsException,
+)
+from bot.metrics import metrics
+from bot.stocks import QuoteOverloadedException
+
+# Socket the workers reach the owner on. By default the owner creates it in a
+# private temporary directory, and passes its path to the workers through the
+# environment.
+CLUSTER_SOCKET = os.getenv("CLUSTER_SOCKET")
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", os.cpu_count() or 1))
+# Total number of gateway shards, by default one per worker
+CLUSTER_SHARDS = int(os.getenv("CLUSTER_SHARDS", 0))
+
+# Database methods workers may call
+REMOTE_METHODS = {
+    "register_user",
+    "user_exists",
+    "validate_user",
+    "get_cash",
+    "add_cash",
+    "get_shares",
+    "get_holdings",
+    "get_holding",
+    "observe_price",
+    "observe_prices",
+    "get_observed_holdings",
+    "observe_all",
+    "get_tickers",
+    "record_prices",
+    "get_prices",
+    "get_price",
+    "buy_quonks",
+    "sell_quonks",
+    "delete_holdings",
+    "leaderboard",
+    "rebuild_totals",
+    "record_history",
+    "get_history",
+    "export_ledger",
+    "backup",
+}
+
+# Exceptions raised in the owner process are raised again in the worker by name
+EXCEPTIONS = {
+    exception.__name__: exception
+    for exception in [
+        UserExistsException,
+        UserDoesNotExistException,
+        NotEnoughCashException,
+        InvalidSharesException,
+        QuoteOverloadedException,
+    ]
+}
+
+HEADER = struct.Struct(">I")
+
+logger = logging.getLogger(__name__)
+
+
+class RemoteException(Exception):
+    pass
+
+
+class Channel:
+    """
+    Length prefixed, pickled messages over a local stream. Pickle is only safe
+    because both ends are processes of this cluster. Messages sent in the same
+    event loop iteration are written together.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.outbox: list[bytes] = []
+        self.messages = 0
+        self.writes = 0
+
+    def send(self, message: Any):
+        data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+        if not self.outbox:
+            asyncio.get_running_loop().call_soon(self.flush)
+        self.outbox.append(HEADER.pack(len(data)) + data)
+        self.messages += 1
+
+    def flush(self):
+        if not self.writer.is_closing():
+            self.writer.write(b"".join(self.outbox))
+            self.writes += 1
+        self.outbox.clear()
+
+    async def receive(self) -> Any | None:
+        """
+        Read the next message, or None once the other end has closed.
+        """
+        try:
+            header = await self.reader.readexactly(HEADER.size)
+            data = await self.reader.readexactly(HEADER.unpack(header)[0])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        return pickle.loads(data)
+
+    def close(self):
+        self.writer.close()
+
+
+class DatabaseServer:
+    """
+    Serves database calls from worker processes, each call running on the guild's
+    database in the pool. Calls are run concurrently, so calls that arrive together
+    are committed together by the database's group commit. Workers' quote tokens
+    are granted by this process's quote scheduler.
+    """
+
+    def __init__(self, pool: DatabasePool, path: str | None = CLUSTER_SOCKET):
+        self.pool = pool
+        self.path = path
+        self.server: asyncio.AbstractServer | None = None
+        self.requests = 0
+
+    async def start(self):
+        # Remove the socket left behind by an earlier owner process, but nothing
+        # else that happens to be at the path
+        if os.path.exists(self.path):
+            if not stat.S_ISSOCK(os.lstat(self.path).st_mode):
+                raise FileExistsError(f"Not a socket: {self.path}")
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(self.handle, path=self.path)
+        # Messages are unpickled, so only this user may connect
+        os.chmod(self.path, 0o600)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        channel = Channel(reader, writer)
+        tasks = set()
+        try:
+            while (request := await channel.receive()) is not None:
+                task = asyncio.create_task(self.dispatch(channel, *request))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            channel.close()
+
+    async def dispatch(
+        self,
+        channel: Channel,
+        request_id: int,
+        guild_id: int,
+        method: str,
+        args: tuple,
+        kwargs: dict,
+    ):
+        self.requests += 1
+        try:
+            if method == "acquire_quote":
+                result = await bot.stocks.quote_scheduler.acquire(*args, **kwargs)
+            elif method not in REMOTE_METHODS:
+                raise RemoteException(f"Not a remote method: {method}")
+            else:
+                async with self.pool.acquire(guild_id) as db:
+                    result = await getattr(db, method)(*args, **kwargs)
+            response = (request_id, True, result)
+        except Exception as e:
+            response = (request_id, False, (type(e).__name__, str(e)))
+        channel.send(response)
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+class RemoteDatabase:
+    """
+    A guild's database in the owner process. Database methods are available as
+    coroutines of the same name.
+    """
+
+    def __init__(self, pool: "RemotePool", guild_id: int):
+        self.pool = pool
+        self.guild_id = guild_id
+
+    def __getattr__(self, name: str):
+        async def call(*args, **kwargs):
+            return await self.pool.call(self.guild_id, name, args, kwargs)
+
+        return call
+
+
+class RemotePool:
+    """
+    Stands in for a DatabasePool in a worker process, forwarding database calls to
+    the owner process over one connection.
+    """
+
+    def __init__(self, path: str | None = CLUSTER_SOCKET):
+        self.path = path
+        self.connection: asyncio.Task | None = None
+        self.reader: asyncio.Task | None = None
+        self.pending: dict[int, asyncio.Future] = {}
+        self.ids = itertools.count()
+
+    @asynccontextmanager
+    async def acquire(self, guild_id: int | None):
+        yield RemoteDatabase(self, int(guild_id or 0))
+
+    async def connect(self) -> Channel:
+        # Share one connection attempt between concurrent calls
+        if self.connection is None:
+            self.connection = asyncio.ensure_future(self.open())
+        try:
+            return await asyncio.shield(self.connection)
+        except Exception:
+            self.connection = None
+            raise
+
+    async def open(self) -> Channel:
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        channel = Channel(reader, writer)
+        self.reader = asyncio.create_task(self.read(channel))
+        return channel
+
+    async def read(self, channel: Channel):
+        while (response := await channel.receive()) is not None:
+            request_id, ok, result = response
+            future = self.pending.pop(request_id, None)
+            if future is not None and not future.done():
+                future.set_result((ok, result))
+        # Fail the calls still waiting, and reconnect on the next call
+        self.connection = None
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Lost the database process."))
+        self.pending.clear()
+
+    async def call(self, guild_id: int, method: str, args: tuple, kwargs: dict):
+        with metrics.timer("quonkbot_cluster_seconds", method=method):
+            channel = await self.connect()
+            request_id = next(self.ids)
+            future = asyncio.get_running_loop().create_future()
+            self.pending[request_id] = future
+            try:
+                channel.send((request_id, guild_id, method, args, kwargs))
+                ok, result = await future
+            finally:
+                self.pending.pop(request_id, None)
+            if ok:
+                return result
+            name, message = result
+            if name in EXCEPTIONS:
+                raise EXCEPTIONS[name](message)
+            raise RemoteException(f"{name}: {message}")
+
+    def stats(self) -> dict[str, int]:
+        return {"pending": len(self.pending)}
+
+    def close(self):
+        if self.connection is not None and self.connection.done():
+            if self.connection.exception() is None:
+                self.connection.result().close()
+        self.connection = None
+
+
+class RemoteScheduler:
+    """
+    Stands in for the quote scheduler in a worker process, waiting for each token
+    in the owner's scheduler. The cluster then stays within one QUOTE_RATE, and
+    commands quoted by workers are served before the owner's bulk refreshes.
+    """
+
+    def __init__(self, pool: RemotePool):
+        self.pool = pool
+
+    async def acquire(
+        self, priority: str = "interactive", ticker: str | list[str] = ""
+    ):
+        # A worker that stops waiting, such as on a timeout, leaves the token to be
+        # granted and go unused, which errs below the limit
+        await self.pool.call(0, "acquire_quote", (priority, ticker), {})
+
+    def promote(self, ticker: str, priority: str = "interactive"):
+        # Workers do not refresh prices in bulk, so their requests already wait at
+        # the priority of a command
+        pass
+
+
+def shards(index: int, workers: int, shard_count: int) -> list[int]:
+    return list(range(index, shard_count, workers))
+
+
+def run_worker(index: int, shard_ids: list[int], shard_count: int):
+    # The app forwards database calls to the owner when it sees CLUSTER_WORKER
+    os.environ["CLUSTER_WORKER"] = str(index)
+    # Each worker serves its metrics on the next port up from the owner's
+    if bot.metrics.METRICS_PORT is not None:
+        bot.metrics.METRICS_PORT = str(int(bot.metrics.METRICS_PORT) + 1 + index)
+    from bot import app
+
+    bot.stocks.quote_scheduler = RemoteScheduler(app.pool)
+    app.bot.run(shard_ids=shard_ids, shard_count=shard_count)
+
+
+async def join(processes: list[multiprocessing.Process]):
+    """
+    Wait for the processes to exit. Each process's sentinel becomes readable once
+    it exits, so no thread is held waiting on it. The default executor is left
+    free to open and close databases.
+    """
+    loop = asyncio.get_running_loop()
+    for process in processes:
+        exited = loop.create_future()
+
+        def on_exit(exited: asyncio.Future = exited):
+            if not exited.done():
+                exited.set_result(None)
+
+        loop.add_reader(process.sentinel, on_exit)
+        try:
+            await exited
+        finally:
+            loop.remove_reader(process.sentinel)
+        process.join()
+
+
+async def serve(app, processes: list[multiprocessing.Process], path: str):
+    server = DatabaseServer(app.pool, path)
+    await server.start()
+    await metrics.serve()
+    for process in processes:
+        process.start()
+    logger.info("Serving %d workers on %s", len(processes), server.path)
+    try:
+        # Warm up while the workers connect to the gateway
+        app.history_recorder.start()
+        app.checkpointer.start()
+        await app.warm_up()
+        await join(processes)
+    finally:
+        await app.ingestor.stop()
+        await app.history_recorder.stop()
+        await app.checkpointer.stop()
+        await metrics.close()
+        await server.close()
+
+
+def main():
+    from bot import app
+
+    # Workers inherit the socket path, which is in a directory only this user can
+    # enter unless CLUSTER_SOCKET says otherwise
+    directory = None
+    path = CLUSTER_SOCKET
+    if path is None:
+        directory = tempfile.mkdtemp(prefix="quonkbot-")
+        path = os.path.join(directory, "cluster.sock")
+        os.environ["CLUSTER_SOCKET"] = path
+    shard_count = CLUSTER_SHARDS or CLUSTER_WORKERS
+    workers = min(CLUSTER_WORKERS, shard_count)
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(
+            target=run_worker,
+            args=(index, shards(index, workers, shard_count), shard_count),
+            name=f"worker-{index}",
+        )
+        for index in range(workers)
+    ]
+    try:
+        asyncio.run(serve(app, processes, path))
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        app.pool.close()
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
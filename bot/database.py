@@ -1,6 +1,28 @@
+import asyncio
 import duckdb
+import json
+import logging
 import os
-from typing import Iterator
+import queue
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Iterator
+from bot.metrics import metrics
+from bot.money import MICROS, Money, to_micros
+
+DATABASE_MAX_OPEN = int(os.getenv("DATABASE_MAX_OPEN", 32))
+DATABASE_MAX_BATCH = int(os.getenv("DATABASE_MAX_BATCH", 64))
+# Days of history to keep per resolution, where 0 keeps it forever
+HISTORY_RETENTION = os.getenv("HISTORY_RETENTION", "snapshot=2,minute=7,hour=90,day=0")
+# Guild to import the single DATABASE_PATH file of earlier versions into
+LEGACY_GUILD_ID = os.getenv("LEGACY_GUILD_ID")
+
+logger = logging.getLogger(__name__)
 
 
 class UserExistsException(Exception):
@@ -19,7 +41,39 @@ class InvalidSharesException(Exception):
     pass
 
 
+class DatabaseNotEmptyException(Exception):
+    pass
+
+
+# Exceptions that Database methods raise to reject an operation before writing
+# anything, so that the operation fails without rolling back the rest of its group,
+# see AsyncDatabase
+REJECTIONS = (
+    UserExistsException,
+    UserDoesNotExistException,
+    NotEnoughCashException,
+    InvalidSharesException,
+)
+
+
+@dataclass(frozen=True, slots=True)
 class Holding:
+    """
+    Immutable snapshot of a holding, read in the same query as the rest of its row.
+    """
+
+    member_id: int
+    ticker: str
+    shares: int
+    price: Money
+    value: Money
+
+
+class LiveHolding:
+    """
+    Holding whose properties are re-read from HOLDINGS on every access.
+    """
+
     def __init__(self, db: "Database", member_id: int, ticker: str):
         self.db = db
         self.member_id = member_id
@@ -43,7 +97,7 @@ class Holding:
             WHERE id = ? AND ticker = ?
         """
         result = self.db.db.execute(query, [self.member_id, self.ticker]).fetchone()
-        return self.db.trunc(result[0])
+        return self.db.read_money(result[0])
 
     @property
     def value(self):
@@ -53,49 +107,375 @@ class Holding:
             WHERE id = ? AND ticker = ?
         """
         result = self.db.db.execute(query, [self.member_id, self.ticker]).fetchone()
-        return self.db.trunc(result[0])
+        return self.db.read_money(result[0])
+
+
+@dataclass(frozen=True, slots=True)
+class HistoryPoint:
+    """
+    A member's total value at the end of a period, and its range over the period.
+    """
+
+    at: datetime
+    low: Money
+    high: Money
+    value: Money
 
 
 class Leader:
-    def __init__(self, member_id: int, value: float):
+    def __init__(self, member_id: int, value: Money):
         self.member_id = member_id
         self.value = value
 
 
 class Database:
+    """
+    Money is stored as DECIMAL and read as float dollars, or, in fixed point mode,
+    stored as BIGINT micro-dollars and read and written as integers. In fixed point
+    mode every amount and price passed in must already be in micro-dollars, see
+    bot.money, and money columns of an existing database are converted on open.
+    """
+
     PRECISION = 18
     SCALE = 6
+    STARTING_CASH = 10000
+    MONEY_COLUMNS = [
+        ("CASH", "cash"),
+        ("HOLDINGS", "price"),
+        ("HOLDINGS", "value"),
+        ("TOTALS", "total"),
+        ("PRICES", "price"),
+        ("SNAPSHOTS", "total"),
+        ("ROLLUPS", "low"),
+        ("ROLLUPS", "high"),
+        ("ROLLUPS", "last"),
+        ("TRADES", "price"),
+        ("TRADES", "amount"),
+        ("OBSERVATIONS", "price"),
+        ("OBSERVATIONS", "delta"),
+    ]
+    LEDGER_TABLES = ["TRADES", "OBSERVATIONS"]
+    BACKUP_TABLES = ["MEMBERS", "CASH", "HOLDINGS"]
+    # Schema migrations in the order they were added, applied by migrate to
+    # databases whose schema version is older
+    MIGRATIONS = ["key_holdings"]
+    # History rollup resolutions in seconds
+    RESOLUTIONS = {"minute": 60, "hour": 3600, "day": 86400}
 
-    def __init__(self, path: str | None = None):
+    def __init__(
+        self,
+        path: str | None = None,
+        fixed_point: bool = False,
+        retention: dict[str, float] | None = None,
+    ):
         self.db = duckdb.connect(path or os.getenv("DATABASE_PATH"))
+        self.in_transaction = False
+        self.fixed_point = fixed_point
+        self.retention = retention or parse_retention(HISTORY_RETENTION)
+        if fixed_point:
+            self.money_type = "BIGINT"
+        else:
+            self.money_type = f"DECIMAL({self.PRECISION}, {self.SCALE})"
         self.db.execute("CREATE TABLE IF NOT EXISTS MEMBERS (id BIGINT PRIMARY KEY);")
         self.db.execute(
             f"""
             CREATE TABLE IF NOT EXISTS CASH (
                 id BIGINT PRIMARY KEY, 
-                cash DECIMAL({self.PRECISION}, {self.SCALE})
+                cash {self.money_type}
+            );
+        """
+        )
+        created = self.create_holdings("HOLDINGS")
+        # Cash plus Quonk value per member, maintained by every write so that the
+        # leaderboard does not have to aggregate HOLDINGS.
+        self.db.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS TOTALS (
+                id BIGINT PRIMARY KEY,
+                total {self.money_type}
+            );
+        """
+        )
+        self.db.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS PRICES (
+                ticker VARCHAR PRIMARY KEY,
+                price {self.money_type},
+                fetched_at TIMESTAMP
+            );
+        """
+        )
+        # Append-only snapshots of every member's total, and their rollups
+        self.db.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS SNAPSHOTS (
+                id BIGINT,
+                at TIMESTAMP,
+                total {self.money_type}
+            );
+        """
+        )
+        self.db.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS ROLLUPS (
+                resolution INTEGER,
+                id BIGINT,
+                bucket TIMESTAMP,
+                low {self.money_type},
+                high {self.money_type},
+                last {self.money_type},
+                PRIMARY KEY (resolution, id, bucket)
+            );
+        """
+        )
+        # Append-only ledger of every change to CASH and HOLDINGS, in the order of
+        # LEDGER_SEQ, from which both can be replayed. Trades are registrations,
+        # deposits, buys, sells, closed holdings and opening balances.
+        self.db.execute("CREATE SEQUENCE IF NOT EXISTS LEDGER_SEQ;")
+        self.db.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS TRADES (
+                seq BIGINT DEFAULT nextval('LEDGER_SEQ'),
+                at TIMESTAMP,
+                id BIGINT,
+                side VARCHAR,
+                ticker VARCHAR,
+                shares INTEGER,
+                price {self.money_type},
+                amount {self.money_type}
             );
         """
         )
         self.db.execute(
             f"""
-            CREATE TABLE IF NOT EXISTS HOLDINGS (
-                id BIGINT, 
-                ticker VARCHAR, 
-                shares INTEGER, 
-                price DECIMAL({self.PRECISION}, {self.SCALE}),
-                value DECIMAL({self.PRECISION}, {self.SCALE})
+            CREATE TABLE IF NOT EXISTS OBSERVATIONS (
+                seq BIGINT DEFAULT nextval('LEDGER_SEQ'),
+                at TIMESTAMP,
+                id BIGINT,
+                ticker VARCHAR,
+                price {self.money_type},
+                delta {self.money_type}
+            );
+        """
+        )
+        self.convert_money()
+        self.migrate(created)
+        self.open_ledger()
+        self.rebuild_totals()
+
+    def create_holdings(self, name: str) -> bool:
+        """
+        Create a keyed holdings table, unless one exists. Returns whether it was
+        created.
+        """
+        query = "SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = ?"
+        exists = self.db.execute(query, [name]).fetchone()[0] > 0
+        self.db.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {name} (
+                id BIGINT,
+                ticker VARCHAR,
+                shares INTEGER,
+                price {self.money_type},
+                value {self.money_type},
+                PRIMARY KEY (id, ticker)
+            );
+        """
+        )
+        return not exists
+
+    def migrate(self, created: bool = False):
+        """
+        Apply the migrations newer than the database's schema version in order, each
+        in its own transaction, recording when each was applied and how long it
+        took. Databases whose HOLDINGS was just created are at the latest schema, so
+        their migrations are recorded as applied without running them.
+        """
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS MIGRATIONS (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR,
+                applied_at TIMESTAMP,
+                seconds DOUBLE
             );
         """
         )
+        query = "SELECT COALESCE(MAX(version), 0) FROM MIGRATIONS"
+        version = self.db.execute(query).fetchone()[0]
+        pending = self.MIGRATIONS[version:]
+        if created:
+            query = "INSERT INTO MIGRATIONS VALUES (?, ?, ?, 0)"
+            for version, name in enumerate(pending, start=version + 1):
+                self.db.execute(query, [version, name, datetime.now()])
+            return
+        for version, name in enumerate(pending, start=version + 1):
+            started = time.perf_counter()
+            with self.transaction():
+                getattr(self, f"migrate_{name}")()
+                query = "INSERT INTO MIGRATIONS VALUES (?, ?, ?, ?)"
+                seconds = time.perf_counter() - started
+                self.db.execute(query, [version, name, datetime.now(), seconds])
+        # Write the rebuilt tables out of the write-ahead log
+        if pending:
+            self.checkpoint()
+
+    def migrate_key_holdings(self):
+        """
+        Key HOLDINGS by (id, ticker), merging the duplicate rows older databases
+        may have. DuckDB cannot add a primary key to an existing table, so the
+        merged rows are copied into a new keyed table that replaces it. The rows are written in key order, as grouping shuffles them and
+        scans filtering on a member would no longer be able to skip row groups.
+        """
+        self.create_holdings("HOLDINGS_KEYED")
+        self.db.execute(
+            f"""
+            INSERT INTO HOLDINGS_KEYED
+            SELECT
+                id,
+                ticker,
+                SUM(shares)::INTEGER,
+                MAX(price),
+                SUM(value)::{self.money_type}
+            FROM HOLDINGS
+            GROUP BY id, ticker
+            ORDER BY id, ticker
+        """
+        )
+        self.db.execute("DROP TABLE HOLDINGS")
+        self.db.execute("ALTER TABLE HOLDINGS_KEYED RENAME TO HOLDINGS")
 
     def trunc(self, x) -> float:
         return round(float(x), self.SCALE)
 
+    def read_money(self, x) -> Money:
+        if self.fixed_point:
+            return int(x)
+        return self.trunc(x)
+
+    def to_money(self, dollars: float) -> Money:
+        if self.fixed_point:
+            return to_micros(dollars)
+        return self.trunc(dollars)
+
+    def convert_money(self):
+        """
+        Convert money columns stored in the other representation to this one.
+        """
+        for table, column in self.MONEY_COLUMNS:
+            types = {
+                row[0]: row[1]
+                for row in self.db.execute(f"DESCRIBE {table}").fetchall()
+            }
+            if types[column] == self.money_type.replace(" ", ""):
+                continue
+            # Tables cannot be altered while they have indexes
+            query = "SELECT index_name, sql FROM duckdb_indexes() WHERE table_name = ?"
+            indexes = self.db.execute(query, [table]).fetchall()
+            for name, _ in indexes:
+                self.db.execute(f"DROP INDEX {name}")
+            self.db.execute(
+                f"""
+                ALTER TABLE {table}
+                ALTER {column} TYPE {self.money_type}
+                USING {self.cast_money(column)}
+            """
+            )
+            for _, sql in indexes:
+                self.db.execute(sql)
+
+    def cast_money(self, column: str) -> str:
+        """
+        SQL expression converting a money column in the other representation to
+        this one.
+        """
+        if self.fixed_point:
+            return f"({column} * {MICROS})::BIGINT"
+        return f"{column}::DECIMAL({self.PRECISION}, 0) * 0.000001"
+
+    def open_ledger(self):
+        """
+        Record the balances of a database from before the ledger as opening trades,
+        so that replaying the ledger starts from them.
+        """
+        if self.db.execute("SELECT COUNT(*) FROM TRADES").fetchone()[0] > 0:
+            return
+        at = datetime.now()
+        with self.transaction():
+            query = """
+                INSERT INTO TRADES (at, id, side, amount)
+                SELECT ?, id, 'open', cash FROM CASH ORDER BY id
+            """
+            self.db.execute(query, [at])
+            query = """
+                INSERT INTO TRADES (at, id, side, ticker, shares, price, amount)
+                SELECT ?, id, 'open', ticker, shares, price, value
+                FROM HOLDINGS
+                ORDER BY id, ticker
+            """
+            self.db.execute(query, [at])
+
+    def record_trade(
+        self,
+        member_id: int,
+        side: str,
+        ticker: str | None = None,
+        shares: int | None = None,
+        price: Money | None = None,
+        amount: Money | None = None,
+    ):
+        query = """
+            INSERT INTO TRADES (at, id, side, ticker, shares, price, amount)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """
+        params = [datetime.now(), member_id, side, ticker, shares, price, amount]
+        self.db.execute(query, params)
+
+    def record_observations(self):
+        """
+        Record the observed holdings in the ledger, in key order. Holdings whose
+        price has not changed accumulate nothing and were left out of OBSERVED.
+        """
+        query = """
+            INSERT INTO OBSERVATIONS (at, id, ticker, price, delta)
+            SELECT ?, id, ticker, price, delta
+            FROM OBSERVED
+            ORDER BY id, ticker
+        """
+        self.db.execute(query, [datetime.now()])
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the enclosed statements as one transaction, which is rolled back if an
+        exception is raised. Nested transactions join the outermost one.
+        """
+        if self.in_transaction:
+            yield
+            return
+        self.db.begin()
+        self.in_transaction = True
+        try:
+            yield
+        except BaseException:
+            self.db.rollback()
+            raise
+        else:
+            self.db.commit()
+        finally:
+            self.in_transaction = False
+
     def register_user(self, member_id: int) -> bool:
+        # Check first, since a failed insert aborts the whole transaction
+        if self.user_exists(member_id):
+            raise UserExistsException("User is already registered.")
         try:
-            self.db.execute("INSERT INTO MEMBERS VALUES (?)", [member_id])
-            self.db.execute("INSERT INTO CASH VALUES (?, ?)", [member_id, 10000])
+            with self.transaction():
+                self.db.execute("INSERT INTO MEMBERS VALUES (?)", [member_id])
+                cash = self.to_money(self.STARTING_CASH)
+                self.db.execute("INSERT INTO CASH VALUES (?, ?)", [member_id, cash])
+                self.db.execute("INSERT INTO TOTALS VALUES (?, ?)", [member_id, cash])
+                self.record_trade(member_id, "register", amount=cash)
             return True
         except duckdb.ConstraintException:
             raise UserExistsException("User is already registered.")
@@ -110,47 +490,72 @@ class Database:
         if not self.user_exists(member_id):
             raise UserDoesNotExistException("User does not exist!")
 
-    def get_cash(self, member_id: int) -> float:
+    def get_cash(self, member_id: int) -> Money:
         query = "SELECT cash FROM CASH WHERE id = ?"
         result = self.db.execute(query, [member_id]).fetchone()
-        return self.trunc(result[0])
+        return self.read_money(result[0])
 
-    def add_cash(self, member_id: int, delta: float):
-        delta = self.trunc(delta)
-        cash = self.get_cash(member_id) + delta
-        self.db.execute("UPDATE CASH SET cash = ? WHERE id = ?", [cash, member_id])
+    def add_cash(self, member_id: int, delta: Money):
+        if not self.fixed_point:
+            delta = self.trunc(delta)
+        with self.transaction():
+            query = "UPDATE CASH SET cash = cash + ? WHERE id = ?"
+            self.db.execute(query, [delta, member_id])
+            query = "UPDATE TOTALS SET total = total + ? WHERE id = ?"
+            self.db.execute(query, [delta, member_id])
+            self.record_trade(member_id, "deposit", amount=delta)
 
     def get_shares(self, member_id: int, ticker: str) -> int:
         query = """
-            SELECT SUM(shares)
-            FROM HOLDINGS 
+            SELECT shares
+            FROM HOLDINGS
             WHERE id = ? AND ticker = ?
         """
         result = self.db.execute(query, [member_id, ticker]).fetchone()
-        if result[0] is None:
-            return 0
-        else:
-            return int(result[0])
+        return 0 if result is None else int(result[0])
 
-    def get_holdings(self, member_id: int) -> Iterator[Holding]:
+    def get_holdings(
+        self, member_id: int, live: bool = False
+    ) -> Iterator[Holding | LiveHolding]:
         query = """
-            SELECT id, ticker
+            SELECT id, ticker, shares, price, value
             FROM HOLDINGS
             WHERE id = ?
             ORDER BY ticker
         """
         holdings = self.db.execute(query, [member_id]).fetchall()
         for holding in holdings:
-            yield Holding(
-                db=self,
-                member_id=member_id,
-                ticker=holding[1],
-            )
+            if live:
+                yield LiveHolding(db=self, member_id=member_id, ticker=holding[1])
+            else:
+                yield self.snapshot(holding)
 
-    def get_holding(self, member_id: int, ticker: str) -> Holding:
-        return Holding(db=self, member_id=member_id, ticker=ticker)
+    def get_holding(
+        self, member_id: int, ticker: str, live: bool = False
+    ) -> Holding | LiveHolding | None:
+        if live:
+            return LiveHolding(db=self, member_id=member_id, ticker=ticker)
+        query = """
+            SELECT id, ticker, shares, price, value
+            FROM HOLDINGS
+            WHERE id = ? AND ticker = ?
+        """
+        holding = self.db.execute(query, [member_id, ticker]).fetchone()
+        if holding is None:
+            return None
+        else:
+            return self.snapshot(holding)
 
-    def observe_price(self, member_id: int, ticker: str, price: float):
+    def snapshot(self, row: tuple) -> Holding:
+        return Holding(
+            member_id=row[0],
+            ticker=row[1],
+            shares=int(row[2]),
+            price=self.read_money(row[3]),
+            value=self.read_money(row[4]),
+        )
+
+    def observe_price(self, member_id: int, ticker: str, price: Money):
         """
         Observation of price changes (always increases) the value of Quonks. If the
         observed price is higher than the last observed price, then the Quonks were
@@ -158,98 +563,1030 @@ class Database:
         last observed price, then the Quonks were short, and the short value is
         accumulated.
         """
+        self.observe({ticker: price}, member_id)
+
+    def observe_prices(self, member_id: int, prices: dict[str, Money]):
+        """
+        Observe the prices of several of a member's holdings in one statement.
+        """
+        if prices:
+            self.observe(prices, member_id)
+
+    def get_observed_holdings(
+        self, member_id: int, prices: dict[str, Money]
+    ) -> list[Holding]:
+        """
+        Observe the prices of a member's holdings, and read back the observed
+        holdings in the same transaction. Holdings bought since the prices were
+        fetched are read back as they were.
+        """
+        with self.transaction():
+            self.observe_prices(member_id, prices)
+            return list(self.get_holdings(member_id))
+
+    def observe_all(self, prices: dict[str, Money]):
+        """
+        Observe the prices for every member holding those tickers in one statement.
+        """
+        if prices:
+            self.observe(prices)
+
+    def observe(self, prices: dict[str, Money], member_id: int | None = None):
+        """
+        Compute the value each holding accumulates from the prices once, into the
+        OBSERVED temporary table, then add it to TOTALS, the ledger and HOLDINGS.
+        """
+        with self.transaction():
+            self.compute_observed(prices, member_id)
+            self.observe_totals()
+            self.record_observations()
+            self.observe_holdings(member_id)
+
+    def member_filter(self, column: str, member_id: int | None) -> tuple[str, list]:
+        """
+        Condition selecting one member's rows, or every row without a member. It is
+        a plain equality rather than `? IS NULL OR`, so DuckDB can push it into the
+        scan and skip the row groups of other members.
+        """
+        if member_id is None:
+            return "TRUE", []
+        return f"{column} = ?", [member_id]
+
+    def compute_observed(self, prices: dict[str, Money], member_id: int | None = None):
+        """
+        Replace OBSERVED with the new price and accumulated value of every holding
+        whose price changed. Temporary tables belong to this connection, so other
+        cursors never see it.
+        """
+        member, member_params = self.member_filter("h.id", member_id)
+        query = f"""
+            CREATE OR REPLACE TEMP TABLE OBSERVED AS
+            SELECT h.id, h.ticker, p.price, h.shares * ABS(h.price - p.price) AS delta
+            FROM HOLDINGS h
+            JOIN (
+                SELECT UNNEST(?::VARCHAR[]) AS ticker, UNNEST(?::{self.money_type}[]) AS price
+            ) p
+            ON h.ticker = p.ticker
+            WHERE h.price != p.price AND {member}
+        """
+        params = [list(prices.keys()), list(prices.values())]
+        self.db.execute(query, params + member_params)
+
+    def observe_totals(self):
         query = """
+            UPDATE TOTALS
+            SET total = total + d.delta
+            FROM (SELECT id, SUM(delta) AS delta FROM OBSERVED GROUP BY id) d
+            WHERE TOTALS.id = d.id
+        """
+        self.db.execute(query)
+
+    def observe_holdings(self, member_id: int | None = None):
+        # The member filter lets the scan of HOLDINGS skip other members' rows
+        # before the join
+        member, member_params = self.member_filter("HOLDINGS.id", member_id)
+        query = f"""
             UPDATE HOLDINGS
-            SET value = value + (shares * ABS(price - ?)), price = ?
-            WHERE id = ? AND ticker = ?
+            SET value = HOLDINGS.value + o.delta, price = o.price
+            FROM OBSERVED o
+            WHERE HOLDINGS.id = o.id AND HOLDINGS.ticker = o.ticker AND {member}
         """
-        self.db.execute(query, [price, price, member_id, ticker])
-
-    def buy_quonks(self, member_id: int, ticker: str, shares: int, price: float):
-        # Get current cash on hand
-        cash = self.get_cash(member_id)
-        # Reject attempts to buy more than they have cash for
-        if shares * price > cash:
-            limit = int(cash / price)
-            if limit > 0:
-                raise NotEnoughCashException(
-                    f"You only have enough to buy {limit} shares of ${ticker}."
-                )
-            else:
-                raise NotEnoughCashException(
-                    f"You do not have enough cash to buy any shares of ${ticker}"
-                )
-        else:
-            # Otherwise, they have enough cash. Convert the cash to shares.
-            cost = shares * price
-            self.add_cash(member_id, cost * -1)
-            self.observe_price(member_id, ticker, price)
-            if self.get_shares(member_id, ticker) == 0:
-                query = "INSERT INTO HOLDINGS VALUES (?, ?, ?, ?, ?)"
-                value = shares * price
-                self.db.execute(query, [member_id, ticker, shares, price, value])
-            else:
-                query = """
-                    UPDATE HOLDINGS
-                    SET shares = shares + ?, value = value + (? * price)
-                    WHERE id = ? AND ticker = ?
-                """
-                self.db.execute(query, [shares, shares, member_id, ticker])
+        self.db.execute(query, member_params)
 
-    def sell_quonks(
-        self, member_id: int, ticker: str, shares: int, price: float
-    ) -> float:
-        # Get current number of shares.
-        current_holding = self.get_shares(member_id, ticker)
-        # Reject attempts to sell more shares than they own.
-        if shares > current_holding:
-            raise InvalidSharesException("You cannot sell more shares than you own.")
-        else:
-            # Otherwise, they have enough shares. Convert shares to cash
-            # Observe the selling price
-            self.observe_price(member_id, ticker, price)
+    def get_tickers(self) -> list[str]:
+        query = "SELECT DISTINCT ticker FROM HOLDINGS ORDER BY ticker"
+        return [row[0] for row in self.db.execute(query).fetchall()]
+
+    def record_prices(
+        self, prices: dict[str, Money], fetched_at: datetime | None = None
+    ):
+        """
+        Store the latest fetched price for each ticker, replacing older ones.
+        """
+        if not prices:
+            return
+        query = f"""
+            INSERT OR REPLACE INTO PRICES
+            SELECT UNNEST(?::VARCHAR[]), UNNEST(?::{self.money_type}[]), ?
+        """
+        tickers = [ticker.upper() for ticker in prices.keys()]
+        fetched_at = fetched_at or datetime.now()
+        self.db.execute(query, [tickers, list(prices.values()), fetched_at])
+
+    def get_prices(self, tickers: list[str], max_age: float) -> dict[str, Money]:
+        """
+        Get the stored prices that were fetched at most `max_age` seconds ago, keyed
+        by the requested tickers. Tickers without a fresh price are left out.
+        """
+        tickers = {ticker.upper(): ticker for ticker in tickers}
+        if not tickers:
+            return {}
+        query = """
+            SELECT ticker, price
+            FROM PRICES
+            WHERE ticker IN (SELECT UNNEST(?::VARCHAR[])) AND fetched_at >= ?
+        """
+        cutoff = datetime.now() - timedelta(seconds=max_age)
+        rows = self.db.execute(query, [list(tickers), cutoff]).fetchall()
+        return {tickers[ticker]: self.read_money(price) for ticker, price in rows}
+
+    def get_price(self, ticker: str, max_age: float) -> Money | None:
+        return self.get_prices([ticker], max_age).get(ticker)
+
+    def buy_quonks(self, member_id: int, ticker: str, shares: int, price: Money):
+        cost = shares * price
+        if not self.fixed_point:
+            cost = self.trunc(cost)
+        with self.transaction():
+            # Take the cost out of cash on hand, if they have enough
             query = """
-                SELECT value / shares
-                FROM HOLDINGS
-                WHERE id = ? AND ticker = ?
+                UPDATE CASH
+                SET cash = cash - ?
+                WHERE id = ? AND cash >= ?
             """
-            result = self.db.execute(query, [member_id, ticker]).fetchone()
-            quonk_price = self.trunc(result[0])
-            quonk_value = quonk_price * shares
-            self.add_cash(member_id, quonk_value)
+            result = self.db.execute(query, [cost, member_id, cost]).fetchone()
+            # Reject attempts to buy more than they have cash for
+            if result[0] == 0:
+                self.validate_user(member_id)
+                cash = self.get_cash(member_id)
+                limit = int(cash // price)
+                if limit > 0:
+                    raise NotEnoughCashException(
+                        f"You only have enough to buy {limit} shares of ${ticker}."
+                    )
+                else:
+                    raise NotEnoughCashException(
+                        f"You do not have enough cash to buy any shares of ${ticker}"
+                    )
+            # Otherwise, they have enough cash. Observe the price and convert the
+            # cash to shares.
+            self.observe({ticker: price}, member_id)
+            self.record_trade(member_id, "buy", ticker, shares, price, cost)
             query = """
                 UPDATE HOLDINGS
-                SET shares = shares - ?, value = value - ?
+                SET value = value + ?, shares = shares + ?
                 WHERE id = ? AND ticker = ?
             """
-            self.db.execute(query, [shares, quonk_value, member_id, ticker])
-            if self.get_shares(member_id, ticker) == 0:
+            params = [cost, shares, member_id, ticker]
+            if self.db.execute(query, params).fetchone()[0] == 0:
+                query = "INSERT INTO HOLDINGS VALUES (?, ?, ?, ?, ?)"
+                self.db.execute(query, [member_id, ticker, shares, price, cost])
+
+    def sell_quonks(
+        self, member_id: int, ticker: str, shares: int, price: Money
+    ) -> Money:
+        with self.transaction():
+            # Reject attempts to sell more shares than they own, before writing
+            # anything
+            current_holding = self.get_shares(member_id, ticker)
+            if shares > current_holding:
+                raise InvalidSharesException(
+                    "You cannot sell more shares than you own."
+                )
+            # Otherwise, they have enough shares. Observe the selling price,
+            # reading back the observed value.
+            self.observe({ticker: price}, member_id)
+            # DuckDB cannot return updated rows from keyed tables, so read it back
+            query = "SELECT value FROM HOLDINGS WHERE id = ? AND ticker = ?"
+            value = self.db.execute(query, [member_id, ticker]).fetchone()[0]
+            # Convert shares to cash
+            if self.fixed_point:
+                quonk_price = int(value) // current_holding
+                quonk_value = quonk_price * shares
+            else:
+                quonk_price = self.trunc(float(value) / current_holding)
+                quonk_value = self.trunc(quonk_price * shares)
+            self.record_trade(member_id, "sell", ticker, shares, price, quonk_value)
+            if shares == current_holding:
+                # Deleting the holding takes its whole value out of the total, so
+                # add back the cash it sold for.
                 self.delete_holdings(member_id, ticker)
+                query = "UPDATE TOTALS SET total = total + ? WHERE id = ?"
+                self.db.execute(query, [quonk_value, member_id])
+            else:
+                query = """
+                    UPDATE HOLDINGS
+                    SET shares = shares - ?, value = value - ?
+                    WHERE id = ? AND ticker = ?
+                """
+                self.db.execute(query, [shares, quonk_value, member_id, ticker])
+            query = "UPDATE CASH SET cash = cash + ? WHERE id = ?"
+            self.db.execute(query, [quonk_value, member_id])
             return quonk_price
 
     def delete_holdings(self, member_id: int, ticker: str):
-        query = "DELETE FROM HOLDINGS WHERE id = ? AND ticker = ?"
-        self.db.execute(query, [member_id, ticker])
+        with self.transaction():
+            self.record_trade(member_id, "close", ticker)
+            query = """
+                UPDATE TOTALS
+                SET total = total - (
+                    SELECT COALESCE(SUM(value), 0)
+                    FROM HOLDINGS
+                    WHERE id = ? AND ticker = ?
+                )
+                WHERE id = ?
+            """
+            self.db.execute(query, [member_id, ticker, member_id])
+            query = "DELETE FROM HOLDINGS WHERE id = ? AND ticker = ?"
+            self.db.execute(query, [member_id, ticker])
 
-    def leaderboard(self):
+    def leaderboard(self) -> Iterator[Leader]:
         query = """
-            SELECT a.id, a.cash, COALESCE(b.value, 0)
-            FROM CASH a
-            LEFT JOIN (
-                SELECT id, SUM(value) AS value
-                FROM HOLDINGS
-                GROUP BY id
-            ) b
-            ON a.id = b.id
-            ORDER BY COALESCE(b.value, 0) DESC
+            SELECT id, total
+            FROM TOTALS
+            ORDER BY total DESC
             LIMIT 10
         """
         for leader in self.db.execute(query).fetchall():
-            value = self.trunc(leader[1])
-            cash = self.trunc(leader[2])
-            yield Leader(member_id=leader[0], value=cash + value)
+            yield Leader(member_id=leader[0], value=self.read_money(leader[1]))
+
+    def rebuild_totals(self) -> int:
+        """
+        Recompute TOTALS from CASH and HOLDINGS, returning the number of members whose
+        maintained total was missing or differed from the recomputed one.
+        """
+        query = """
+            SELECT c.id, c.cash + COALESCE(SUM(h.value), 0) AS total
+            FROM CASH c
+            LEFT JOIN HOLDINGS h
+            ON c.id = h.id
+            GROUP BY c.id, c.cash
+        """
+        with self.transaction():
+            query = f"""
+                SELECT r.id, r.total, t.id IS NULL AS missing
+                FROM ({query}) r
+                LEFT JOIN TOTALS t
+                ON r.id = t.id
+                WHERE t.id IS NULL OR t.total != r.total
+            """
+            drifted = self.db.execute(query).fetchall()
+            missing = [[id, total] for id, total, missing in drifted if missing]
+            stale = [[total, id] for id, total, missing in drifted if not missing]
+            if missing:
+                self.db.executemany("INSERT INTO TOTALS VALUES (?, ?)", missing)
+            if stale:
+                query = "UPDATE TOTALS SET total = ? WHERE id = ?"
+                self.db.executemany(query, stale)
+        return len(drifted)
+
+    def record_history(self, at: datetime | None = None):
+        """
+        Snapshot every member's total in one statement, fold the snapshots into the
+        rollup of each resolution, and drop history past its retention.
+        """
+        at = at or datetime.now()
+        with self.transaction():
+            query = "INSERT INTO SNAPSHOTS SELECT id, ?, total FROM TOTALS"
+            self.db.execute(query, [at])
+            query = """
+                INSERT INTO ROLLUPS
+                SELECT ?, id, time_bucket(?, ?::TIMESTAMP), total, total, total
+                FROM TOTALS
+                ON CONFLICT (resolution, id, bucket) DO UPDATE
+                SET low = LEAST(low, excluded.low),
+                    high = GREATEST(high, excluded.high),
+                    last = excluded.last
+            """
+            for seconds in self.RESOLUTIONS.values():
+                self.db.execute(query, [seconds, timedelta(seconds=seconds), at])
+            self.prune_history(at)
+
+    def prune_history(self, at: datetime):
+        days = self.retention.get("snapshot", 0)
+        if days > 0:
+            query = "DELETE FROM SNAPSHOTS WHERE at < ?"
+            self.db.execute(query, [at - timedelta(days=days)])
+        for name, seconds in self.RESOLUTIONS.items():
+            days = self.retention.get(name, 0)
+            if days > 0:
+                query = "DELETE FROM ROLLUPS WHERE resolution = ? AND bucket < ?"
+                self.db.execute(query, [seconds, at - timedelta(days=days)])
+
+    def get_history(
+        self,
+        member_id: int,
+        period: timedelta,
+        points: int,
+        now: datetime | None = None,
+    ) -> list[HistoryPoint]:
+        """
+        Get a member's total value over the last `period`, downsampled to at most
+        `points` points from the coarsest rollup retained over the period that is
+        fine enough, or else the finest one retained.
+        """
+        now = now or datetime.now()
+        step = period / points
+
+        def kept(name: str) -> timedelta:
+            days = self.retention.get(name, 0)
+            return timedelta.max if days == 0 else timedelta(days=days)
+
+        retained = [
+            seconds
+            for name, seconds in self.RESOLUTIONS.items()
+            if kept(name) >= period
+        ]
+        if not retained:
+            # No rollup covers the whole period, so use the one kept longest
+            retained = [self.RESOLUTIONS[max(self.RESOLUTIONS, key=kept)]]
+        fine = [seconds for seconds in retained if seconds <= step.total_seconds()]
+        resolution = max(fine) if fine else min(retained)
+        query = """
+            SELECT
+                time_bucket(?, bucket, ?::TIMESTAMP) AS at,
+                MIN(low),
+                MAX(high),
+                arg_max(last, bucket)
+            FROM ROLLUPS
+            WHERE resolution = ? AND id = ? AND bucket >= ?
+            GROUP BY at
+            ORDER BY at
+        """
+        since = now - period
+        params = [step, since, resolution, member_id, since]
+        return [
+            HistoryPoint(
+                at=row[0],
+                low=self.read_money(row[1]),
+                high=self.read_money(row[2]),
+                value=self.read_money(row[3]),
+            )
+            for row in self.db.execute(query, params).fetchall()
+        ]
+
+    def replay_ledger(self, dry_run: bool = False) -> int:
+        """
+        Rebuild CASH and HOLDINGS by replaying the ledger in order, returning the
+        number of balances and holdings that were missing or differed from the
+        replayed ones. With `dry_run` they are only counted.
+        """
+        query = """
+            SELECT seq, side, id, ticker, shares, price, amount
+            FROM TRADES
+            UNION ALL
+            SELECT seq, 'observe', id, ticker, NULL, price, delta
+            FROM OBSERVATIONS
+            ORDER BY seq
+        """
+        cash = {}
+        holdings = {}
+        with self.transaction():
+            result = self.db.execute(query)
+            while rows := result.fetchmany(10000):
+                for _, side, member_id, ticker, shares, price, amount in rows:
+                    key = (member_id, ticker)
+                    if side == "register" or (side == "open" and ticker is None):
+                        cash[member_id] = amount
+                    elif side == "open" and key in holdings:
+                        # Duplicate rows opened before HOLDINGS was keyed, merged
+                        # as by migrate_key_holdings
+                        holdings[key][0] += shares
+                        holdings[key][1] = max(holdings[key][1], price)
+                        holdings[key][2] += amount
+                    elif side == "open":
+                        holdings[key] = [shares, price, amount]
+                    elif side == "deposit":
+                        cash[member_id] += amount
+                    elif side == "observe":
+                        holdings[key][1] = price
+                        holdings[key][2] += amount
+                    elif side == "buy":
+                        cash[member_id] -= amount
+                        if key in holdings:
+                            holdings[key][0] += shares
+                            holdings[key][1] = price
+                            holdings[key][2] += amount
+                        else:
+                            holdings[key] = [shares, price, amount]
+                    elif side == "sell":
+                        cash[member_id] += amount
+                        holdings[key][0] -= shares
+                        holdings[key][2] -= amount
+                    elif side == "close":
+                        holdings.pop(key, None)
+            # Compare with the balances and holdings as they are
+            query = "SELECT id, cash FROM CASH"
+            current_cash = dict(self.db.execute(query).fetchall())
+            query = "SELECT id, ticker, shares, price, value FROM HOLDINGS"
+            current_holdings = {
+                (row[0], row[1]): list(row[2:])
+                for row in self.db.execute(query).fetchall()
+            }
+            drifted = sum(
+                cash.get(id) != current_cash.get(id)
+                for id in cash.keys() | current_cash.keys()
+            )
+            drifted += sum(
+                holdings.get(key) != current_holdings.get(key)
+                for key in holdings.keys() | current_holdings.keys()
+            )
+            if dry_run or drifted == 0:
+                return drifted
+            # CASH and HOLDINGS are updated in place, as DuckDB cannot reinsert a
+            # deleted key in the same transaction
+            replayed = f"""
+                SELECT UNNEST(?::BIGINT[]) AS id, UNNEST(?::{self.money_type}[]) AS cash
+            """
+            params = [list(cash.keys()), list(cash.values())]
+            query = f"""
+                UPDATE CASH
+                SET cash = r.cash
+                FROM ({replayed}) r
+                WHERE CASH.id = r.id AND CASH.cash != r.cash
+            """
+            self.db.execute(query, params)
+            query = f"""
+                INSERT INTO CASH
+                SELECT * FROM ({replayed}) WHERE id NOT IN (SELECT id FROM CASH)
+            """
+            self.db.execute(query, params)
+            query = "DELETE FROM CASH WHERE id NOT IN (SELECT UNNEST(?::BIGINT[]))"
+            self.db.execute(query, [list(cash.keys())])
+            replayed = f"""
+                SELECT
+                    UNNEST(?::BIGINT[]) AS id,
+                    UNNEST(?::VARCHAR[]) AS ticker,
+                    UNNEST(?::INTEGER[]) AS shares,
+                    UNNEST(?::{self.money_type}[]) AS price,
+                    UNNEST(?::{self.money_type}[]) AS value
+            """
+            keys = list(holdings.keys())
+            params = [[key[0] for key in keys], [key[1] for key in keys]]
+            params += [[holdings[key][i] for key in keys] for i in range(3)]
+            query = f"""
+                UPDATE HOLDINGS
+                SET shares = r.shares, price = r.price, value = r.value
+                FROM ({replayed}) r
+                WHERE HOLDINGS.id = r.id AND HOLDINGS.ticker = r.ticker
+            """
+            self.db.execute(query, params)
+            query = f"""
+                INSERT INTO HOLDINGS
+                SELECT r.*
+                FROM ({replayed}) r
+                ANTI JOIN HOLDINGS h
+                ON r.id = h.id AND r.ticker = h.ticker
+            """
+            self.db.execute(query, params)
+            query = """
+                DELETE FROM HOLDINGS
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM (
+                        SELECT UNNEST(?::BIGINT[]) AS id, UNNEST(?::VARCHAR[]) AS ticker
+                    ) r
+                    WHERE HOLDINGS.id = r.id AND HOLDINGS.ticker = r.ticker
+                )
+            """
+            self.db.execute(query, params[:2])
+            self.rebuild_totals()
+        return drifted
+
+    def export_ledger(
+        self, directory: str, since: date | None = None
+    ) -> dict[str, int]:
+        """
+        Export the ledger to zstd compressed Parquet files under `directory`, one
+        directory per table partitioned by day, such as
+        trades/day=2024-01-31/data_0.parquet. Only the days from `since` on are
+        written, replacing their earlier exports, so exports can be refreshed
+        incrementally. Returns the number of rows exported per table.
+        """
+        os.makedirs(directory, exist_ok=True)
+        exported = {}
+        for table in self.LEDGER_TABLES:
+            target = os.path.join(directory, table.lower()).replace("'", "''")
+            query = f"""
+                COPY (
+                    SELECT *, at::DATE AS day
+                    FROM {table}
+                    WHERE ? IS NULL OR at::DATE >= ?
+                    ORDER BY seq
+                ) TO '{target}' (
+                    FORMAT PARQUET,
+                    COMPRESSION ZSTD,
+                    PARTITION_BY (day),
+                    OVERWRITE_OR_IGNORE
+                )
+            """
+            self.db.execute(query, [since, since])
+            query = f"SELECT COUNT(*) FROM {table} WHERE ? IS NULL OR at::DATE >= ?"
+            exported[table] = self.db.execute(query, [since, since]).fetchone()[0]
+        return exported
+
+    def checkpoint(self):
+        """
+        Write the write-ahead log into the database file, which also reclaims the
+        space of deleted rows.
+        """
+        self.db.execute("CHECKPOINT")
+
+    def backup(
+        self, directory: str, cursor: duckdb.DuckDBPyConnection | None = None
+    ) -> dict[str, int]:
+        """
+        Save MEMBERS, CASH and HOLDINGS as a bundle of zstd compressed Parquet files
+        in `directory`, returning the number of rows saved per table. The tables are
+        read in one transaction on a cursor of their own, which sees a consistent
+        snapshot without blocking writes on the main connection. The bundle is
+        written beside `directory` and replaces it once complete.
+        """
+        partial = f"{directory}.partial"
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+        connection = cursor or self.db.cursor()
+        saved = {}
+        try:
+            connection.begin()
+            for table in self.BACKUP_TABLES:
+                path = os.path.join(partial, f"{table.lower()}.parquet")
+                query = f"""
+                    COPY {table}
+                    TO '{path.replace("'", "''")}' (FORMAT PARQUET, COMPRESSION ZSTD)
+                """
+                connection.execute(query)
+                query = f"SELECT COUNT(*) FROM {table}"
+                saved[table] = connection.execute(query).fetchone()[0]
+            connection.commit()
+        finally:
+            if cursor is None:
+                connection.close()
+        manifest = {
+            "fixed_point": self.fixed_point,
+            "at": datetime.now().isoformat(),
+            "rows": saved,
+        }
+        with open(os.path.join(partial, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+        # Swap the complete bundle in for the last one
+        previous = f"{directory}.previous"
+        shutil.rmtree(previous, ignore_errors=True)
+        if os.path.exists(directory):
+            os.rename(directory, previous)
+        os.rename(partial, directory)
+        shutil.rmtree(previous, ignore_errors=True)
+        return saved
+
+    def restore(self, directory: str) -> dict[str, int]:
+        """
+        Bulk load a bundle saved by backup into this database, which must be empty,
+        returning the number of rows loaded per table. Money saved in the other
+        representation is converted. TOTALS are computed, and the restored balances
+        open the ledger.
+        """
+        with open(os.path.join(directory, "manifest.json")) as f:
+            manifest = json.load(f)
+        query = "SELECT (SELECT COUNT(*) FROM MEMBERS) + (SELECT COUNT(*) FROM TRADES)"
+        if self.db.execute(query).fetchone()[0] > 0:
+            raise DatabaseNotEmptyException("Can only restore into an empty database.")
+        convert = manifest["fixed_point"] != self.fixed_point
+        restored = {}
+        with self.transaction():
+            for table in self.BACKUP_TABLES:
+                columns = [
+                    self.cast_money(row[0])
+                    if convert and (table, row[0]) in self.MONEY_COLUMNS
+                    else row[0]
+                    for row in self.db.execute(f"DESCRIBE {table}").fetchall()
+                ]
+                path = os.path.join(directory, f"{table.lower()}.parquet")
+                query = f"""
+                    INSERT INTO {table}
+                    SELECT {", ".join(columns)}
+                    FROM read_parquet('{path.replace("'", "''")}')
+                """
+                restored[table] = self.db.execute(query).fetchone()[0]
+            query = """
+                INSERT INTO TOTALS
+                SELECT c.id, c.cash + COALESCE(SUM(h.value), 0)
+                FROM CASH c
+                LEFT JOIN HOLDINGS h
+                ON c.id = h.id
+                GROUP BY c.id, c.cash
+            """
+            self.db.execute(query)
+            self.open_ledger()
+        return restored
 
     def clear(self):
         self.db.execute("DROP TABLE MEMBERS;")
         self.db.execute("DROP TABLE CASH;")
         self.db.execute("DROP TABLE HOLDINGS;")
+        self.db.execute("DROP TABLE TOTALS;")
+        self.db.execute("DROP TABLE PRICES;")
+        self.db.execute("DROP TABLE SNAPSHOTS;")
+        self.db.execute("DROP TABLE ROLLUPS;")
+        self.db.execute("DROP TABLE TRADES;")
+        self.db.execute("DROP TABLE OBSERVATIONS;")
+        self.db.execute("DROP SEQUENCE LEDGER_SEQ;")
+        self.db.execute("DROP TABLE MIGRATIONS;")
+
+    def close(self):
+        self.db.close()
+
+
+def parse_retention(retention: str) -> dict[str, float]:
+    days = {}
+    for part in retention.split(","):
+        name, value = part.split("=")
+        days[name.strip()] = float(value)
+    return days
+
+
+class Operation:
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        future: asyncio.Future,
+        method: Callable,
+        args: tuple,
+        kwargs: dict,
+    ):
+        self.loop = loop
+        self.future = future
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        # Operations with effects outside the transaction, which must not be run
+        # twice, always run on their own
+        self.alone = method.__name__ in AsyncDatabase.RUN_ALONE
+
+    def run(self):
+        self.result = None
+        self.error = None
+        name = self.method.__name__
+        try:
+            with metrics.timer("quonkbot_database_seconds", method=name):
+                result = self.method(*self.args, **self.kwargs)
+                # Generators must be consumed on the worker thread
+                if isinstance(result, Iterator):
+                    result = list(result)
+        except REJECTIONS as e:
+            # Rejections are raised before anything was written, so they are the
+            # operation's result rather than a reason to roll back
+            self.error = e
+            return
+        self.result = result
+
+    def resolve(self):
+        self.loop.call_soon_threadsafe(self.set_future)
+
+    def set_future(self):
+        if self.future.cancelled():
+            return
+        if self.error is not None:
+            self.future.set_exception(self.error)
+        else:
+            self.future.set_result(self.result)
+
+
+class AsyncDatabase:
+    """
+    Awaitable facade over a Database. The connection is owned by one worker thread,
+    which runs queued operations so that database work never blocks the event loop.
+
+    Operations that queue up while the worker is busy are run as one group in a
+    single transaction and committed together, up to `max_batch` at a time.
+    Operations rejected with one of REJECTIONS fail on their own. If any operation
+    in a group raises another exception, the group is rolled back and each operation
+    is run again in its own transaction, so only the failing one sees its exception.
+    Operations in RUN_ALONE, which have effects outside the database, are never
+    grouped.
+
+    Database methods are available as coroutines of the same name.
+    """
+
+    RUN_ALONE = {"cursor", "backup", "restore", "export_ledger", "checkpoint"}
+
+    def __init__(self, db: Database, max_batch: int = DATABASE_MAX_BATCH):
+        self.db = db
+        self.max_batch = max_batch
+        self.queue: queue.SimpleQueue[Operation | None] = queue.SimpleQueue()
+        self.operations = 0
+        self.commits = 0
+        self.rollbacks = 0
+        # Backups of a database write to the same bundle, so they take turns
+        self.backup_lock = asyncio.Lock()
+        self.thread = threading.Thread(target=self.work, name="database", daemon=True)
+        self.thread.start()
+
+    def __getattr__(self, name: str) -> Callable:
+        method = getattr(self.db, name)
+
+        async def call(*args, **kwargs):
+            return await self.submit(method, *args, **kwargs)
+
+        return call
+
+    def submit(self, method: Callable, *args, **kwargs) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.put(Operation(loop, future, method, args, kwargs))
+        return future
+
+    def work(self):
+        running = True
+        while running:
+            operation = self.queue.get()
+            if operation is None:
+                break
+            # Group the operations that queued up while the last group ran
+            group = [operation]
+            while len(group) < self.max_batch and not operation.alone:
+                try:
+                    operation = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if operation is None:
+                    running = False
+                    break
+                if operation.alone:
+                    # Run the group so far, then this operation on its own
+                    self.run_group(group)
+                    group = [operation]
+                    break
+                group.append(operation)
+            self.run_group(group)
+
+    def run_group(self, group: list[Operation]):
+        committed = False
+        if len(group) > 1:
+            try:
+                with self.db.transaction():
+                    for operation in group:
+                        operation.run()
+                self.commits += 1
+                committed = True
+            except Exception:
+                self.rollbacks += 1
+        if not committed:
+            for operation in group:
+                self.run_isolated(operation)
+        self.operations += len(group)
+        for operation in group:
+            operation.resolve()
+
+    def run_isolated(self, operation: Operation):
+        operation.result = None
+        try:
+            with self.db.transaction():
+                operation.run()
+            self.commits += 1
+        except Exception as e:
+            operation.error = e
+
+    async def backup(self, directory: str) -> dict[str, int]:
+        """
+        Back up the database off the worker thread, on a cursor opened by the
+        worker, so queued operations keep running while the bundle is written. A
+        backup waits for the one already running, such as a scheduled checkpoint
+        racing /backup, rather than writing over its partial bundle.
+        """
+        async with self.backup_lock:
+            cursor = await self.submit(self.db.db.cursor)
+            loop = asyncio.get_running_loop()
+            try:
+                with metrics.timer("quonkbot_database_seconds", method="backup"):
+                    return await loop.run_in_executor(
+                        None, self.db.backup, directory, cursor
+                    )
+            finally:
+                cursor.close()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "operations": self.operations,
+            "commits": self.commits,
+            "rollbacks": self.rollbacks,
+        }
+
+    def stop(self):
+        """
+        Finish the queued operations and stop the worker.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def close(self):
+        self.stop()
+        self.db.close()
+
+
+class DatabasePool:
+    """
+    One database file per guild, each opened on first use behind its own
+    AsyncDatabase. At most `max_open` databases are kept open, and beyond that the
+    least recently used ones that are not acquired are closed.
+
+    The pool also stands in for a database for the market data ingestor, which
+    refreshes the tickers held in the open databases and records prices to all of
+    them.
+
+    Earlier versions kept every member in the single `legacy_path` file, by default
+    DATABASE_PATH. It is imported as the database of `legacy_guild_id`, by default
+    LEGACY_GUILD_ID, when that guild has no database yet.
+    """
+
+    def __init__(
+        self,
+        directory: str | None = None,
+        max_open: int = DATABASE_MAX_OPEN,
+        fixed_point: bool = False,
+        max_batch: int = DATABASE_MAX_BATCH,
+        legacy_path: str | None = None,
+        legacy_guild_id: int | None = None,
+    ):
+        self.directory = directory or os.getenv("DATABASE_DIR", "db")
+        self.max_open = max_open
+        self.fixed_point = fixed_point
+        self.max_batch = max_batch
+        self.databases: OrderedDict[int, asyncio.Future] = OrderedDict()
+        self.leases: dict[int, int] = {}
+        self.opens = 0
+        self.evictions = 0
+        os.makedirs(self.directory, exist_ok=True)
+        legacy_path = legacy_path or os.getenv("DATABASE_PATH")
+        if legacy_guild_id is None and LEGACY_GUILD_ID is not None:
+            legacy_guild_id = int(LEGACY_GUILD_ID)
+        if legacy_path is not None and os.path.exists(legacy_path):
+            if legacy_guild_id is None:
+                logger.warning(
+                    "Set LEGACY_GUILD_ID to import the members in %s", legacy_path
+                )
+            else:
+                self.import_legacy(legacy_path, legacy_guild_id)
+
+    def path(self, guild_id: int) -> str:
+        return os.path.join(self.directory, f"{guild_id}.db")
+
+    def import_legacy(self, path: str, guild_id: int) -> bool:
+        """
+        Copy a database file of earlier versions into place as the guild's database,
+        unless it already has one. Opening it upgrades it like any other database,
+        and the original file is left as it was.
+        """
+        target = self.path(guild_id)
+        if os.path.exists(target) or os.path.abspath(path) == os.path.abspath(target):
+            return False
+        # Copy next to the target and move it into place, so that a partial copy is
+        # never opened. The write-ahead log holds changes not yet checkpointed.
+        for suffix in [".wal", ""]:
+            if os.path.exists(f"{path}{suffix}"):
+                shutil.copyfile(f"{path}{suffix}", f"{target}.partial{suffix}")
+                os.replace(f"{target}.partial{suffix}", f"{target}{suffix}")
+        logger.info("Imported %s as the database of guild %s", path, guild_id)
+        return True
+
+    def open(self, guild_id: int) -> AsyncDatabase:
+        db = Database(self.path(guild_id), fixed_point=self.fixed_point)
+        return AsyncDatabase(db, self.max_batch)
+
+    @contextmanager
+    def hold(self, guild_id: int):
+        self.leases[guild_id] = self.leases.get(guild_id, 0) + 1
+        try:
+            yield
+        finally:
+            self.leases[guild_id] -= 1
+            if self.leases[guild_id] == 0:
+                del self.leases[guild_id]
+
+    @asynccontextmanager
+    async def acquire(self, guild_id: int | None):
+        """
+        Get the guild's database, which is kept open until the block exits. Direct
+        messages have no guild, and share the database of guild 0.
+        """
+        guild_id = int(guild_id or 0)
+        with self.hold(guild_id):
+            yield await self.get(guild_id)
+
+    async def get(self, guild_id: int) -> AsyncDatabase:
+        future = self.databases.get(guild_id)
+        if future is None:
+            # Open off the event loop, sharing the open with concurrent callers
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(None, self.open, guild_id)
+            future.add_done_callback(lambda future: self._opened(guild_id, future))
+            self.databases[guild_id] = future
+            self.opens += 1
+            await asyncio.shield(future)
+            # Make room for the database, which is not evicted itself
+            with self.hold(guild_id):
+                await self.evict()
+        self.databases.move_to_end(guild_id)
+        return await asyncio.shield(future)
+
+    def _opened(self, guild_id: int, future: asyncio.Future):
+        # Forget failed opens so that the next caller tries again
+        if future.cancelled() or future.exception() is not None:
+            if self.databases.get(guild_id) is future:
+                del self.databases[guild_id]
+
+    def ready(self) -> list[int]:
+        return [
+            guild_id
+            for guild_id, future in self.databases.items()
+            if future.done() and not future.cancelled() and future.exception() is None
+        ]
+
+    async def evict(self):
+        # Close the least recently used databases nobody is using
+        excess = len(self.databases) - self.max_open
+        idle = [guild_id for guild_id in self.ready() if guild_id not in self.leases]
+        # Take every database to close out of the pool before waiting on any of
+        # them, so none can be acquired while it is being closed
+        closing = [
+            self.databases.pop(guild_id).result() for guild_id in idle[: max(excess, 0)]
+        ]
+        self.evictions += len(closing)
+        loop = asyncio.get_running_loop()
+        for db in closing:
+            await loop.run_in_executor(None, db.close)
+
+    async def open_recent(self, limit: int | None = None) -> list[int]:
+        """
+        Open the databases of the most recently written guilds, up to `limit` or
+        `max_open`, so that the first commands after a restart find them open.
+        """
+        limit = min(limit or self.max_open, self.max_open)
+        paths = [
+            entry
+            for entry in os.scandir(self.directory)
+            if entry.name.endswith(".db") and entry.name[:-3].isdigit()
+        ]
+        paths.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        guild_ids = [int(entry.name[:-3]) for entry in paths[:limit]]
+        await asyncio.gather(*[self.get(guild_id) for guild_id in guild_ids])
+        # Opens finish in any order, so rank them by recency as the pool's LRU
+        for guild_id in reversed(guild_ids):
+            if guild_id in self.databases:
+                self.databases.move_to_end(guild_id)
+        return guild_ids
+
+    async def each(self, method: str, *args) -> list:
+        """
+        Call a method on every open database, keeping each open until it returns.
+        """
+        guild_ids = self.ready()
+        with ExitStack() as stack:
+            for guild_id in guild_ids:
+                stack.enter_context(self.hold(guild_id))
+            return await asyncio.gather(
+                *[
+                    getattr(self.databases[guild_id].result(), method)(*args)
+                    for guild_id in guild_ids
+                ]
+            )
+
+    async def get_tickers(self) -> list[str]:
+        tickers = set()
+        for held in await self.each("get_tickers"):
+            tickers.update(held)
+        return sorted(tickers)
+
+    async def record_prices(self, prices: dict[str, Money]):
+        await self.each("record_prices", prices)
+
+    async def record_history(self, at: datetime | None = None):
+        """
+        Snapshot the members of the open databases. Databases are only closed while
+        idle, so their totals do not change until they are opened again.
+        """
+        await self.each("record_history", at)
+
+    async def checkpoint(self):
+        await self.each("checkpoint")
+
+    async def backup(self, directory: str) -> dict[int, dict[str, int]]:
+        """
+        Back up each open database to a bundle named after its guild in `directory`.
+        """
+        guild_ids = self.ready()
+        with ExitStack() as stack:
+            for guild_id in guild_ids:
+                stack.enter_context(self.hold(guild_id))
+            saved = await asyncio.gather(
+                *[
+                    self.databases[guild_id]
+                    .result()
+                    .backup(os.path.join(directory, str(guild_id)))
+                    for guild_id in guild_ids
+                ]
+            )
+        return dict(zip(guild_ids, saved))
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "open": len(self.databases),
+            "acquired": len(self.leases),
+            "opens": self.opens,
+            "evictions": self.evictions,
+        }
+
+    def close(self):
+        for guild_id in self.ready():
+            self.databases.pop(guild_id).result().close()
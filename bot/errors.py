@@ -1,16 +1,32 @@
+from functools import wraps
 from typing import Callable
+import time
 import lightbulb
 import hikari
+from bot.metrics import metrics
 
 
 def handle_exceptions(*exceptions: tuple[Exception]):
     def wrapper(f: Callable):
+        @wraps(f)
         async def wrapped_function(ctx: lightbulb.Context):
+            started = time.perf_counter()
+            outcome = "error"
             try:
                 await f(ctx)
+                outcome = "ok"
             except exceptions as e:
+                outcome = "rejected"
                 await ctx.respond(e, flags=hikari.MessageFlag.EPHEMERAL)
                 return
+            finally:
+                elapsed = time.perf_counter() - started
+                metrics.observe(
+                    "quonkbot_command_seconds",
+                    elapsed,
+                    command=f.__name__,
+                    outcome=outcome,
+                )
 
         return wrapped_function
 
@@ -0,0 +1,37 @@
+import os
+from datetime import datetime
+from bot.tasks import PeriodicTask
+
+HISTORY_INTERVAL = float(os.getenv("HISTORY_INTERVAL", 60))
+
+SPARKS = "▁▂▃▄▅▆▇█"
+
+
+class HistoryRecorder(PeriodicTask):
+    """
+    Background task that snapshots every member's total value once per `interval`
+    seconds, one bulk write per database per cycle.
+    """
+
+    failure_message = "Recording history failed"
+
+    def __init__(self, db, interval: float = HISTORY_INTERVAL):
+        super().__init__(interval)
+        self.db = db
+
+    async def run_cycle(self):
+        await self.db.record_history(datetime.now())
+
+
+def sparkline(values: list) -> str:
+    """
+    Draw values as a line of block characters scaled between their min and max.
+    """
+    if not values:
+        return ""
+    low = min(values)
+    span = max(values) - low
+    if span == 0:
+        return SPARKS[0] * len(values)
+    steps = len(SPARKS) - 1
+    return "".join(SPARKS[int((value - low) * steps // span)] for value in values)
@@ -0,0 +1,77 @@
+import os
+from typing import Awaitable, Callable
+from bot.tasks import PeriodicTask
+
+INGEST_INTERVAL = float(os.getenv("INGEST_INTERVAL", 60))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 20))
+INGEST_MAX_FETCHES = int(os.getenv("INGEST_MAX_FETCHES", 200))
+INGEST_MAX_BACKOFF = float(os.getenv("INGEST_MAX_BACKOFF", 900))
+
+
+class MarketDataIngestor(PeriodicTask):
+    """
+    Background task that keeps the PRICES table of an AsyncDatabase fresh for every
+    ticker held in HOLDINGS, so commands can use a stored price instead of quoting
+    upstream.
+
+    Each cycle quotes at most `max_fetches` tickers in batches of `batch_size`. When
+    there are more tickers than that, later cycles continue where the last one
+    stopped. Failed cycles back off exponentially, up to `max_backoff` seconds.
+    """
+
+    failure_message = "Price ingestion failed, backing off"
+
+    def __init__(
+        self,
+        db,
+        fetch_prices: Callable[[list[str]], Awaitable[dict[str, float]]],
+        interval: float = INGEST_INTERVAL,
+        batch_size: int = INGEST_BATCH_SIZE,
+        max_fetches: int = INGEST_MAX_FETCHES,
+        max_backoff: float = INGEST_MAX_BACKOFF,
+    ):
+        super().__init__(interval)
+        self.db = db
+        self.fetch_prices = fetch_prices
+        self.batch_size = batch_size
+        self.max_fetches = max_fetches
+        self.max_backoff = max_backoff
+        self.offset = 0
+
+    async def next_tickers(self) -> list[str]:
+        tickers = await self.db.get_tickers()
+        if len(tickers) <= self.max_fetches:
+            self.offset = 0
+            return tickers
+        # Rotate through the tickers so that every one is eventually refreshed
+        self.offset %= len(tickers)
+        tickers = tickers[self.offset :] + tickers[: self.offset]
+        self.offset += self.max_fetches
+        return tickers[: self.max_fetches]
+
+    async def run_cycle(self) -> int:
+        """
+        Refresh one cycle of tickers, returning the number of prices recorded. Raises
+        if an upstream error left no batch with any price to record.
+        """
+        tickers = await self.next_tickers()
+        recorded = 0
+        error = None
+        for i in range(0, len(tickers), self.batch_size):
+            batch = tickers[i : i + self.batch_size]
+            try:
+                prices = await self.fetch_prices(batch)
+            except Exception as e:
+                # Keep whatever part of the batch was quoted
+                prices = getattr(e, "prices", {})
+                error = e
+            await self.db.record_prices(prices)
+            recorded += len(prices)
+        if error is not None and recorded == 0:
+            raise error
+        return recorded
+
+    def delay(self) -> float:
+        if self.failures == 0:
+            return self.interval
+        return min(self.interval * 2**self.failures, self.max_backoff)
@@ -0,0 +1,56 @@
+"""
+Export a guild database's trade ledger to Parquet, or rebuild its cash and holdings
+by replaying the ledger. The bot must not have the database open.
+
+    python -m bot.ledger export db/1234.db ledger/1234 --since 2024-01-31
+    python -m bot.ledger replay db/1234.db --dry-run
+
+Exports can be queried without touching the live database, for example
+
+    SELECT side, COUNT(*)
+    FROM read_parquet('ledger/1234/trades/*/*.parquet', hive_partitioning = true)
+    GROUP BY side
+"""
+
+import argparse
+import json
+import sys
+from datetime import date
+from bot.database import Database
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--float",
+        action="store_true",
+        help="Open the database with DECIMAL rather than micro-dollar money columns",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="Export the ledger to Parquet")
+    export.add_argument("database")
+    export.add_argument("directory")
+    export.add_argument(
+        "--since", type=date.fromisoformat, help="Only export days from this one on"
+    )
+    replay = commands.add_parser("replay", help="Rebuild cash and holdings")
+    replay.add_argument("database")
+    replay.add_argument(
+        "--dry-run", action="store_true", help="Only count what would change"
+    )
+    args = parser.parse_args(argv)
+
+    db = Database(args.database, fixed_point=not args.float)
+    try:
+        if args.command == "export":
+            report = db.export_ledger(args.directory, args.since)
+        else:
+            report = {"drifted": db.replay_ledger(dry_run=args.dry_run)}
+    finally:
+        db.close()
+    sys.stdout.write(json.dumps(report) + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
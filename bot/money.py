@@ -0,0 +1,26 @@
+MICROS = 1_000_000
+
+# Money is float dollars, or integer micro-dollars when fixed point is enabled
+Money = float | int
+
+
+def to_micros(dollars: float) -> int:
+    """
+    Convert dollars, such as an upstream quote, to integer micro-dollars.
+    """
+    return round(dollars * MICROS)
+
+
+def to_dollars(micros: int) -> float:
+    return micros / MICROS
+
+
+def format_money(micros: int) -> str:
+    """
+    Format micro-dollars as dollars and cents, rounding half up on the cents without
+    going through a float.
+    """
+    sign = "-" if micros < 0 else ""
+    cents = (abs(micros) + 5_000) // 10_000
+    dollars, cents = divmod(cents, 100)
+    return f"{sign}${dollars:,}.{cents:02d}"
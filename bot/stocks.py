@@ -1,21 +1,801 @@
-import yfinance as yf
+import asyncio
+import duckdb
+import heapq
+import json
+import time
 import os
 import random
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Awaitable, Callable
+from bot.metrics import metrics
+from bot.symbols import symbols
 
 GENERATE_RANDOM_STOCK_VALUES = os.getenv("GENERATE_RANDOM_STOCK_VALUES")
+QUOTE_PROVIDER = os.getenv("QUOTE_PROVIDER", "yfinance")
+QUOTE_TAPE = os.getenv("QUOTE_TAPE")
+QUOTE_TAPE_SPEED = float(os.getenv("QUOTE_TAPE_SPEED", 1))
+QUOTE_WORKERS = int(os.getenv("QUOTE_WORKERS", 8))
+QUOTE_TIMEOUT = float(os.getenv("QUOTE_TIMEOUT", 10))
+QUOTE_CACHE_TTL = float(os.getenv("QUOTE_CACHE_TTL", 30))
+QUOTE_CACHE_SIZE = int(os.getenv("QUOTE_CACHE_SIZE", 1024))
+QUOTE_NEGATIVE_TTL = float(os.getenv("QUOTE_NEGATIVE_TTL", 300))
+# Upstream requests per second, where 0 disables the limit, and the largest burst
+QUOTE_RATE = float(os.getenv("QUOTE_RATE", 5))
+QUOTE_BURST = float(os.getenv("QUOTE_BURST", 10))
+# Bulk quotes that may wait for the rate limit before more are shed
+QUOTE_MAX_QUEUE = int(os.getenv("QUOTE_MAX_QUEUE", 100))
+
+# Upstream request priorities, most urgent first. Commands quote interactively, and
+# background refreshes such as the market data ingestor quote in bulk.
+QUOTE_PRIORITIES = ["interactive", "bulk"]
+
+# Finest price history yfinance serves for each span in seconds
+YFINANCE_INTERVALS = [(7 * 86400, "1m"), (60 * 86400, "5m"), (730 * 86400, "1h")]
+
+# Quotes are fetched on a bounded pool so that blocking yfinance calls never run on
+# the event loop, and a burst of slow quotes cannot spawn unbounded threads.
+executor = ThreadPoolExecutor(max_workers=QUOTE_WORKERS, thread_name_prefix="quote")
 
 
 class QuoteException(Exception):
     pass
 
 
-def get_stock_price(ticker: str) -> float:
-    if GENERATE_RANDOM_STOCK_VALUES:
-        price = random.sample([100, 200], k=1)[0]
-    else:
+class UnknownTickerException(QuoteException):
+    """
+    Raised for tickers that are not in the symbol index, or that upstream has no
+    price for.
+    """
+
+
+class QuoteBatchException(QuoteException):
+    """
+    Raised when some tickers in a batch could not be quoted. The quotes that did
+    succeed are available in `prices`, and each failure in `errors`.
+    """
+
+    def __init__(self, prices: dict[str, float], errors: dict[str, Exception]):
+        self.prices = prices
+        self.errors = errors
+        tickers = ", ".join(f"${ticker}" for ticker in errors)
+        super().__init__(f"Unable to quote: {tickers}")
+
+
+class QuoteOverloadedException(QuoteException):
+    """
+    Raised for bulk quotes shed because too many are already waiting for the
+    upstream rate limit.
+    """
+
+
+class QuoteCache:
+    """
+    Process-wide cache of recent quotes. Entries are fresh for `ttl` seconds, and
+    the least recently used entries are evicted beyond `max_size`. Concurrent misses
+    for the same ticker share a single in-flight fetch.
+
+    Tickers upstream has no price for are remembered for `negative_ttl` seconds, and
+    are rejected without fetching again until then.
+    """
+
+    def __init__(
+        self,
+        ttl: float = QUOTE_CACHE_TTL,
+        max_size: int = QUOTE_CACHE_SIZE,
+        clock: Callable[[], float] = time.monotonic,
+        negative_ttl: float = QUOTE_NEGATIVE_TTL,
+    ):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self.negative_ttl = negative_ttl
+        self.entries: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self.unknown: OrderedDict[str, float] = OrderedDict()
+        self.inflight: dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.negative_hits = 0
+
+    def get(self, ticker: str) -> float | None:
+        key = ticker.upper()
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        price, fetched_at = entry
+        if self.clock() - fetched_at >= self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return price
+
+    def put(self, ticker: str, price: float):
+        key = ticker.upper()
+        self.entries[key] = (price, self.clock())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def is_unknown(self, ticker: str) -> bool:
+        key = ticker.upper()
+        failed_at = self.unknown.get(key)
+        if failed_at is None:
+            return False
+        if self.clock() - failed_at >= self.negative_ttl:
+            del self.unknown[key]
+            return False
+        return True
+
+    def put_unknown(self, ticker: str):
+        key = ticker.upper()
+        self.unknown[key] = self.clock()
+        self.unknown.move_to_end(key)
+        while len(self.unknown) > self.max_size:
+            self.unknown.popitem(last=False)
+
+    async def fetch(
+        self, ticker: str, fetch: Callable[[str], Awaitable[float]]
+    ) -> float:
+        started = time.perf_counter()
+        key = ticker.upper()
+        # Serve fresh entries directly
+        price = self.get(key)
+        if price is not None:
+            self.hits += 1
+            elapsed = time.perf_counter() - started
+            metrics.observe("quonkbot_quote_seconds", elapsed, result="hit")
+            return price
+        # Reject tickers that recently had no price without fetching again
+        if self.is_unknown(key):
+            self.negative_hits += 1
+            elapsed = time.perf_counter() - started
+            metrics.observe("quonkbot_quote_seconds", elapsed, result="unknown")
+            raise UnknownTickerException(f"Unable to quote: ${ticker}")
+        task = self.inflight.get(key)
+        if task is not None:
+            # Wait on a fetch another caller already started
+            self.coalesced += 1
+            result = "coalesced"
+        else:
+            # Otherwise, start the fetch. Shielding keeps it running for the other
+            # waiters if the caller that started it is cancelled.
+            self.misses += 1
+            result = "miss"
+            task = asyncio.ensure_future(fetch(ticker))
+            self.inflight[key] = task
+            task.add_done_callback(lambda task: self._complete(key, task))
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            result = "error"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe("quonkbot_quote_seconds", elapsed, result=result)
+
+    def _complete(self, key: str, task: asyncio.Future):
+        del self.inflight[key]
+        if task.cancelled():
+            return
+        if task.exception() is None:
+            self.put(key, task.result())
+        elif isinstance(task.exception(), UnknownTickerException):
+            self.put_unknown(key)
+
+    async def fetch_many(
+        self,
+        tickers: list[str],
+        fetch: Callable[[list[str]], Awaitable[dict[str, float | None]]],
+    ) -> dict[str, float | Exception]:
+        """
+        Like fetch for several tickers, except that the tickers that are neither
+        fresh nor in flight are fetched together in one call to `fetch`, which
+        returns their prices, or None for tickers it has no price for. Returns each
+        ticker's price or the exception quoting it raised.
+        """
+        started = time.perf_counter()
+        outcomes = {}
+        results = {}
+        waiting = {}
+        missing = {}
+        for ticker in tickers:
+            key = ticker.upper()
+            price = self.get(key)
+            if price is not None:
+                self.hits += 1
+                outcomes[ticker] = "hit"
+                results[ticker] = price
+            elif self.is_unknown(key):
+                self.negative_hits += 1
+                outcomes[ticker] = "unknown"
+                results[ticker] = UnknownTickerException(f"Unable to quote: ${ticker}")
+            elif key in self.inflight or key in missing:
+                self.coalesced += 1
+                outcomes[ticker] = "coalesced"
+            else:
+                self.misses += 1
+                outcomes[ticker] = "miss"
+                missing[key] = ticker
+        if missing:
+            # Start one fetch for every missing ticker, and one in-flight entry for
+            # each ticker of it that other callers can wait on
+            batch = asyncio.ensure_future(fetch(list(missing.values())))
+            for key, ticker in missing.items():
+                task = asyncio.ensure_future(self.pick(batch, ticker))
+                self.inflight[key] = task
+                task.add_done_callback(lambda task, key=key: self._complete(key, task))
+        for ticker in tickers:
+            if ticker not in results:
+                waiting[ticker] = asyncio.shield(self.inflight[ticker.upper()])
+        done = await asyncio.gather(*waiting.values(), return_exceptions=True)
+        results.update(zip(waiting, done))
+        elapsed = time.perf_counter() - started
+        for ticker, result in outcomes.items():
+            if isinstance(results[ticker], Exception) and result != "unknown":
+                result = "error"
+            metrics.observe("quonkbot_quote_seconds", elapsed, result=result)
+        return {ticker: results[ticker] for ticker in tickers}
+
+    @staticmethod
+    async def pick(batch: asyncio.Future, ticker: str) -> float:
+        prices = await asyncio.shield(batch)
+        if prices.get(ticker) is None:
+            raise UnknownTickerException(f"Unable to quote: ${ticker}")
+        return prices[ticker]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "negative_hits": self.negative_hits,
+            "size": len(self.entries),
+            "unknown": len(self.unknown),
+            "inflight": len(self.inflight),
+        }
+
+    def clear(self):
+        self.entries.clear()
+        self.unknown.clear()
+
+
+class QuoteScheduler:
+    """
+    Process-wide token bucket in front of the quote provider, allowing `rate`
+    upstream requests per second on average and bursts of up to `burst`. Cluster
+    workers wait in the owner process's scheduler, see bot.cluster.RemoteScheduler.
+
+    Requests that find the bucket empty wait in order of priority, see
+    QUOTE_PRIORITIES, so commands are served before bulk refreshes queued earlier.
+    Once `max_queue` bulk requests are waiting, further ones are shed with a
+    QuoteOverloadedException. A rate of 0 disables the limit.
+    """
+
+    def __init__(
+        self,
+        rate: float = QUOTE_RATE,
+        burst: float = QUOTE_BURST,
+        max_queue: int = QUOTE_MAX_QUEUE,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+        # Heap of [rank, order, priority, tickers, future] waiting for a token
+        self.waiting: list[list] = []
+        self.order = 0
+        self.depth = {priority: 0 for priority in QUOTE_PRIORITIES}
+        self.timer: asyncio.TimerHandle | None = None
+        self.timer_loop: asyncio.AbstractEventLoop | None = None
+        self.granted = 0
+        self.queued = 0
+        self.promoted = 0
+        self.shed = 0
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(
+        self, priority: str = "interactive", ticker: str | list[str] = ""
+    ):
+        """
+        Wait for a token to request `ticker`, or a batch of tickers, upstream at
+        `priority`.
+        """
+        tickers = [ticker] if isinstance(ticker, str) else ticker
+        started = time.perf_counter()
+        if self.rate <= 0:
+            self.granted += 1
+            return
+        # Take a token straight away when nothing is waiting for one
+        self.refill()
+        if not self.waiting and self.tokens >= 1:
+            self.tokens -= 1
+            self.granted += 1
+            metrics.observe("quonkbot_quote_wait_seconds", 0.0, priority=priority)
+            return
+        if priority != QUOTE_PRIORITIES[0] and self.depth[priority] >= self.max_queue:
+            self.shed += 1
+            metrics.inc("quonkbot_quote_shed_total", priority=priority)
+            names = ", ".join(f"${ticker}" for ticker in tickers)
+            raise QuoteOverloadedException(f"Too many quotes waiting: {names}")
+        # Otherwise, wait in the queue to be granted one by dispatch
+        future = asyncio.get_running_loop().create_future()
+        rank = QUOTE_PRIORITIES.index(priority)
+        keys = {ticker.upper() for ticker in tickers}
+        entry = [rank, self.order, priority, keys, future]
+        self.order += 1
+        heapq.heappush(self.waiting, entry)
+        self.queued += 1
+        self.update_depth(priority, 1)
+        self.schedule()
+        try:
+            await future
+        except BaseException:
+            # Leave the queue when cancelled, such as by a timeout
+            if entry in self.waiting:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                self.update_depth(entry[2], -1)
+            raise
+        self.granted += 1
+        elapsed = time.perf_counter() - started
+        metrics.observe("quonkbot_quote_wait_seconds", elapsed, priority=entry[2])
+
+    def promote(self, ticker: str, priority: str = "interactive"):
+        """
+        Move a queued request for `ticker` up to `priority`, for when a more urgent
+        caller is waiting on the same fetch.
+        """
+        rank = QUOTE_PRIORITIES.index(priority)
+        for entry in self.waiting:
+            if ticker.upper() in entry[3] and entry[0] > rank:
+                self.update_depth(entry[2], -1)
+                entry[0], entry[2] = rank, priority
+                self.update_depth(priority, 1)
+                self.promoted += 1
+        heapq.heapify(self.waiting)
+
+    def dispatch(self):
+        # Grant the tokens that have refilled to the most urgent waiters
+        self.timer = None
+        self.refill()
+        while self.waiting and self.tokens >= 1:
+            entry = heapq.heappop(self.waiting)
+            self.update_depth(entry[2], -1)
+            if not entry[4].done():
+                self.tokens -= 1
+                entry[4].set_result(None)
+        if self.waiting:
+            self.schedule()
+
+    def schedule(self):
+        # Dispatch once the next token has refilled. A timer left behind by an
+        # event loop that has since closed is replaced.
+        loop = asyncio.get_running_loop()
+        if self.timer is not None and self.timer_loop is loop:
+            return
+        self.refill()
+        delay = max((1 - self.tokens) / self.rate, 0)
+        self.timer = loop.call_later(delay, self.dispatch)
+        self.timer_loop = loop
+
+    def update_depth(self, priority: str, change: int):
+        self.depth[priority] += change
+        metrics.set(
+            "quonkbot_quote_queue_depth", self.depth[priority], priority=priority
+        )
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "granted": self.granted,
+            "queued": self.queued,
+            "promoted": self.promoted,
+            "shed": self.shed,
+            **{f"waiting_{priority}": depth for priority, depth in self.depth.items()},
+        }
+
+
+class QuoteProvider:
+    """
+    Source of current prices. Providers return None for tickers they cannot quote.
+    Providers that can quote many tickers in one request set `batched` and override
+    get_prices, otherwise batches are fanned out over get_price.
+    """
+
+    batched = False
+
+    def get_price(self, ticker: str) -> float | None:
+        raise NotImplementedError
+
+    def get_history(self, ticker: str, period: float):
+        """
+        Get a ticker's prices over the last `period` seconds, starting with the last
+        one before them, as NumPy arrays of Unix timestamps and prices.
+        """
+        raise NotImplementedError
+
+    def get_prices(self, tickers: list[str]) -> dict[str, float | None]:
+        return {ticker: self.get_price(ticker) for ticker in tickers}
+
+
+class YFinanceProvider(QuoteProvider):
+    def get_price(self, ticker: str) -> float | None:
+        # yfinance pulls in pandas and requests, so it is imported on the first
+        # live quote instead of at startup
+        import yfinance as yf
+
         yf_ticker = yf.Ticker(ticker)
-        price = yf_ticker.info.get("currentPrice")
+        return yf_ticker.info.get("currentPrice")
+
+    def get_history(self, ticker: str, period: float):
+        import numpy as np
+        import yfinance as yf
+
+        interval = "1d"
+        for span, finest in YFINANCE_INTERVALS:
+            if period <= span:
+                interval = finest
+                break
+        start = datetime.fromtimestamp(time.time() - period)
+        history = yf.Ticker(ticker).history(start=start, interval=interval)
+        if history.empty:
+            return None
+        timestamps = history.index.asi8 / 1e9
+        return timestamps, history["Close"].to_numpy(dtype=np.float64)
+
+
+class RandomProvider(QuoteProvider):
+    batched = True
+
+    def get_price(self, ticker: str) -> float | None:
+        return random.sample([100, 200], k=1)[0]
+
+    def get_history(self, ticker: str, period: float):
+        import numpy as np
+
+        # One random price a minute, the same for every call in that minute
+        now = time.time() // 60 * 60
+        timestamps = np.arange(now - period // 60 * 60, now + 1, 60, dtype=np.float64)
+        rng = np.random.default_rng([int(now), *ticker.encode()])
+        return timestamps, rng.choice([100.0, 200.0], size=len(timestamps))
+
+
+class TapeProvider(QuoteProvider):
+    """
+    Replays recorded prices from a CSV or Parquet tape with ticker, timestamp and
+    price columns. Timestamps may be timestamps or Unix seconds.
+
+    The tape is compiled once into NumPy arrays next to it (or in `cache_dir`), which
+    are memory-mapped so that long histories do not need to fit in memory. Replay
+    starts at the beginning of the tape and advances `speed` times faster than
+    `clock`. A ticker's price is its last tick at or before the replay time, and its
+    first tick before that. With `loop`, replay starts over after the last tick.
+    """
+
+    batched = True
+    # Ticks copied from the sorted tape into the arrays at a time while compiling
+    chunk_rows = 1_000_000
+
+    def __init__(
+        self,
+        path: str,
+        speed: float = 1,
+        loop: bool = False,
+        cache_dir: str | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        import numpy as np
+
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.cache_dir = cache_dir or f"{path}.npy"
+        self.clock = clock
+        if self.is_stale():
+            self.compile()
+        self.timestamps = np.load(self.cache_file("timestamps"), mmap_mode="r")
+        self.prices = np.load(self.cache_file("prices"), mmap_mode="r")
+        with open(self.cache_file("tickers", "json")) as f:
+            self.tickers: dict[str, list[int]] = json.load(f)
+        self.start = float(self.timestamps.min()) if len(self.timestamps) else 0.0
+        self.end = float(self.timestamps.max()) if len(self.timestamps) else 0.0
+        self.started = clock()
+
+    def cache_file(self, name: str, extension: str = "npy") -> str:
+        return os.path.join(self.cache_dir, f"{name}.{extension}")
+
+    def is_stale(self) -> bool:
+        index = self.cache_file("tickers", "json")
+        if not os.path.exists(index):
+            return True
+        return os.path.getmtime(index) < os.path.getmtime(self.path)
+
+    def compile(self):
+        import numpy as np
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Sort the tape into a scratch database, which DuckDB can spill to disk, then
+        # copy it into the arrays a few tickers at a time, so that compiling does not
+        # need the whole tape in memory either
+        scratch = self.cache_file("compile", "duckdb")
+        db = duckdb.connect(scratch)
+        try:
+            reader = (
+                "read_parquet" if self.path.endswith(".parquet") else "read_csv_auto"
+            )
+            source = f"{reader}(?)"
+            query = f"DESCRIBE SELECT * FROM {source}"
+            columns = {
+                column[0]: column[1]
+                for column in db.execute(query, [self.path]).fetchall()
+            }
+            if columns["timestamp"].startswith(("TIMESTAMP", "DATE")):
+                timestamp = "epoch(timestamp)"
+            else:
+                timestamp = "timestamp"
+            # Scans return the sorted rows in order without sorting them again
+            db.execute("SET preserve_insertion_order = true")
+            query = f"""
+                CREATE OR REPLACE TABLE tape AS
+                SELECT
+                    UPPER(ticker) AS ticker,
+                    CAST({timestamp} AS DOUBLE) AS timestamp,
+                    CAST(price AS DOUBLE) AS price
+                FROM {source}
+                WHERE ticker IS NOT NULL
+                ORDER BY 1, 2
+            """
+            db.execute(query, [self.path])
+            query = "SELECT ticker, COUNT(*) FROM tape GROUP BY ticker ORDER BY ticker"
+            counts = db.execute(query).fetchall()
+            size = sum(count for _, count in counts)
+            arrays = {
+                name: np.lib.format.open_memmap(
+                    self.cache_file(name), mode="w+", dtype=np.float64, shape=(size,)
+                )
+                for name in ["timestamps", "prices"]
+            }
+            # Index each ticker's contiguous range of ticks, and copy the ticks of
+            # consecutive tickers once there are at least chunk_rows of them
+            tickers = {}
+            first = start = 0
+            chunk = []
+            for name, count in counts:
+                tickers[name] = [start, start + count]
+                start += count
+                chunk.append(name)
+                if start - first < self.chunk_rows and name != counts[-1][0]:
+                    continue
+                query = "SELECT timestamp, price FROM tape WHERE ticker BETWEEN ? AND ?"
+                ticks = db.execute(query, [chunk[0], name]).fetchnumpy()
+                arrays["timestamps"][first:start] = ticks["timestamp"]
+                arrays["prices"][first:start] = ticks["price"]
+                first = start
+                chunk = []
+            for array in arrays.values():
+                array.flush()
+            del arrays
+        finally:
+            db.close()
+            for path in [scratch, f"{scratch}.wal"]:
+                if os.path.exists(path):
+                    os.remove(path)
+        # Written last, since the cache is only used once its index exists
+        with open(self.cache_file("tickers", "json"), "w") as f:
+            json.dump(tickers, f)
+
+    def replay_time(self) -> float:
+        elapsed = (self.clock() - self.started) * self.speed
+        duration = self.end - self.start
+        if self.loop and duration > 0:
+            elapsed %= duration
+        return self.start + elapsed
+
+    def get_price(self, ticker: str) -> float | None:
+        return self.get_prices([ticker])[ticker]
+
+    def get_prices(self, tickers: list[str]) -> dict[str, float | None]:
+        import numpy as np
+
+        now = self.replay_time()
+        prices = {}
+        for ticker in tickers:
+            ticks = self.tickers.get(ticker.upper())
+            if ticks is None:
+                prices[ticker] = None
+                continue
+            start, end = ticks
+            i = np.searchsorted(self.timestamps[start:end], now, side="right")
+            prices[ticker] = float(self.prices[start + max(i - 1, 0)])
+        return prices
+
+    def get_history(self, ticker: str, period: float):
+        import numpy as np
+
+        ticks = self.tickers.get(ticker.upper())
+        if ticks is None:
+            return None
+        start, end = ticks
+        timestamps = self.timestamps[start:end]
+        now = self.replay_time()
+        first = max(np.searchsorted(timestamps, now - period, side="right") - 1, 0)
+        last = max(np.searchsorted(timestamps, now, side="right"), first + 1)
+        return (
+            np.asarray(timestamps[first:last]),
+            np.asarray(self.prices[start + first : start + last]),
+        )
+
+
+def make_provider() -> QuoteProvider:
+    if GENERATE_RANDOM_STOCK_VALUES or QUOTE_PROVIDER == "random":
+        return RandomProvider()
+    elif QUOTE_PROVIDER == "tape":
+        return TapeProvider(QUOTE_TAPE, speed=QUOTE_TAPE_SPEED, loop=True)
+    elif QUOTE_PROVIDER == "yfinance":
+        return YFinanceProvider()
+    else:
+        raise ValueError(f"Unknown quote provider: {QUOTE_PROVIDER}")
+
+
+quote_cache = QuoteCache()
+quote_scheduler = QuoteScheduler()
+provider = make_provider()
+
+
+def get_stock_price(ticker: str) -> float:
+    price = provider.get_price(ticker)
     if price is None:
-        raise QuoteException(f"Unable to quote: ${ticker}")
+        raise UnknownTickerException(f"Unable to quote: ${ticker}")
     else:
         return price
+
+
+def collect_prices(results: dict[str, float | Exception]) -> dict[str, float]:
+    prices = {}
+    errors = {}
+    for ticker, result in results.items():
+        if isinstance(result, Exception):
+            errors[ticker] = result
+        else:
+            prices[ticker] = result
+    if errors:
+        raise QuoteBatchException(prices, errors)
+    return prices
+
+
+async def fetch_stock_price(
+    ticker: str, timeout: float | None = QUOTE_TIMEOUT, priority: str = "interactive"
+) -> float:
+    """
+    Quote a ticker upstream without blocking the event loop, once the quote
+    scheduler allows a request at `priority`. The fetch runs on the quote executor,
+    and only the awaiting caller is delayed by a slow response. If waiting for the
+    scheduler and the quote take longer than `timeout` seconds, a QuoteException is
+    raised. The worker thread cannot be interrupted, so it finishes in the
+    background.
+    """
+
+    async def fetch() -> float:
+        await quote_scheduler.acquire(priority, ticker)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, get_stock_price, ticker)
+
+    try:
+        return await asyncio.wait_for(fetch(), timeout)
+    except asyncio.TimeoutError:
+        raise QuoteException(f"Timed out quoting: ${ticker}")
+
+
+async def fetch_stock_prices(
+    tickers: list[str],
+    timeout: float | None = QUOTE_TIMEOUT,
+    priority: str = "interactive",
+) -> dict[str, float | None]:
+    """
+    Quote several tickers upstream in one request to a batched provider, taking a
+    single token from the quote scheduler, with the same timeout as
+    fetch_stock_price.
+    """
+
+    async def fetch() -> dict[str, float | None]:
+        await quote_scheduler.acquire(priority, tickers)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, provider.get_prices, tickers)
+
+    try:
+        return await asyncio.wait_for(fetch(), timeout)
+    except asyncio.TimeoutError:
+        names = ", ".join(f"${ticker}" for ticker in tickers)
+        raise QuoteException(f"Timed out quoting: {names}")
+
+
+async def get_stock_price_async(
+    ticker: str, timeout: float | None = QUOTE_TIMEOUT, priority: str = "interactive"
+) -> float:
+    """
+    Quote a ticker through the shared quote cache, fetching it upstream only when
+    there is no fresh entry and no fetch already in flight. Tickers missing from a
+    loaded symbol index are rejected without a fetch. Joining a fetch that is still
+    queued at a lower priority promotes it to `priority`.
+    """
+    if symbols and ticker not in symbols:
+        raise UnknownTickerException(f"Unknown ticker: ${ticker}")
+    if ticker.upper() in quote_cache.inflight:
+        quote_scheduler.promote(ticker, priority)
+    return await quote_cache.fetch(
+        ticker, lambda ticker: fetch_stock_price(ticker, timeout, priority)
+    )
+
+
+def get_stock_history(ticker: str, period: float):
+    history = provider.get_history(ticker, period)
+    if history is None or len(history[0]) == 0:
+        raise UnknownTickerException(f"Unable to quote: ${ticker}")
+    return history
+
+
+async def get_stock_history_async(
+    ticker: str, period: float, timeout: float | None = QUOTE_TIMEOUT
+):
+    """
+    Get a ticker's price history over the last `period` seconds on the quote
+    executor, see QuoteProvider.get_history. It counts against the quote
+    scheduler's rate limit like an interactive quote.
+    """
+    if symbols and ticker not in symbols:
+        raise UnknownTickerException(f"Unknown ticker: ${ticker}")
+
+    async def fetch():
+        await quote_scheduler.acquire("interactive", ticker)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, get_stock_history, ticker, period)
+
+    try:
+        return await asyncio.wait_for(fetch(), timeout)
+    except asyncio.TimeoutError:
+        raise QuoteException(f"Timed out getting the history of: ${ticker}")
+
+
+async def get_stock_prices_async(
+    tickers: list[str],
+    timeout: float | None = QUOTE_TIMEOUT,
+    priority: str = "interactive",
+) -> dict[str, float]:
+    """
+    Quote several tickers through the shared quote cache. Providers that support
+    batches are asked for every ticker that has to be fetched in one request.
+    Otherwise, such as for yfinance, which has no batch endpoint for current prices,
+    the tickers are quoted concurrently, so the batch takes as long as its slowest
+    quote. Failures are reported per ticker by raising a QuoteBatchException once
+    every quote has completed.
+    """
+    tickers = list(dict.fromkeys(tickers))
+    if not provider.batched:
+        results = await asyncio.gather(
+            *[get_stock_price_async(ticker, timeout, priority) for ticker in tickers],
+            return_exceptions=True,
+        )
+        return collect_prices(dict(zip(tickers, results)))
+    results = {}
+    if symbols:
+        for ticker in tickers:
+            if ticker not in symbols:
+                results[ticker] = UnknownTickerException(f"Unknown ticker: ${ticker}")
+    quoted = [ticker for ticker in tickers if ticker not in results]
+    for ticker in quoted:
+        if ticker.upper() in quote_cache.inflight:
+            quote_scheduler.promote(ticker, priority)
+    results.update(
+        await quote_cache.fetch_many(
+            quoted, lambda tickers: fetch_stock_prices(tickers, timeout, priority)
+        )
+    )
+    return collect_prices({ticker: results[ticker] for ticker in tickers})
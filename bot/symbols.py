@@ -0,0 +1,62 @@
+import os
+import re
+from bisect import bisect_left
+
+SYMBOLS_PATH = os.getenv("SYMBOLS_PATH")
+
+SYMBOL = re.compile(r"^[A-Z0-9.\-^=]{1,12}$")
+
+
+class SymbolIndex:
+    """
+    Directory of ticker symbols and their names, held as parallel sorted lists so
+    that lookups and prefix searches are binary searches. An empty index knows no
+    symbols, and is treated as not loaded rather than as rejecting every ticker.
+    """
+
+    def __init__(self, symbols: dict[str, str]):
+        pairs = sorted((symbol.upper(), name) for symbol, name in symbols.items())
+        self.symbols = [symbol for symbol, _ in pairs]
+        self.names = [name for _, name in pairs]
+
+    @classmethod
+    def load(cls, path: str) -> "SymbolIndex":
+        """
+        Load a symbol directory with one symbol per line, optionally followed by its
+        name after a `|`, `,` or tab, such as the NASDAQ Trader symbol files. Header
+        and footer lines are skipped.
+        """
+        symbols = {}
+        with open(path) as f:
+            for line in f:
+                fields = re.split(r"[|,\t]", line.strip(), maxsplit=2)
+                symbol = fields[0].strip().upper()
+                if symbol in ("SYMBOL", "TICKER") or not SYMBOL.match(symbol):
+                    continue
+                symbols[symbol] = fields[1].strip() if len(fields) > 1 else ""
+        return cls(symbols)
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+    def __contains__(self, ticker: str) -> bool:
+        ticker = ticker.upper()
+        i = bisect_left(self.symbols, ticker)
+        return i < len(self.symbols) and self.symbols[i] == ticker
+
+    def search(self, prefix: str, limit: int = 25) -> list[tuple[str, str]]:
+        """
+        Get up to `limit` symbols starting with `prefix`, with their names.
+        """
+        prefix = prefix.strip().upper()
+        matches = []
+        i = bisect_left(self.symbols, prefix)
+        while i < len(self.symbols) and len(matches) < limit:
+            if not self.symbols[i].startswith(prefix):
+                break
+            matches.append((self.symbols[i], self.names[i]))
+            i += 1
+        return matches
+
+
+symbols = SymbolIndex.load(SYMBOLS_PATH) if SYMBOLS_PATH else SymbolIndex({})
@@ -0,0 +1,53 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask:
+    """
+    Background task that calls `run_cycle` forever, waiting `delay()` seconds after
+    each cycle, or before it when `wait_first` is set. Failed cycles are logged
+    with `failure_message` and counted in `failures`, which resets on success.
+    """
+
+    wait_first = False
+    failure_message = "Periodic task failed"
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.failures = 0
+        self.task: asyncio.Task | None = None
+
+    async def run_cycle(self):
+        raise NotImplementedError
+
+    def delay(self) -> float:
+        return self.interval
+
+    async def run(self):
+        while True:
+            if self.wait_first:
+                await asyncio.sleep(self.delay())
+            try:
+                await self.run_cycle()
+                self.failures = 0
+            except Exception:
+                self.failures += 1
+                logger.exception(self.failure_message)
+            if not self.wait_first:
+                await asyncio.sleep(self.delay())
+
+    def start(self) -> asyncio.Task:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
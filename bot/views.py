@@ -0,0 +1,113 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+VIEW_TTL = float(os.getenv("VIEW_TTL", 15))
+VIEW_CACHE_SIZE = int(os.getenv("VIEW_CACHE_SIZE", 1024))
+
+
+class ViewCache:
+    """
+    Cache of rendered views per member, under a key such as their guild and member
+    id. A view is keyed by the member and by the version of their holdings it was
+    built from, and is reused until it is older than `ttl`, the window in which
+    prices are considered unchanged. Commands that change a member's holdings must
+    call invalidate.
+
+    Requests that arrive while a member's view is being built share that build
+    instead of starting their own.
+    """
+
+    def __init__(
+        self,
+        ttl: float = VIEW_TTL,
+        max_size: int = VIEW_CACHE_SIZE,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self.views: OrderedDict[Hashable, tuple[int, float, Any]] = OrderedDict()
+        self.versions: dict[Hashable, int] = {}
+        self.inflight: dict[tuple[Hashable, int], asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def invalidate(self, key: Hashable):
+        self.views.pop(key, None)
+        # Versions only tell apart views built before and after a change, so they
+        # are only kept while a view is cached or being built, see forget
+        if self.building(key):
+            self.versions[key] = self.versions.get(key, 0) + 1
+        else:
+            self.versions.pop(key, None)
+
+    def building(self, key: Hashable) -> bool:
+        return any(flight[0] == key for flight in self.inflight)
+
+    def forget(self, key: Hashable):
+        # Drop the version of a key with no view cached or being built, so that
+        # versions are bounded along with the views
+        if key not in self.views and not self.building(key):
+            self.versions.pop(key, None)
+
+    def get(self, key: Hashable) -> Any | None:
+        entry = self.views.get(key)
+        if entry is None:
+            return None
+        version, built_at, view = entry
+        if version != self.versions.get(key, 0):
+            return None
+        if self.clock() - built_at >= self.ttl:
+            return None
+        self.views.move_to_end(key)
+        return view
+
+    def put(self, key: Hashable, version: int, built_at: float, view: Any):
+        # Drop views built from holdings that changed during the build
+        if version != self.versions.get(key, 0):
+            return
+        self.views[key] = (version, built_at, view)
+        self.views.move_to_end(key)
+        while len(self.views) > self.max_size:
+            evicted, _ = self.views.popitem(last=False)
+            self.forget(evicted)
+
+    async def fetch(self, key: Hashable, build: Callable[[], Awaitable[Any]]) -> Any:
+        view = self.get(key)
+        if view is not None:
+            self.hits += 1
+            return view
+        flight = (key, self.versions.get(key, 0))
+        task = self.inflight.get(flight)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+        self.misses += 1
+        built_at = self.clock()
+        task = asyncio.ensure_future(build())
+        self.inflight[flight] = task
+        task.add_done_callback(lambda task: self._complete(flight, built_at, task))
+        return await asyncio.shield(task)
+
+    def _complete(
+        self, flight: tuple[Hashable, int], built_at: float, task: asyncio.Future
+    ):
+        del self.inflight[flight]
+        key, version = flight
+        if not task.cancelled() and task.exception() is None:
+            self.put(key, version, built_at, task.result())
+        self.forget(key)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "size": len(self.views),
+            "versions": len(self.versions),
+            "inflight": len(self.inflight),
+        }
@@ -0,0 +1,69 @@
+import time
+import numpy as np
+from bot.backtest import backtest, backtest_history, resample
+from bot.database import Database
+from bot.money import to_micros
+
+
+def observe_sql(prices: list[int], cadence: int, shares: int) -> int:
+    """
+    What the database earns buying at the first price, observing every `cadence`
+    prices and selling at the last one.
+    """
+    db = Database("db/test.db", fixed_point=True)
+    try:
+        db.register_user(0)
+        db.buy_quonks(0, "T", shares, prices[0])
+        for price in prices[cadence:-1:cadence]:
+            db.observe_price(0, "T", price)
+        db.sell_quonks(0, "T", shares, prices[-1])
+        return db.get_cash(0) - to_micros(Database.STARTING_CASH)
+    finally:
+        db.clear()
+        db.close()
+
+
+class TestBacktest:
+    def test_backtest(self):
+        prices = np.array([[10, 12, 9, 9, 15], [1, 1, 1, 1, 1]])
+        assert backtest(prices, [1, 2, 3]).tolist() == [[11, 7, 7], [0, 0, 0]]
+        assert backtest(prices[0], [4], shares=3).tolist() == [[15]]
+
+    def test_matches_database(self):
+        rng = np.random.default_rng(0)
+        prices = rng.integers(to_micros(5), to_micros(50), size=(2, 41))
+        cadences = [1, 3, 40]
+        earned = backtest(prices, cadences, shares=4)
+        for ticker in range(2):
+            path = [int(price) for price in prices[ticker]]
+            expected = [observe_sql(path, cadence, 4) for cadence in cadences]
+            assert earned[ticker].tolist() == expected
+
+    def test_resample(self):
+        timestamps = np.array([10.0, 20.0, 35.0])
+        prices = np.array([1.0, 2.0, 3.0])
+        assert resample(timestamps, prices, 0, 10, 5).tolist() == [1, 1, 2, 2, 3]
+
+    def test_backtest_history(self):
+        # An hour of minute prices alternating between $10 and $11
+        timestamps = np.arange(0, 3601, 60, dtype=np.float64)
+        prices = np.where(np.arange(61) % 2, 11.0, 10.0)
+        earned = backtest_history(timestamps, prices, shares=2)
+        assert earned == {
+            "minute": to_micros(2 * 60),
+            "5 minutes": to_micros(2 * 12),
+            "hour": 0,
+            "day": 0,
+        }
+        # Cadences finer than the history are left out
+        earned = backtest_history(timestamps[::5], prices[::5])
+        assert list(earned) == ["5 minutes", "hour", "day"]
+
+    def test_years_of_minutes(self):
+        timestamps = np.arange(0, 2 * 365 * 86400, 60, dtype=np.float64)
+        rng = np.random.default_rng(0)
+        prices = 100 + np.cumsum(rng.normal(0, 0.01, len(timestamps)))
+        start = time.perf_counter()
+        earned = backtest_history(timestamps, prices)
+        assert time.perf_counter() - start < 1
+        assert earned["minute"] > earned["hour"] > earned["day"] > 0
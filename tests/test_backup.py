@@ -0,0 +1,35 @@
+import asyncio
+import json
+from bot.backup import Checkpointer, main
+from bot.database import Database
+
+
+class FakePool:
+    def __init__(self):
+        self.calls = []
+
+    async def checkpoint(self):
+        self.calls.append("checkpoint")
+
+    async def backup(self, directory: str):
+        self.calls.append(("backup", directory))
+
+
+class TestCheckpointer:
+    def test_run_cycle(self):
+        pool = FakePool()
+        asyncio.run(Checkpointer(pool, backup_dir=None).run_cycle())
+        assert pool.calls == ["checkpoint"]
+        asyncio.run(Checkpointer(pool, backup_dir="backups").run_cycle())
+        assert pool.calls[1:] == ["checkpoint", ("backup", "backups")]
+
+
+def test_main(tmp_path, capsys):
+    db = Database(str(tmp_path / "1.db"), fixed_point=True)
+    db.register_user(0)
+    db.close()
+    bundle = str(tmp_path / "bundle")
+    assert main(["save", str(tmp_path / "1.db"), bundle])["rows"]["MEMBERS"] == 1
+    report = main(["restore", bundle, str(tmp_path / "2.db")])
+    assert report["rows"] == {"MEMBERS": 1, "CASH": 1, "HOLDINGS": 0}
+    assert json.loads(capsys.readouterr().out.splitlines()[-1]) == report
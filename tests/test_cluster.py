@@ -0,0 +1,149 @@
+import asyncio
+import multiprocessing
+import os
+import pytest
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+import bot.stocks
+from bot.cluster import (
+    DatabaseServer,
+    join,
+    RemoteException,
+    RemotePool,
+    RemoteScheduler,
+    shards,
+)
+from bot.database import DatabasePool, Holding, NotEnoughCashException
+from bot.stocks import QuoteOverloadedException, QuoteScheduler
+
+
+def run(tmp_path, client):
+    """
+    Run a client coroutine against a database server on a socket in tmp_path.
+    """
+    pool = DatabasePool(str(tmp_path), fixed_point=True)
+    server = DatabaseServer(pool, str(tmp_path / "cluster.sock"))
+    remote = RemotePool(server.path)
+
+    async def main():
+        await server.start()
+        try:
+            return await client(remote)
+        finally:
+            remote.close()
+            await server.close()
+
+    try:
+        return asyncio.run(main()), server
+    finally:
+        pool.close()
+
+
+class TestCluster:
+    def test_calls(self, tmp_path):
+        async def client(remote: RemotePool):
+            async with remote.acquire(1) as db:
+                await db.register_user(0)
+                await db.buy_quonks(0, "ABC", 2, 10_000_000)
+                return await db.get_holdings(0), await db.get_cash(0)
+
+        (holdings, cash), _ = run(tmp_path, client)
+        assert holdings == [Holding(0, "ABC", 2, 10_000_000, 20_000_000)]
+        assert cash == 9980_000_000
+
+    def test_exceptions(self, tmp_path):
+        async def client(remote: RemotePool):
+            async with remote.acquire(1) as db:
+                await db.register_user(0)
+                with pytest.raises(NotEnoughCashException, match="buy 1 shares"):
+                    await db.buy_quonks(0, "ABC", 2, 6000_000_000)
+                with pytest.raises(RemoteException, match="Not a remote method"):
+                    await db.clear()
+
+        run(tmp_path, client)
+
+    def test_concurrent_calls(self, tmp_path):
+        async def client(remote: RemotePool):
+            async def register(guild_id: int, member_id: int):
+                async with remote.acquire(guild_id) as db:
+                    await db.register_user(member_id)
+                    return await db.get_cash(member_id)
+
+            return await asyncio.gather(
+                *[
+                    register(guild_id, member_id)
+                    for guild_id in range(3)
+                    for member_id in range(20)
+                ]
+            )
+
+        cash, server = run(tmp_path, client)
+        assert cash == [10000_000_000] * 60
+        assert server.requests == 120
+
+    def test_remote_scheduler(self, tmp_path, monkeypatch):
+        # The owner's bucket never refills, and sheds bulk quotes instead of
+        # queueing them
+        scheduler = QuoteScheduler(rate=1, burst=2, max_queue=0, clock=lambda: 0)
+        monkeypatch.setattr(bot.stocks, "quote_scheduler", scheduler)
+
+        async def client(remote: RemotePool):
+            quotes = RemoteScheduler(remote)
+            await quotes.acquire("interactive", "ABC")
+            await quotes.acquire("bulk", ["ABC", "XYZ"])
+            with pytest.raises(QuoteOverloadedException, match="XYZ"):
+                await quotes.acquire("bulk", ["XYZ"])
+
+        run(tmp_path, client)
+        assert scheduler.stats()["granted"] == 2
+        assert scheduler.stats()["shed"] == 1
+
+    def test_socket(self, tmp_path):
+        pool = DatabasePool(str(tmp_path), fixed_point=True)
+        path = tmp_path / "cluster.sock"
+
+        async def main():
+            path.write_text("not a socket")
+            with pytest.raises(FileExistsError):
+                await DatabaseServer(pool, str(path)).start()
+            path.unlink()
+            server = DatabaseServer(pool, str(path))
+            await server.start()
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+            await server.close()
+            # A socket left behind is replaced
+            await server.start()
+            await server.close()
+            return mode
+
+        try:
+            assert asyncio.run(main()) == 0o600
+        finally:
+            pool.close()
+
+    def test_join(self):
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=time.sleep, args=(0.2,)) for _ in range(3)]
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            loop.set_default_executor(ThreadPoolExecutor(max_workers=1))
+            for process in processes:
+                process.start()
+            joined = asyncio.create_task(join(processes))
+            await asyncio.sleep(0)
+            # The executor stays free while the processes run
+            await asyncio.wait_for(loop.run_in_executor(None, int), timeout=0.1)
+            assert not joined.done()
+            await joined
+
+        asyncio.run(main())
+        assert [process.exitcode for process in processes] == [0, 0, 0]
+
+    def test_shards(self):
+        assert [shards(index, 3, 8) for index in range(3)] == [
+            [0, 3, 6],
+            [1, 4, 7],
+            [2, 5],
+        ]
@@ -1,11 +1,21 @@
+import asyncio
+import duckdb
+import os
+import threading
+import time
+from datetime import datetime, timedelta
 import pytest
 from bot.database import (
+    AsyncDatabase,
     Database,
+    DatabaseNotEmptyException,
+    DatabasePool,
     InvalidSharesException,
     NotEnoughCashException,
     UserDoesNotExistException,
     UserExistsException,
 )
+from bot.money import MICROS, to_micros
 
 EPSILON = 1e-10
 
@@ -80,16 +90,68 @@ class TestDatabase:
         assert next(holdings).ticker == "ABC"
         assert next(holdings).ticker == "XYZ"
 
-    def test_observe_price(self, db: Database):
+    def test_get_holding_snapshot(self, db: Database):
         db.register_user(0)
+        assert db.get_holding(0, "ABC") is None
         db.buy_quonks(0, "ABC", 10, 10)
         holding = db.get_holding(0, "ABC")
+        with pytest.raises(AttributeError):
+            holding.shares = 20
+        # Snapshots do not change after they are read
+        db.observe_price(0, "ABC", 20)
+        assert holding.value == 100
+        assert db.get_holding(0, "ABC").value == 200
+
+    def test_get_holdings_live(self, db: Database):
+        db.register_user(0)
+        db.buy_quonks(0, "ABC", 10, 10)
+        holding = next(db.get_holdings(0, live=True))
+        db.observe_price(0, "ABC", 20)
+        assert holding.value == 200
+
+    def test_observe_price(self, db: Database):
+        db.register_user(0)
+        db.buy_quonks(0, "ABC", 10, 10)
+        holding = db.get_holding(0, "ABC", live=True)
         assert holding.value == 100  # 10 x 10
         db.observe_price(0, "ABC", 20)
         assert holding.value == 200  # 100 + (10 x +10)
         db.observe_price(0, "ABC", 10)
         assert holding.value == 300  # 200 + (10 x abs(-10))
 
+    def test_observe_prices(self, db: Database):
+        db.register_user(0)
+        db.register_user(1)
+        db.buy_quonks(0, "ABC", 10, 10)
+        db.buy_quonks(0, "XYZ", 5, 10)
+        db.buy_quonks(1, "ABC", 1, 10)
+        db.observe_prices(0, {"ABC": 20, "XYZ": 5})
+        assert db.get_holding(0, "ABC").value == 200  # 100 + (10 x +10)
+        assert db.get_holding(0, "XYZ").value == 75  # 50 + (5 x abs(-5))
+        assert db.get_holding(1, "ABC").value == 10  # Not observed
+
+    def test_get_observed_holdings(self, db: Database):
+        db.register_user(0)
+        db.buy_quonks(0, "ABC", 10, 10)
+        # XYZ was bought after the prices were fetched
+        db.buy_quonks(0, "XYZ", 5, 10)
+        holdings = db.get_observed_holdings(0, {"ABC": 20})
+        assert [(h.ticker, h.price, h.value) for h in holdings] == [
+            ("ABC", 20, 200),
+            ("XYZ", 10, 50),
+        ]
+
+    def test_observe_all(self, db: Database):
+        db.register_user(0)
+        db.register_user(1)
+        db.buy_quonks(0, "ABC", 10, 10)
+        db.buy_quonks(1, "ABC", 1, 10)
+        db.buy_quonks(1, "XYZ", 1, 10)
+        db.observe_all({"ABC": 20})
+        assert db.get_holding(0, "ABC").value == 200
+        assert db.get_holding(1, "ABC").value == 20
+        assert db.get_holding(1, "XYZ").value == 10
+
     def test_buy_quonks(self, db: Database):
         db.register_user(0)
         db.buy_quonks(0, "ABC", 5, 1000)
@@ -98,6 +160,18 @@ class TestDatabase:
         with pytest.raises(NotEnoughCashException):
             assert db.buy_quonks(0, "ABC", 10000, 10000)
 
+    def test_buy_quonks_rejected(self, db: Database):
+        db.register_user(0)
+        db.buy_quonks(0, "ABC", 5, 1000)
+        with pytest.raises(NotEnoughCashException, match="only have enough to buy 5"):
+            db.buy_quonks(0, "ABC", 6, 1000)
+        # The rejected buy leaves cash and holdings untouched
+        assert db.get_cash(0) == 5000
+        assert db.get_holding(0, "ABC").shares == 5
+        # Spending the exact balance is allowed
+        db.buy_quonks(0, "ABC", 5, 1000)
+        assert db.get_cash(0) == 0
+
     def test_sell_quonks(self, db: Database):
         db.register_user(0)
         assert db.get_cash(0) == 10000
@@ -118,3 +192,662 @@ class TestDatabase:
         assert db.get_shares(0, "ABC") == 10
         db.delete_holdings(0, "ABC")
         assert db.get_shares(0, "ABC") == 0
+
+    def test_sell_quonks_rejected(self, db: Database):
+        db.register_user(0)
+        db.buy_quonks(0, "ABC", 5, 1000)
+        with pytest.raises(InvalidSharesException):
+            db.sell_quonks(0, "ABC", 6, 2000)
+        # The rejected sale does not observe the selling price
+        holding = db.get_holding(0, "ABC")
+        assert holding.price == 1000
+        assert holding.value == 5000
+
+    def test_leaderboard(self, db: Database):
+        db.register_user(0)
+        db.register_user(1)
+        db.register_user(2)
+        # Buying converts cash to an equal Quonk value
+        db.buy_quonks(0, "ABC", 10, 10)
+        assert [leader.value for leader in db.leaderboard()] == [10000] * 3
+        # Observation increases value, and selling realizes it as cash
+        db.observe_price(0, "ABC", 20)
+        db.buy_quonks(1, "ABC", 10, 10)
+        db.sell_quonks(1, "ABC", 10, 15)
+        leaders = [(leader.member_id, leader.value) for leader in db.leaderboard()]
+        assert leaders == [(0, 10100), (1, 10050), (2, 10000)]
+
+    def test_rebuild_totals(self, db: Database):
+        db.register_user(0)
+        db.register_user(1)
+        db.buy_quonks(0, "ABC", 7, 13)
+        db.buy_quonks(0, "XYZ", 3, 21)
+        db.observe_prices(0, {"ABC": 17, "XYZ": 19})
+        db.sell_quonks(0, "ABC", 3, 11)
+        db.sell_quonks(0, "XYZ", 3, 23)
+        db.add_cash(1, 5)
+        # Maintained totals match the base tables
+        assert db.rebuild_totals() == 0
+        # Drift is detected and corrected
+        db.db.execute("UPDATE TOTALS SET total = 0 WHERE id = 1")
+        assert db.rebuild_totals() == 1
+        leaders = {leader.member_id: leader.value for leader in db.leaderboard()}
+        assert leaders[1] == 10005
+
+
+@pytest.fixture()
+def fixed_db():
+    db = Database("db/test.db", fixed_point=True)
+    yield db
+    db.clear()
+
+
+class TestFixedPoint:
+    def test_register_user(self, fixed_db: Database):
+        fixed_db.register_user(0)
+        assert fixed_db.get_cash(0) == to_micros(10000)
+        assert isinstance(fixed_db.get_cash(0), int)
+
+    def test_add_cash(self, fixed_db: Database):
+        fixed_db.register_user(0)
+        # A thousand cents add up exactly
+        for _ in range(1000):
+            fixed_db.add_cash(0, to_micros(0.01))
+        assert fixed_db.get_cash(0) == to_micros(10010)
+        assert next(fixed_db.leaderboard()).value == to_micros(10010)
+
+    def test_observe_price(self, fixed_db: Database):
+        fixed_db.register_user(0)
+        fixed_db.buy_quonks(0, "ABC", 3, to_micros(0.1))
+        for price in [0.2, 0.1] * 100:
+            fixed_db.observe_price(0, "ABC", to_micros(price))
+        holding = fixed_db.get_holding(0, "ABC")
+        assert holding.price == to_micros(0.1)
+        assert holding.value == to_micros(0.3) + 200 * 3 * to_micros(0.1)
+
+    def test_buy_and_sell(self, fixed_db: Database):
+        fixed_db.register_user(0)
+        with pytest.raises(NotEnoughCashException, match="buy 3333 shares"):
+            fixed_db.buy_quonks(0, "ABC", 4000, to_micros(3))
+        fixed_db.buy_quonks(0, "ABC", 3, to_micros(10))
+        fixed_db.observe_price(0, "ABC", to_micros(11))
+        # Value per Quonk is truncated to the micro-dollar
+        assert fixed_db.sell_quonks(0, "ABC", 1, to_micros(11)) == 11_000_000
+        fixed_db.sell_quonks(0, "ABC", 2, to_micros(11))
+        assert fixed_db.get_cash(0) == to_micros(10003)
+        assert fixed_db.rebuild_totals() == 0
+
+    def test_convert(self):
+        db = Database("db/test.db")
+        db.register_user(0)
+        db.buy_quonks(0, "ABC", 3, 10.123456)
+        db.record_prices({"ABC": 10.5})
+        db.close()
+        # Money columns are converted when opened in fixed point mode, and back
+        db = Database("db/test.db", fixed_point=True)
+        assert db.get_cash(0) == 10000_000000 - 30_370368
+        assert db.get_holding(0, "ABC").value == 30_370368
+        assert db.get_price("ABC", 60) == 10_500000
+        assert db.rebuild_totals() == 0
+        db.close()
+        db = Database("db/test.db")
+        assert db.get_cash(0) == 10000 - 30.370368
+        assert db.get_price("ABC", 60) == 10.5
+        db.clear()
+        db.close()
+
+
+class TestHistory:
+    def test_record_history(self, fixed_db: Database):
+        fixed_db.register_user(0)
+        fixed_db.register_user(1)
+        start = datetime(2026, 1, 1)
+        for minute in range(120):
+            fixed_db.add_cash(0, 1 if minute % 2 else -1)
+            fixed_db.record_history(start + timedelta(minutes=minute))
+        # One bulk snapshot per cycle, folded into each resolution
+        query = "SELECT COUNT(*) FROM SNAPSHOTS"
+        assert fixed_db.db.execute(query).fetchone()[0] == 240
+        query = """
+            SELECT bucket, low, high, last
+            FROM ROLLUPS
+            WHERE resolution = 3600 AND id = 0
+            ORDER BY bucket
+        """
+        cash = to_micros(10000)
+        assert fixed_db.db.execute(query).fetchall() == [
+            (start, cash - 1, cash, cash),
+            (start + timedelta(hours=1), cash - 1, cash, cash),
+        ]
+
+    def test_retention(self, fixed_db: Database):
+        fixed_db.register_user(0)
+        fixed_db.retention = {"snapshot": 1, "minute": 2, "hour": 0, "day": 0}
+        start = datetime(2026, 1, 1)
+        for day in range(5):
+            fixed_db.record_history(start + timedelta(days=day))
+        query = "SELECT MIN(at) FROM SNAPSHOTS"
+        assert fixed_db.db.execute(query).fetchone()[0] == start + timedelta(days=3)
+        query = "SELECT resolution, COUNT(*) FROM ROLLUPS GROUP BY ALL ORDER BY ALL"
+        assert fixed_db.db.execute(query).fetchall() == [(60, 3), (3600, 5), (86400, 5)]
+
+    def test_get_history(self, fixed_db: Database):
+        fixed_db.register_user(0)
+        start = datetime(2026, 1, 1)
+        for hour in range(48):
+            fixed_db.add_cash(0, to_micros(1))
+            fixed_db.record_history(start + timedelta(hours=hour))
+        now = start + timedelta(days=2)
+        points = fixed_db.get_history(0, timedelta(days=2), 4, now)
+        assert [point.at for point in points] == [
+            start + timedelta(hours=hours) for hours in [0, 12, 24, 36]
+        ]
+        assert [point.value for point in points] == [
+            to_micros(10000 + hours) for hours in [12, 24, 36, 48]
+        ]
+        assert points[0].low == to_micros(10001)
+        # Members without history have an empty series
+        assert fixed_db.get_history(1, timedelta(days=2), 4, now) == []
+
+    def test_get_history_retained(self, fixed_db: Database):
+        fixed_db.register_user(0)
+        fixed_db.retention = {"snapshot": 1, "minute": 1, "hour": 0, "day": 0}
+        start = datetime(2026, 1, 1)
+        for hour in range(48):
+            fixed_db.add_cash(0, to_micros(1))
+            fixed_db.record_history(start + timedelta(hours=hour))
+        now = start + timedelta(days=2)
+        # Minutes are fine enough for 100 points over two days, but only one day of
+        # them is kept, so the hours are used
+        points = fixed_db.get_history(0, timedelta(days=2), 100, now)
+        assert len(points) == 48
+        assert points[0].at == start
+
+
+def trade(db: Database):
+    m = to_micros if db.fixed_point else float
+    db.register_user(0)
+    db.register_user(1)
+    db.buy_quonks(0, "A", 3, m(10))
+    db.buy_quonks(1, "A", 2, m(11))
+    db.buy_quonks(0, "B", 1, m(5))
+    db.observe_all({"A": m(12), "B": m(4)})
+    db.observe_prices(1, {"A": m(12.5)})
+    db.sell_quonks(0, "A", 1, m(13))
+    db.sell_quonks(1, "A", 2, m(9))
+    db.add_cash(0, m(7.5))
+    db.buy_quonks(1, "A", 1, m(9.5))
+
+
+class TestLedger:
+    def test_record_ledger(self, fixed_db: Database):
+        trade(fixed_db)
+        query = "SELECT id, side, ticker, shares FROM TRADES ORDER BY seq"
+        assert fixed_db.db.execute(query).fetchall() == [
+            (0, "register", None, None),
+            (1, "register", None, None),
+            (0, "buy", "A", 3),
+            (1, "buy", "A", 2),
+            (0, "buy", "B", 1),
+            (0, "sell", "A", 1),
+            (1, "sell", "A", 2),
+            (1, "close", "A", None),
+            (0, "deposit", None, None),
+            (1, "buy", "A", 1),
+        ]
+        # Observing prices that have not changed records nothing
+        query = "SELECT COUNT(*) FROM OBSERVATIONS"
+        count = fixed_db.db.execute(query).fetchone()[0]
+        fixed_db.observe_prices(1, {"A": to_micros(9.5)})
+        assert fixed_db.db.execute(query).fetchone()[0] == count
+        # Rejected trades leave no record
+        with pytest.raises(InvalidSharesException):
+            fixed_db.sell_quonks(0, "A", 10, to_micros(9))
+        query = "SELECT COUNT(*) FROM TRADES"
+        assert fixed_db.db.execute(query).fetchone()[0] == 10
+
+    @pytest.mark.parametrize("fixed_point", [False, True])
+    def test_replay_ledger(self, fixed_point: bool):
+        db = Database("db/test.db", fixed_point=fixed_point)
+        try:
+            trade(db)
+            holdings = list(db.get_holdings(0)) + list(db.get_holdings(1))
+            cash = [db.get_cash(0), db.get_cash(1)]
+            assert db.replay_ledger(dry_run=True) == 0
+            db.db.execute("UPDATE CASH SET cash = cash + 1 WHERE id = 0")
+            db.db.execute("DELETE FROM HOLDINGS WHERE id = 1")
+            db.db.execute("UPDATE HOLDINGS SET shares = 2 WHERE ticker = 'B'")
+            assert db.replay_ledger(dry_run=True) == 3
+            assert db.get_cash(0) != cash[0]
+            assert db.replay_ledger() == 3
+            assert list(db.get_holdings(0)) + list(db.get_holdings(1)) == holdings
+            assert [db.get_cash(0), db.get_cash(1)] == cash
+            assert db.replay_ledger() == 0
+            assert db.rebuild_totals() == 0
+        finally:
+            db.clear()
+            db.close()
+
+    def test_open_ledger(self, fixed_db: Database):
+        # Balances from before the ledger are carried in as opening trades
+        trade(fixed_db)
+        fixed_db.db.execute("DELETE FROM TRADES")
+        fixed_db.db.execute("DELETE FROM OBSERVATIONS")
+        fixed_db.open_ledger()
+        query = "SELECT side, COUNT(*) FROM TRADES GROUP BY ALL"
+        assert fixed_db.db.execute(query).fetchall() == [("open", 5)]
+        fixed_db.buy_quonks(1, "B", 1, to_micros(6))
+        assert fixed_db.replay_ledger(dry_run=True) == 0
+
+    def test_export_ledger(self, fixed_db: Database, tmp_path):
+        trade(fixed_db)
+        fixed_db.db.execute("UPDATE TRADES SET at = '2026-01-01' WHERE seq < 5")
+        directory = str(tmp_path)
+        exported = fixed_db.export_ledger(directory)
+        assert exported == {"TRADES": 10, "OBSERVATIONS": 6}
+        assert sorted(os.listdir(tmp_path / "trades"))[0] == "day=2026-01-01"
+        query = f"""
+            SELECT side, COUNT(*)
+            FROM read_parquet('{directory}/trades/*/*.parquet', hive_partitioning = true)
+            WHERE day = '2026-01-01'
+            GROUP BY ALL
+            ORDER BY ALL
+        """
+        assert fixed_db.db.execute(query).fetchall() == [("buy", 2), ("register", 2)]
+        # Exporting from a day on rewrites only that day's partitions
+        exported = fixed_db.export_ledger(directory, datetime.now().date())
+        assert exported == {"TRADES": 6, "OBSERVATIONS": 6}
+        query = f"SELECT COUNT(*) FROM '{directory}/trades/*/*.parquet'"
+        assert fixed_db.db.execute(query).fetchone()[0] == 10
+
+
+class TestMigrations:
+    def test_upgrade_in_place(self, tmp_path):
+        # A database from before HOLDINGS was keyed, with duplicate holdings
+        path = str(tmp_path / "old.db")
+        old = duckdb.connect(path)
+        old.execute("CREATE TABLE MEMBERS (id BIGINT PRIMARY KEY)")
+        old.execute("CREATE TABLE CASH (id BIGINT PRIMARY KEY, cash DECIMAL(18, 6))")
+        old.execute(
+            """
+            CREATE TABLE HOLDINGS (
+                id BIGINT,
+                ticker VARCHAR,
+                shares INTEGER,
+                price DECIMAL(18, 6),
+                value DECIMAL(18, 6)
+            )
+        """
+        )
+        old.execute("INSERT INTO MEMBERS VALUES (0)")
+        old.execute("INSERT INTO CASH VALUES (0, 9000)")
+        old.execute(
+            """
+            INSERT INTO HOLDINGS VALUES
+                (0, 'ABC', 2, 10, 20.5),
+                (0, 'ABC', 3, 10, 30.25),
+                (0, 'XYZ', 1, 5, 5)
+        """
+        )
+        old.close()
+        db = Database(path, fixed_point=True)
+        assert db.get_shares(0, "ABC") == 5
+        assert db.get_holding(0, "ABC").value == to_micros(50.75)
+        assert list(db.leaderboard())[0].value == to_micros(9000 + 50.75 + 5)
+        query = "SELECT version, name FROM MIGRATIONS"
+        assert db.db.execute(query).fetchall() == [(1, "key_holdings")]
+        query = "SELECT index_name FROM duckdb_indexes() WHERE table_name = 'HOLDINGS'"
+        assert db.db.execute(query).fetchall() == []
+        with pytest.raises(duckdb.ConstraintException):
+            db.db.execute("INSERT INTO HOLDINGS VALUES (0, 'XYZ', 1, 1, 1)")
+        # The merged holdings open the ledger
+        assert db.replay_ledger(dry_run=True) == 0
+        db.close()
+        # Migrations are applied once, and survive converting money back
+        db = Database(path)
+        query = "SELECT COUNT(*) FROM MIGRATIONS"
+        assert db.db.execute(query).fetchone()[0] == 1
+        assert db.get_holding(0, "ABC").value == 50.75
+        db.close()
+
+    def test_lookups_after_checkpoint(self, fixed_db: Database):
+        query = """
+            INSERT INTO HOLDINGS
+            SELECT m.range, 'T' || t.range, 1, 1, 1 FROM range(1000) m, range(10) t
+        """
+        fixed_db.db.execute(query)
+        fixed_db.checkpoint()
+        query = "SELECT COUNT(*) FROM HOLDINGS WHERE id = ?"
+        for member_id in range(1000):
+            assert fixed_db.db.execute(query, [member_id]).fetchone()[0] == 10
+
+    def test_new_database(self, fixed_db: Database):
+        # New databases record the migrations without running them
+        query = "SELECT MAX(version), MAX(seconds) FROM MIGRATIONS"
+        assert fixed_db.db.execute(query).fetchone() == (len(Database.MIGRATIONS), 0)
+        fixed_db.register_user(0)
+        fixed_db.buy_quonks(0, "ABC", 2, to_micros(10))
+        fixed_db.buy_quonks(0, "ABC", 1, to_micros(10))
+        assert fixed_db.get_shares(0, "ABC") == 3
+        assert fixed_db.sell_quonks(0, "ABC", 1, to_micros(11)) == to_micros(11)
+        assert fixed_db.get_shares(0, "ABC") == 2
+        assert fixed_db.get_shares(0, "XYZ") == 0
+
+
+class TestBackup:
+    def test_backup_restore(self, fixed_db: Database, tmp_path):
+        trade(fixed_db)
+        bundle = str(tmp_path / "bundle")
+        assert fixed_db.backup(bundle) == {"MEMBERS": 2, "CASH": 2, "HOLDINGS": 3}
+        # Backing up again replaces the bundle
+        fixed_db.register_user(2)
+        assert fixed_db.backup(bundle)["MEMBERS"] == 3
+        assert sorted(os.listdir(tmp_path)) == ["bundle"]
+        restored = Database(str(tmp_path / "restored.db"), fixed_point=True)
+        assert restored.restore(bundle) == {"MEMBERS": 3, "CASH": 3, "HOLDINGS": 3}
+        for member_id in range(3):
+            assert restored.get_cash(member_id) == fixed_db.get_cash(member_id)
+            assert list(restored.get_holdings(member_id)) == list(
+                fixed_db.get_holdings(member_id)
+            )
+        assert (
+            list(restored.leaderboard())[0].value == next(fixed_db.leaderboard()).value
+        )
+        # The restored balances open the ledger
+        assert restored.replay_ledger(dry_run=True) == 0
+        with pytest.raises(DatabaseNotEmptyException):
+            restored.restore(bundle)
+        restored.close()
+
+    def test_restore_converts(self, fixed_db: Database, tmp_path):
+        trade(fixed_db)
+        bundle = str(tmp_path / "bundle")
+        fixed_db.backup(bundle)
+        restored = Database(str(tmp_path / "restored.db"))
+        restored.restore(bundle)
+        assert restored.get_cash(0) * MICROS == fixed_db.get_cash(0)
+        restored.close()
+
+    def test_backup_online(self, db: Database, tmp_path):
+        async_db = AsyncDatabase(db)
+
+        async def backup_while_trading():
+            await async_db.register_user(0)
+            writes = [async_db.add_cash(0, 1) for _ in range(50)]
+            saved, *_ = await asyncio.gather(
+                async_db.backup(str(tmp_path / "bundle")), *writes
+            )
+            return saved
+
+        assert asyncio.run(backup_while_trading())["CASH"] == 1
+        async_db.stop()
+
+    def test_backup_serialized(self, db: Database, tmp_path):
+        async_db = AsyncDatabase(db)
+        bundle = str(tmp_path / "bundle")
+
+        async def backup_twice():
+            await async_db.register_user(0)
+            return await asyncio.gather(
+                async_db.backup(bundle), async_db.backup(bundle)
+            )
+
+        assert [saved["MEMBERS"] for saved in asyncio.run(backup_twice())] == [1, 1]
+        assert sorted(os.listdir(tmp_path)) == ["bundle"]
+        async_db.stop()
+
+    def test_pool_backup(self, tmp_path):
+        pool = DatabasePool(str(tmp_path / "db"))
+
+        async def backup():
+            for guild_id in [1, 2]:
+                async with pool.acquire(guild_id) as db:
+                    await db.register_user(0)
+            await pool.checkpoint()
+            return await pool.backup(str(tmp_path / "backups"))
+
+        saved = asyncio.run(backup())
+        assert {guild_id: rows["MEMBERS"] for guild_id, rows in saved.items()} == {
+            1: 1,
+            2: 1,
+        }
+        assert sorted(os.listdir(tmp_path / "backups")) == ["1", "2"]
+        pool.close()
+
+
+@pytest.fixture()
+def async_db(db: Database):
+    async_db = AsyncDatabase(db)
+    yield async_db
+    async_db.stop()
+
+
+class TestAsyncDatabase:
+    def test_methods(self, async_db: AsyncDatabase):
+        async def trade():
+            await async_db.register_user(0)
+            await async_db.buy_quonks(0, "ABC", 10, 10)
+            return await async_db.get_holdings(0)
+
+        holdings = asyncio.run(trade())
+        assert [holding.ticker for holding in holdings] == ["ABC"]
+
+    def test_group_commit(self, async_db: AsyncDatabase):
+        release = threading.Event()
+
+        async def trade():
+            # Hold the worker so that the trades queue up behind it
+            blocked = async_db.submit(release.wait)
+            registered = async_db.submit(async_db.db.register_user, 0)
+            trades = [async_db.buy_quonks(0, "ABC", 1, 10) for _ in range(10)]
+            release.set()
+            await asyncio.gather(blocked, registered, *trades)
+
+        asyncio.run(trade())
+        assert async_db.db.get_shares(0, "ABC") == 10
+        assert async_db.stats()["operations"] == 12
+        assert async_db.stats()["commits"] <= 2
+
+    def test_group_rollback(self, async_db: AsyncDatabase):
+        release = threading.Event()
+
+        async def trade():
+            # Hold the worker so that the trades queue up behind it
+            blocked = async_db.submit(release.wait)
+            registered = async_db.submit(async_db.db.register_user, 0)
+            trades = [async_db.buy_quonks(0, "ABC", 1, 1000) for _ in range(11)]
+            trades = asyncio.gather(*trades, return_exceptions=True)
+            release.set()
+            await blocked
+            await registered
+            return await trades
+
+        results = asyncio.run(trade())
+        # Only the trade that overdrew the account fails
+        assert results[:10] == [None] * 10
+        assert isinstance(results[10], NotEnoughCashException)
+        assert async_db.db.get_shares(0, "ABC") == 10
+        assert async_db.db.get_cash(0) == 0
+        # The rejection did not roll back the rest of its group
+        assert async_db.stats()["rollbacks"] == 0
+        assert async_db.stats()["commits"] <= 2
+
+    def test_group_error(self, async_db: AsyncDatabase):
+        release = threading.Event()
+
+        def fail():
+            raise ValueError()
+
+        async def trade():
+            blocked = async_db.submit(release.wait)
+            registered = async_db.submit(async_db.db.register_user, 0)
+            failed = async_db.submit(fail)
+            bought = async_db.buy_quonks(0, "ABC", 1, 10)
+            release.set()
+            return await asyncio.gather(
+                blocked, registered, failed, bought, return_exceptions=True
+            )
+
+        results = asyncio.run(trade())
+        # Other errors roll back the group, and only the failing operation fails
+        # when it is run again alone
+        assert isinstance(results[2], ValueError)
+        assert results[3] is None
+        assert async_db.stats()["rollbacks"] == 1
+        assert async_db.db.get_shares(0, "ABC") == 1
+
+    def test_run_alone(self, async_db: AsyncDatabase):
+        release = threading.Event()
+        groups = []
+        run_group = async_db.run_group
+
+        def record_group(group):
+            groups.append([operation.method.__name__ for operation in group])
+            run_group(group)
+
+        async_db.run_group = record_group
+
+        async def trade():
+            blocked = async_db.submit(release.wait)
+            registered = async_db.submit(async_db.db.register_user, 0)
+            cursor = async_db.submit(async_db.db.db.cursor)
+            bought = async_db.buy_quonks(0, "ABC", 1, 10)
+            release.set()
+            results = await asyncio.gather(blocked, registered, cursor, bought)
+            results[2].close()
+
+        asyncio.run(trade())
+        # Cursors are opened on their own, outside any group
+        assert ["cursor"] in groups
+        assert groups[-1] == ["buy_quonks"]
+
+
+class TestDatabasePool:
+    def test_partitioned(self, tmp_path):
+        pool = DatabasePool(str(tmp_path), max_open=4)
+
+        async def register():
+            async with pool.acquire(1) as db:
+                await db.register_user(0)
+                await db.add_cash(0, 5)
+            async with pool.acquire(2) as db:
+                await db.register_user(0)
+            async with pool.acquire(1) as db:
+                return [leader.value for leader in await db.leaderboard()]
+
+        assert asyncio.run(register()) == [10005]
+        assert pool.stats()["opens"] == 2
+        pool.close()
+        assert sorted(path.name for path in tmp_path.iterdir()) == ["1.db", "2.db"]
+
+    def test_single_open(self, tmp_path):
+        pool = DatabasePool(str(tmp_path))
+
+        async def acquire():
+            async with pool.acquire(1) as db:
+                return db
+
+        async def acquire_many():
+            return await asyncio.gather(*[acquire() for _ in range(10)])
+
+        assert len(set(asyncio.run(acquire_many()))) == 1
+        assert pool.stats()["opens"] == 1
+        pool.close()
+
+    def test_evict(self, tmp_path):
+        pool = DatabasePool(str(tmp_path), max_open=2)
+
+        async def open_guilds():
+            async with pool.acquire(1):
+                for guild_id in [2, 3, 4]:
+                    async with pool.acquire(guild_id) as db:
+                        await db.register_user(0)
+                # The acquired guild is kept while idle ones are closed
+                return list(pool.databases)
+
+        assert asyncio.run(open_guilds()) == [1, 4]
+        assert pool.stats()["evictions"] == 2
+        pool.close()
+
+    def test_evict_while_closing(self, tmp_path, monkeypatch):
+        pool = DatabasePool(str(tmp_path), max_open=3)
+        close = AsyncDatabase.close
+
+        def slow_close(db: AsyncDatabase):
+            time.sleep(0.05)
+            close(db)
+
+        monkeypatch.setattr(AsyncDatabase, "close", slow_close)
+
+        async def open_guilds():
+            for guild_id in [1, 2, 3]:
+                async with pool.acquire(guild_id) as db:
+                    await db.register_user(0)
+            pool.max_open = 1
+            # Guild 2 is acquired while guild 1 is being closed
+            evicting = asyncio.ensure_future(pool.evict())
+            await asyncio.sleep(0.01)
+            async with pool.acquire(2) as db:
+                await evicting
+                return await asyncio.wait_for(db.get_cash(0), 5)
+
+        assert asyncio.run(open_guilds()) == 10000
+        pool.close()
+
+    def test_import_legacy(self, tmp_path):
+        legacy = str(tmp_path / "quonks.db")
+        db = Database(legacy)
+        db.register_user(0)
+        db.close()
+        directory = str(tmp_path / "guilds")
+        pool = DatabasePool(
+            directory, fixed_point=True, legacy_path=legacy, legacy_guild_id=7
+        )
+
+        async def cash() -> int:
+            async with pool.acquire(7) as db:
+                return await db.get_cash(0)
+
+        # The legacy file is upgraded to micro-dollars on open
+        assert asyncio.run(cash()) == to_micros(10000)
+        pool.close()
+        # It is only imported while the guild has no database
+        db = Database(legacy)
+        db.add_cash(0, 5)
+        db.close()
+        pool = DatabasePool(
+            directory, fixed_point=True, legacy_path=legacy, legacy_guild_id=7
+        )
+        assert asyncio.run(cash()) == to_micros(10000)
+        pool.close()
+
+    def test_ingestor_interface(self, tmp_path):
+        pool = DatabasePool(str(tmp_path))
+
+        async def record():
+            for guild_id, ticker in [(1, "ABC"), (2, "XYZ")]:
+                async with pool.acquire(guild_id) as db:
+                    await db.register_user(0)
+                    await db.buy_quonks(0, ticker, 1, 10)
+            await pool.record_prices({"ABC": 11, "XYZ": 12})
+            async with pool.acquire(2) as db:
+                prices = await db.get_prices(["ABC", "XYZ"], 60)
+            return await pool.get_tickers(), prices
+
+        assert asyncio.run(record()) == (["ABC", "XYZ"], {"ABC": 11, "XYZ": 12})
+        pool.close()
+
+    def test_open_recent(self, tmp_path):
+        for guild_id in [1, 2, 3]:
+            Database(str(tmp_path / f"{guild_id}.db")).close()
+            os.utime(tmp_path / f"{guild_id}.db", (guild_id, guild_id))
+        (tmp_path / "notes.db").touch()
+        pool = DatabasePool(str(tmp_path))
+
+        async def open_recent():
+            return await pool.open_recent(2)
+
+        assert asyncio.run(open_recent()) == [3, 2]
+        # The most recently written guild is the most recently used
+        assert pool.ready() == [2, 3]
+        pool.close()
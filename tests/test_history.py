@@ -0,0 +1,27 @@
+import asyncio
+from datetime import datetime
+from bot.history import HistoryRecorder, sparkline
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.recorded = []
+
+    async def record_history(self, at: datetime):
+        self.recorded.append(at)
+
+
+class TestHistoryRecorder:
+    def test_run_cycle(self):
+        db = FakeDatabase()
+        recorder = HistoryRecorder(db)
+        asyncio.run(recorder.run_cycle())
+        assert len(db.recorded) == 1
+
+
+class TestSparkline:
+    def test_sparkline(self):
+        assert sparkline([]) == ""
+        assert sparkline([5, 5]) == "▁▁"
+        assert sparkline([0, 7, 14]) == "▁▄█"
+        assert sparkline([1.0, 1.5]) == "▁█"
@@ -0,0 +1,71 @@
+import asyncio
+import pytest
+from bot.database import AsyncDatabase, Database
+from bot.ingestor import MarketDataIngestor
+from bot.stocks import QuoteBatchException, QuoteException
+
+
+@pytest.fixture()
+def db():
+    db = Database("db/test.db")
+    async_db = AsyncDatabase(db)
+    yield async_db
+    async_db.stop()
+    db.clear()
+
+
+def holdings(db: AsyncDatabase, tickers: list[str]):
+    db.db.register_user(0)
+    for ticker in tickers:
+        db.db.buy_quonks(0, ticker, 1, 1)
+
+
+class TestMarketDataIngestor:
+    def test_run_cycle(self, db: AsyncDatabase):
+        holdings(db, ["ABC", "DEF", "XYZ"])
+        batches = []
+
+        async def fetch_prices(tickers: list[str]) -> dict[str, float]:
+            batches.append(tickers)
+            return {ticker: 10 for ticker in tickers}
+
+        ingestor = MarketDataIngestor(db, fetch_prices, batch_size=2)
+        assert asyncio.run(ingestor.run_cycle()) == 3
+        assert batches == [["ABC", "DEF"], ["XYZ"]]
+        assert db.db.get_prices(["ABC", "XYZ", "GHI"], max_age=60) == {
+            "ABC": 10,
+            "XYZ": 10,
+        }
+        assert db.db.get_price("ABC", max_age=0) is None
+
+    def test_max_fetches(self, db: AsyncDatabase):
+        holdings(db, ["ABC", "DEF", "XYZ"])
+        ingestor = MarketDataIngestor(db, None, max_fetches=2)
+        assert asyncio.run(ingestor.next_tickers()) == ["ABC", "DEF"]
+        assert asyncio.run(ingestor.next_tickers()) == ["XYZ", "ABC"]
+        assert asyncio.run(ingestor.next_tickers()) == ["DEF", "XYZ"]
+
+    def test_partial_failure(self, db: AsyncDatabase):
+        holdings(db, ["ABC", "XYZ"])
+
+        async def fetch_prices(tickers: list[str]) -> dict[str, float]:
+            raise QuoteBatchException({"ABC": 10}, {"XYZ": QuoteException()})
+
+        ingestor = MarketDataIngestor(db, fetch_prices)
+        assert asyncio.run(ingestor.run_cycle()) == 1
+        assert db.db.get_price("ABC", max_age=60) == 10
+
+    def test_backoff(self, db: AsyncDatabase):
+        holdings(db, ["ABC"])
+
+        async def fetch_prices(tickers: list[str]) -> dict[str, float]:
+            raise QuoteException()
+
+        ingestor = MarketDataIngestor(db, fetch_prices, interval=10, max_backoff=50)
+        with pytest.raises(QuoteException):
+            asyncio.run(ingestor.run_cycle())
+        assert ingestor.delay() == 10
+        ingestor.failures = 2
+        assert ingestor.delay() == 40
+        ingestor.failures = 3
+        assert ingestor.delay() == 50
@@ -0,0 +1,66 @@
+import asyncio
+import pytest
+from bot.metrics import Metrics
+
+
+def test_counter():
+    metrics = Metrics()
+    metrics.inc("quotes_total", result="hit")
+    metrics.inc("quotes_total", 2, result="hit")
+    metrics.inc("quotes_total", result="miss")
+    text = metrics.render()
+    assert "# TYPE quotes_total counter" in text
+    assert 'quotes_total{result="hit"} 3' in text
+    assert 'quotes_total{result="miss"} 1' in text
+
+
+def test_gauge():
+    metrics = Metrics()
+    metrics.set("queue_depth", 3, priority="bulk")
+    metrics.set("queue_depth", 1, priority="bulk")
+    text = metrics.render()
+    assert "# TYPE queue_depth gauge" in text
+    assert 'queue_depth{priority="bulk"} 1' in text
+
+
+def test_histogram():
+    metrics = Metrics()
+    metrics.observe("command_seconds", 0.003, command="buy")
+    metrics.observe("command_seconds", 0.2, command="buy")
+    text = metrics.render()
+    assert "# TYPE command_seconds histogram" in text
+    assert 'command_seconds_bucket{command="buy",le="0.001"} 0' in text
+    assert 'command_seconds_bucket{command="buy",le="0.005"} 1' in text
+    assert 'command_seconds_bucket{command="buy",le="+Inf"} 2' in text
+    assert 'command_seconds_count{command="buy"} 2' in text
+
+
+def test_timer():
+    metrics = Metrics()
+    with metrics.timer("query_seconds", method="get_cash"):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.timer("query_seconds", method="get_cash"):
+            raise ValueError()
+    text = metrics.render()
+    assert 'query_seconds_count{method="get_cash",outcome="ok"} 1' in text
+    assert 'query_seconds_count{method="get_cash",outcome="error"} 1' in text
+
+
+def test_serve():
+    metrics = Metrics()
+    metrics.inc("quotes_total")
+
+    async def scrape() -> bytes:
+        await metrics.serve(port=0)
+        port = metrics.server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+        await metrics.close()
+        return response
+
+    response = asyncio.run(scrape())
+    assert response.startswith(b"HTTP/1.1 200 OK")
+    assert b"quotes_total 1" in response
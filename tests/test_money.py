@@ -0,0 +1,16 @@
+from bot.money import format_money, to_dollars, to_micros
+
+
+class TestMoney:
+    def test_to_micros(self):
+        assert to_micros(0.1) == 100_000
+        assert to_micros(123.456789) == 123_456_789
+        assert to_micros(10000) == 10_000_000_000
+        assert to_dollars(to_micros(0.1)) == 0.1
+
+    def test_format_money(self):
+        assert format_money(0) == "$0.00"
+        assert format_money(to_micros(1234567.891)) == "$1,234,567.89"
+        assert format_money(4_995_000) == "$5.00"
+        assert format_money(4_994_999) == "$4.99"
+        assert format_money(-to_micros(12.5)) == "-$12.50"
@@ -1,8 +1,362 @@
+import asyncio
+import duckdb
+import numpy as np
+import os
+import time
 import pytest
-from bot.stocks import QuoteException, get_stock_price
+from bot import stocks
+from bot.symbols import SymbolIndex
+from bot.stocks import (
+    QuoteBatchException,
+    QuoteCache,
+    QuoteException,
+    QuoteOverloadedException,
+    QuoteScheduler,
+    TapeProvider,
+    UnknownTickerException,
+    get_stock_price,
+    get_stock_price_async,
+    get_stock_prices_async,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture()
+def quote_cache(monkeypatch):
+    quote_cache = QuoteCache()
+    monkeypatch.setattr(stocks, "quote_cache", quote_cache)
+    yield quote_cache
 
 
 def test_get_stock_price():
     get_stock_price("MSFT")
     with pytest.raises(QuoteException):
         get_stock_price("FOOBARFOOBAR")
+
+
+def test_get_stock_price_async(monkeypatch, quote_cache: QuoteCache):
+    monkeypatch.setattr(stocks, "get_stock_price", lambda ticker: 100)
+    assert asyncio.run(get_stock_price_async("MSFT")) == 100
+    assert asyncio.run(get_stock_price_async("msft")) == 100
+    assert quote_cache.misses == 1
+    assert quote_cache.hits == 1
+
+
+def test_get_stock_price_async_timeout(monkeypatch, quote_cache: QuoteCache):
+    def slow_price(ticker: str) -> float:
+        time.sleep(0.5)
+        return 100
+
+    monkeypatch.setattr(stocks, "get_stock_price", slow_price)
+    with pytest.raises(QuoteException):
+        asyncio.run(get_stock_price_async("MSFT", timeout=0.01))
+    # Failed quotes are not cached
+    assert quote_cache.get("MSFT") is None
+
+
+def fake_price(ticker: str) -> float:
+    if ticker == "FOOBARFOOBAR":
+        raise QuoteException(f"Unable to quote: ${ticker}")
+    return len(ticker)
+
+
+class BatchProvider(stocks.QuoteProvider):
+    batched = True
+
+    def __init__(self):
+        self.batches = []
+
+    def get_prices(self, tickers: list[str]) -> dict[str, float | None]:
+        self.batches.append(tickers)
+        return {ticker: len(ticker) if ticker != "DEF" else None for ticker in tickers}
+
+
+def test_get_stock_prices_batched(monkeypatch, quote_cache: QuoteCache):
+    provider = BatchProvider()
+    monkeypatch.setattr(stocks, "provider", provider)
+    prices = asyncio.run(get_stock_prices_async(["ABC", "ABCD", "ABC"]))
+    assert prices == {"ABC": 3, "ABCD": 4}
+    # Only the tickers that are not cached are asked for, in one request
+    with pytest.raises(QuoteBatchException) as e:
+        asyncio.run(get_stock_prices_async(["ABC", "DEF", "XY"]))
+    assert e.value.prices == {"ABC": 3, "XY": 2}
+    assert list(e.value.errors) == ["DEF"]
+    assert provider.batches == [["ABC", "ABCD"], ["DEF", "XY"]]
+    assert quote_cache.is_unknown("DEF")
+    assert quote_cache.stats()["inflight"] == 0
+
+
+def test_get_stock_prices_batched_coalesced(monkeypatch, quote_cache: QuoteCache):
+    provider = BatchProvider()
+    monkeypatch.setattr(stocks, "provider", provider)
+    monkeypatch.setattr(stocks, "get_stock_price", fake_price)
+
+    async def quote_many():
+        return await asyncio.gather(
+            get_stock_prices_async(["ABC", "XY"]),
+            get_stock_prices_async(["XY", "ABCD"]),
+        )
+
+    assert asyncio.run(quote_many()) == [{"ABC": 3, "XY": 2}, {"XY": 2, "ABCD": 4}]
+    # The second batch waits for XY from the first instead of asking again
+    assert provider.batches == [["ABC", "XY"], ["ABCD"]]
+    assert quote_cache.stats()["coalesced"] == 1
+
+
+def test_get_stock_prices_async(monkeypatch, quote_cache: QuoteCache):
+    monkeypatch.setattr(stocks, "get_stock_price", fake_price)
+    assert asyncio.run(get_stock_prices_async(["ABC", "ABCD"])) == {"ABC": 3, "ABCD": 4}
+    with pytest.raises(QuoteBatchException) as e:
+        asyncio.run(get_stock_prices_async(["ABC", "FOOBARFOOBAR"]))
+    assert e.value.prices == {"ABC": 3}
+    assert list(e.value.errors) == ["FOOBARFOOBAR"]
+
+
+class TestQuoteCache:
+    def test_ttl(self):
+        clock = FakeClock()
+        cache = QuoteCache(ttl=10, clock=clock)
+        cache.put("ABC", 100)
+        assert cache.get("ABC") == 100
+        clock.now = 10
+        assert cache.get("ABC") is None
+
+    def test_lru_eviction(self):
+        cache = QuoteCache(max_size=2)
+        cache.put("ABC", 1)
+        cache.put("XYZ", 2)
+        # Touch ABC so that XYZ is the least recently used
+        cache.get("ABC")
+        cache.put("DEF", 3)
+        assert cache.get("XYZ") is None
+        assert cache.get("ABC") == 1
+        assert cache.get("DEF") == 3
+
+    def test_coalesced_fetch(self):
+        cache = QuoteCache()
+        calls = []
+
+        async def fetch(ticker: str) -> float:
+            calls.append(ticker)
+            await asyncio.sleep(0.01)
+            return 100
+
+        async def quote_many():
+            return await asyncio.gather(*[cache.fetch("ABC", fetch) for _ in range(10)])
+
+        assert asyncio.run(quote_many()) == [100] * 10
+        assert len(calls) == 1
+        assert cache.stats()["misses"] == 1
+        assert cache.stats()["coalesced"] == 9
+        assert cache.stats()["inflight"] == 0
+
+    def test_negative_cache(self):
+        clock = FakeClock()
+        cache = QuoteCache(negative_ttl=60, clock=clock)
+        calls = []
+
+        async def fetch(ticker: str) -> float:
+            calls.append(ticker)
+            raise UnknownTickerException(f"Unable to quote: ${ticker}")
+
+        for now in [0, 30, 60]:
+            clock.now = now
+            with pytest.raises(UnknownTickerException):
+                asyncio.run(cache.fetch("FOOBARFOOBAR", fetch))
+        # Refetched only once the negative entry expired
+        assert len(calls) == 2
+        assert cache.stats()["negative_hits"] == 1
+
+    def test_timeouts_not_negative(self):
+        cache = QuoteCache()
+
+        async def fetch(ticker: str) -> float:
+            raise QuoteException(f"Timed out quoting: ${ticker}")
+
+        with pytest.raises(QuoteException):
+            asyncio.run(cache.fetch("ABC", fetch))
+        assert not cache.is_unknown("ABC")
+
+
+class TestQuoteScheduler:
+    def test_rate(self):
+        scheduler = QuoteScheduler(rate=50, burst=1)
+
+        async def acquire_many():
+            await asyncio.gather(*[scheduler.acquire() for _ in range(6)])
+
+        started = time.perf_counter()
+        asyncio.run(acquire_many())
+        # The first request spends the burst, and the other five wait 20ms each
+        assert time.perf_counter() - started >= 0.09
+        assert scheduler.stats()["granted"] == 6
+        assert scheduler.stats()["queued"] == 5
+
+    def test_unlimited(self):
+        scheduler = QuoteScheduler(rate=0, burst=0)
+
+        async def acquire_many():
+            await asyncio.gather(*[scheduler.acquire() for _ in range(100)])
+
+        asyncio.run(acquire_many())
+        assert scheduler.stats()["queued"] == 0
+
+    def test_priority(self):
+        scheduler = QuoteScheduler(rate=100, burst=1)
+        order = []
+
+        async def acquire(priority: str, name: str):
+            await scheduler.acquire(priority, name)
+            order.append(name)
+
+        async def acquire_many():
+            await scheduler.acquire()
+            tasks = [asyncio.create_task(acquire("bulk", f"B{i}")) for i in range(3)]
+            await asyncio.sleep(0)
+            tasks.append(asyncio.create_task(acquire("interactive", "I")))
+            await asyncio.gather(*tasks)
+
+        asyncio.run(acquire_many())
+        # The command queued last is served before the bulk refreshes
+        assert order == ["I", "B0", "B1", "B2"]
+
+    def test_shed(self):
+        scheduler = QuoteScheduler(rate=1, burst=1, max_queue=1)
+
+        async def overload():
+            await scheduler.acquire()
+            waiting = [
+                asyncio.create_task(scheduler.acquire("bulk", "ABC")),
+                asyncio.create_task(scheduler.acquire("interactive", "XYZ")),
+            ]
+            await asyncio.sleep(0)
+            with pytest.raises(QuoteOverloadedException):
+                await scheduler.acquire("bulk", "DEF")
+            assert scheduler.depth == {"interactive": 1, "bulk": 1}
+            # Waiters that give up leave the queue
+            for task in waiting:
+                task.cancel()
+            await asyncio.gather(*waiting, return_exceptions=True)
+
+        asyncio.run(overload())
+        assert scheduler.depth == {"interactive": 0, "bulk": 0}
+        assert scheduler.stats()["shed"] == 1
+
+    def test_promote(self, monkeypatch, quote_cache: QuoteCache):
+        scheduler = QuoteScheduler(rate=100, burst=1)
+        monkeypatch.setattr(stocks, "quote_scheduler", scheduler)
+        monkeypatch.setattr(stocks, "get_stock_price", fake_price)
+        order = []
+
+        async def quote(ticker: str, priority: str):
+            await get_stock_price_async(ticker, priority=priority)
+            order.append((ticker, priority))
+
+        async def quote_many():
+            await scheduler.acquire()
+            tasks = [
+                asyncio.create_task(quote(ticker, "bulk")) for ticker in ["A", "BB"]
+            ]
+            while scheduler.depth["bulk"] < 2:
+                await asyncio.sleep(0)
+            # A command joins the queued bulk fetch of BB
+            tasks.append(asyncio.create_task(quote("BB", "interactive")))
+            await asyncio.gather(*tasks)
+
+        asyncio.run(quote_many())
+        assert order[0] == ("BB", "bulk")
+        assert order[-1] == ("A", "bulk")
+        assert scheduler.stats()["promoted"] == 1
+        assert quote_cache.misses == 2
+
+
+def test_symbol_index_rejects(monkeypatch, quote_cache: QuoteCache):
+    monkeypatch.setattr(stocks, "symbols", SymbolIndex({"MSFT": "Microsoft"}))
+    monkeypatch.setattr(stocks, "get_stock_price", lambda ticker: 100)
+    assert asyncio.run(get_stock_price_async("msft")) == 100
+    with pytest.raises(UnknownTickerException, match="Unknown ticker"):
+        asyncio.run(get_stock_price_async("FOOBARFOOBAR"))
+    assert quote_cache.misses == 1
+
+
+@pytest.fixture()
+def tape(tmp_path) -> str:
+    path = tmp_path / "tape.csv"
+    path.write_text(
+        "ticker,timestamp,price\n"
+        "abc,2024-01-01 00:00:00,10\n"
+        "abc,2024-01-01 00:01:00,11\n"
+        "xyz,2024-01-01 00:00:30,5\n"
+        "abc,2024-01-01 00:02:00,12\n"
+    )
+    return str(path)
+
+
+class TestTapeProvider:
+    def test_replay(self, tape: str):
+        clock = FakeClock()
+        provider = TapeProvider(tape, speed=60, clock=clock)
+        assert isinstance(provider.prices, np.memmap)
+        assert provider.get_prices(["ABC", "xyz", "DEF"]) == {
+            "ABC": 10,
+            "xyz": 5,
+            "DEF": None,
+        }
+        # One second of clock time is one minute of replay time
+        clock.now = 1
+        assert provider.get_price("ABC") == 11
+        clock.now = 10
+        assert provider.get_price("ABC") == 12
+
+    def test_get_history(self, tape: str):
+        clock = FakeClock()
+        provider = TapeProvider(tape, speed=60, clock=clock)
+        clock.now = 1
+        # The window starts with the last tick before it
+        timestamps, prices = provider.get_history("abc", 30)
+        assert prices.tolist() == [10, 11]
+        assert (timestamps[1] - timestamps[0]) == 60
+        timestamps, prices = provider.get_history("ABC", 3600)
+        assert prices.tolist() == [10, 11]
+        assert provider.get_history("DEF", 60) is None
+
+    def test_compile_in_chunks(self, tape: str, tmp_path, monkeypatch):
+        whole = TapeProvider(tape, cache_dir=str(tmp_path / "whole"))
+        monkeypatch.setattr(TapeProvider, "chunk_rows", 1)
+        chunked = TapeProvider(tape, cache_dir=str(tmp_path / "chunked"))
+        assert chunked.tickers == whole.tickers == {"ABC": [0, 3], "XYZ": [3, 4]}
+        assert chunked.timestamps.tolist() == whole.timestamps.tolist()
+        assert chunked.prices.tolist() == [10, 11, 12, 5]
+        # The scratch database is removed after compiling
+        assert sorted(os.listdir(tmp_path / "chunked")) == [
+            "prices.npy",
+            "tickers.json",
+            "timestamps.npy",
+        ]
+
+    def test_loop(self, tape: str):
+        clock = FakeClock()
+        provider = TapeProvider(tape, speed=60, loop=True, clock=clock)
+        clock.now = 2.5
+        assert provider.get_price("ABC") == 10
+
+    def test_parquet(self, tape: str, tmp_path):
+        path = str(tmp_path / "tape.parquet")
+        duckdb.execute(f"COPY (SELECT * FROM read_csv_auto('{tape}')) TO '{path}'")
+        provider = TapeProvider(path, clock=FakeClock())
+        assert provider.get_price("XYZ") == 5
+
+    def test_get_stock_prices(self, tape: str, monkeypatch, quote_cache: QuoteCache):
+        monkeypatch.setattr(stocks, "provider", TapeProvider(tape, clock=FakeClock()))
+        prices = asyncio.run(get_stock_prices_async(["ABC", "XYZ"]))
+        assert prices == {"ABC": 10, "XYZ": 5}
+        with pytest.raises(QuoteBatchException) as e:
+            asyncio.run(get_stock_prices_async(["ABC", "DEF"]))
+        assert list(e.value.errors) == ["DEF"]
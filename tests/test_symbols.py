@@ -0,0 +1,38 @@
+import pytest
+from bot.symbols import SymbolIndex
+
+
+@pytest.fixture()
+def index(tmp_path) -> SymbolIndex:
+    path = tmp_path / "symbols.txt"
+    path.write_text(
+        "Symbol|Security Name|Market Category\n"
+        "MSFT|Microsoft Corporation - Common Stock|Q\n"
+        "AAPL|Apple Inc. - Common Stock|Q\n"
+        "AA|Alcoa Corporation|N\n"
+        "AAL|American Airlines Group, Inc.|Q\n"
+        "File Creation Time: 0101202600:00|||\n"
+    )
+    return SymbolIndex.load(str(path))
+
+
+class TestSymbolIndex:
+    def test_load(self, index: SymbolIndex):
+        assert index.symbols == ["AA", "AAL", "AAPL", "MSFT"]
+        assert index.names[2] == "Apple Inc. - Common Stock"
+
+    def test_contains(self, index: SymbolIndex):
+        assert "msft" in index
+        assert "AAP" not in index
+        assert "ZZZZ" not in index
+
+    def test_search(self, index: SymbolIndex):
+        assert [symbol for symbol, _ in index.search("aa")] == ["AA", "AAL", "AAPL"]
+        assert index.search("AAP") == [("AAPL", "Apple Inc. - Common Stock")]
+        assert len(index.search("", limit=2)) == 2
+        assert index.search("B") == []
+
+    def test_plain_list(self, tmp_path):
+        path = tmp_path / "symbols.txt"
+        path.write_text("ibm\nGE\n")
+        assert SymbolIndex.load(str(path)).search("") == [("GE", ""), ("IBM", "")]
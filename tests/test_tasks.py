@@ -0,0 +1,57 @@
+import asyncio
+from bot.tasks import PeriodicTask
+
+
+class Counter(PeriodicTask):
+    def __init__(self, interval: float, fail: int = 0):
+        super().__init__(interval)
+        self.cycles = 0
+        self.fail = fail
+
+    async def run_cycle(self):
+        self.cycles += 1
+        if self.cycles <= self.fail:
+            raise RuntimeError("cycle failed")
+
+
+class TestPeriodicTask:
+    def test_start_stop(self):
+        task = Counter(interval=0.01)
+
+        async def run():
+            assert task.start() is task.start()
+            await asyncio.sleep(0.05)
+            await task.stop()
+
+        asyncio.run(run())
+        assert task.cycles >= 2
+        assert task.task is None
+
+    def test_wait_first(self):
+        task = Counter(interval=10)
+        task.wait_first = True
+
+        async def run():
+            task.start()
+            await asyncio.sleep(0.01)
+            await task.stop()
+
+        asyncio.run(run())
+        assert task.cycles == 0
+
+    def test_failures(self):
+        task = Counter(interval=0.01, fail=2)
+
+        async def run():
+            task.start()
+            while task.cycles < 2:
+                await asyncio.sleep(0.01)
+            failures = task.failures
+            while task.cycles < 3:
+                await asyncio.sleep(0.01)
+            await task.stop()
+            return failures
+
+        # Failed cycles are counted, and the task keeps running until one succeeds
+        assert asyncio.run(run()) == 2
+        assert task.failures == 0
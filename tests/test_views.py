@@ -0,0 +1,97 @@
+import asyncio
+import pytest
+from bot.views import ViewCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture()
+def clock() -> FakeClock:
+    return FakeClock()
+
+
+class Builder:
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.builds = 0
+
+    async def __call__(self) -> int:
+        self.builds += 1
+        await asyncio.sleep(self.delay)
+        return self.builds
+
+
+class TestViewCache:
+    def test_reuse_within_ttl(self, clock: FakeClock):
+        views = ViewCache(ttl=10, clock=clock)
+        build = Builder()
+        assert asyncio.run(views.fetch(0, build)) == 1
+        assert asyncio.run(views.fetch(0, build)) == 1
+        clock.now = 10
+        assert asyncio.run(views.fetch(0, build)) == 2
+        assert views.stats()["hits"] == 1
+        assert views.stats()["misses"] == 2
+
+    def test_invalidate(self, clock: FakeClock):
+        views = ViewCache(ttl=10, clock=clock)
+        build = Builder()
+        assert asyncio.run(views.fetch(0, build)) == 1
+        views.invalidate(0)
+        assert asyncio.run(views.fetch(0, build)) == 2
+
+    def test_coalesced_build(self, clock: FakeClock):
+        views = ViewCache(ttl=10, clock=clock)
+        build = Builder(delay=0.01)
+
+        async def click_many():
+            return await asyncio.gather(*[views.fetch(0, build) for _ in range(10)])
+
+        assert asyncio.run(click_many()) == [1] * 10
+        assert build.builds == 1
+        assert views.stats()["coalesced"] == 9
+
+    def test_invalidated_during_build(self, clock: FakeClock):
+        views = ViewCache(ttl=10, clock=clock)
+        build = Builder(delay=0.01)
+
+        async def trade_during_build():
+            view = asyncio.ensure_future(views.fetch(0, build))
+            await asyncio.sleep(0)
+            views.invalidate(0)
+            return await view
+
+        assert asyncio.run(trade_during_build()) == 1
+        # The view built from the old holdings is not reused
+        assert views.get(0) is None
+
+    def test_failed_build(self, clock: FakeClock):
+        views = ViewCache(ttl=10, clock=clock)
+
+        async def build():
+            raise ValueError()
+
+        with pytest.raises(ValueError):
+            asyncio.run(views.fetch(0, build))
+        assert views.get(0) is None
+
+    def test_versions_bounded(self, clock: FakeClock):
+        views = ViewCache(ttl=10, max_size=2, clock=clock)
+
+        async def trade_during_builds():
+            for key in range(100):
+                view = asyncio.ensure_future(views.fetch(key, Builder(delay=0.001)))
+                await asyncio.sleep(0)
+                views.invalidate(key)
+                await view
+                await views.fetch(key, Builder())
+
+        asyncio.run(trade_during_builds())
+        # Versions are only kept for the views that are still cached
+        assert views.stats()["size"] == 2
+        assert views.stats()["versions"] <= 2